@@ -0,0 +1,137 @@
+""" This module frames Tiny-PyRPG messages so they survive the trip over a TCP stream.
+    Every message is sent as a 4 byte big-endian length header followed by the
+    payload, and the receiving side reassembles messages from whatever chunks
+    the socket hands it. Keep this file identical in the client and the server,
+    which src/server/tests/test_framing.py checks. """
+import asyncio
+import struct
+
+HEADER = struct.Struct("!I")
+
+# Anything larger than this is treated as a corrupt or hostile stream.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# How much room to make in the receive buffer before each read.
+READ_SIZE = 65536
+
+class FrameError(Exception):
+    """ Raised when the stream does not hold valid frames. """
+
+def pack_frame(payload):
+    """ Returns the payload with its length header in front of it. """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError("frame of {} bytes is too large".format(len(payload)))
+    return HEADER.pack(len(payload)) + payload
+
+class FrameBuffer:
+    """ A streaming reassembly buffer. Bytes are read straight into one growing
+        bytearray, complete frames are sliced out of it in place, and the
+        consumed space is only reclaimed when more room is needed. """
+
+    def __init__(self):
+        self._buf = bytearray(READ_SIZE)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """ Makes sure there are at least size free bytes after the buffered data. """
+        if len(self._buf) - self._end >= size:
+            return
+        # Slide the unread bytes to the front before growing.
+        pending = self._end - self._start
+        if self._start:
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        if len(self._buf) - self._end < size:
+            self._buf.extend(bytes(size - (len(self._buf) - self._end)))
+
+    def feed(self, data):
+        """ Appends bytes received from somewhere other than read_from. """
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def read_from(self, sock):
+        """ Reads one chunk from the socket into the buffer. Returns the number
+            of bytes read, which is 0 once the peer has closed the connection. """
+        self._reserve(READ_SIZE)
+        with memoryview(self._buf) as view:
+            count = sock.recv_into(view[self._end:])
+        self._end += count
+        return count
+
+    def take(self):
+        """ Removes and returns every byte that has not been read as a frame yet. """
+        with memoryview(self._buf) as view:
+            pending = bytes(view[self._start:self._end])
+        self._start = 0
+        self._end = 0
+        return pending
+
+    def next_frame(self):
+        """ Returns the next complete payload, or None if it has not fully arrived. """
+        pending = self._end - self._start
+        if pending < HEADER.size:
+            return None
+        (size,) = HEADER.unpack_from(self._buf, self._start)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError("frame of {} bytes is too large".format(size))
+        if pending < HEADER.size + size:
+            return None
+        start = self._start + HEADER.size
+        with memoryview(self._buf) as view:
+            payload = bytes(view[start:start + size])
+        self._start = start + size
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+        return payload
+
+class FramedSocket:
+    """ Wraps a connected socket to send and receive whole messages. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = FrameBuffer()
+
+    def send(self, payload):
+        self.sock.sendall(pack_frame(payload))
+
+    def recv(self):
+        """ Blocks until a whole message has arrived and returns it.
+            Returns None once the peer has closed the connection, which is not
+            the same as a message with an empty payload. """
+        while True:
+            payload = self.buffer.next_frame()
+            if payload is not None:
+                return payload
+            if not self.buffer.read_from(self.sock):
+                return None
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def shutdown(self, how):
+        try:
+            self.sock.shutdown(how)
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+async def read_frame(reader):
+    """ Reads one whole message from an asyncio stream.
+        Returns None once the peer has closed the connection. """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (size,) = HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError("frame of {} bytes is too large".format(size))
+        return await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
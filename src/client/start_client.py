@@ -1,12 +1,14 @@
 # Standard module imports
 import ipaddress
-import json
 import socket
 import sys
 import threading
 import time
 from queue import Queue
 
+from codec import JSON_CODEC, CODECS, CodecError, codec_offer
+from framing import FrameError, FramedSocket
+
 # PyQt5 imports
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import QMainWindow
@@ -303,29 +305,126 @@ class ClientSocket:
         print("Creating Socket")
         self.parent = parent
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn = FramedSocket(self.sock)
+        self.codec = JSON_CODEC
+        self.responses = Queue()
+        self.in_game = False
+        # The last full lobby and game, which deltas from the server are merged into.
+        self.lobby_state = None
+        self.game_state = None
+        # Set once the server has ended the game, so losing the connection after that is expected.
+        self.game_over = False
+
+    def listen(self):
+        # Reads everything the server sends. Pushed updates are applied straight away
+        # and answers to requests are handed to the command loop through self.responses.
+        while True:
+            # A message that cannot be read ends the connection just like the server leaving,
+            # so the command loop is woken with None and connection_closed still runs.
+            try:
+                payload = self.conn.recv()
+                response = None if payload is None else self.codec.decode(payload)
+            except (OSError, FrameError, CodecError, ValueError):
+                response = None
+            if response is None:
+                self.responses.put(None)
+                return
+            if response["response"] == "PUSH":
+                self.apply_push(self.apply_delta(response["data"]))
+            else:
+                self.responses.put(self.apply_delta(response))
+
+    def recv_response(self):
+        # Returns the answer to the last request, or None if the connection ended first.
+        return self.responses.get()
+
+    def connection_closed(self):
+        if not self.game_over:
+            self.parent.signal.sig_with_strs.emit("Lost the connection to the server.")
+            self.parent.signal.sig_quit.emit()
+
+    def apply_delta(self, response):
+        # Remembers full lobbies and games, and merges deltas into them so the rest
+        # of the client only ever sees full LOBBY DATA and GAME DATA responses.
+        kind = response["response"]
+        data = response["data"]
+        if kind == "LOBBY DATA" or kind == "JOIN ACCEPT":
+            self.lobby_state = data
+        elif kind == "GAME DATA" or kind == "GAME START":
+            self.game_state = data
+        elif kind == "LOBBY DELTA":
+            self.lobby_state["version"] = data["version"]
+            self.lobby_state["player-number"] = data["player-number"]
+            for player, fields in data["lobby"].items():
+                self.lobby_state["lobby"][player].update(fields)
+            response = {"response": "LOBBY DATA", "data": self.lobby_state}
+        elif kind == "GAME DELTA":
+            self.game_state["version"] = data["version"]
+            if "actions" in data:
+                self.game_state["actions"] = data["actions"]
+            game = self.game_state["game"]
+            for key, value in data["game"].items():
+                if key != "players":
+                    game[key] = value
+            for player, fields in data["game"]["players"].items():
+                game["players"][player].update(fields)
+            response = {"response": "GAME DATA", "data": self.game_state}
+        return response
+
+    def apply_push(self, push):
+        data = push["data"]
+        response = push["response"]
+        if response == "LOBBY DATA" and not self.in_game:
+            self.parent.window._update_players(data)
+        elif response == "GAME DATA":
+            if self.in_game:
+                self.parent.window._update_players(data)
+            else:
+                # The game was started by someone else; the next lobby request moves us into it.
+                self.parent.command_queue.put("GET UPDATE")
+        elif response == "END GAME":
+            # Wake the command loop with None so it stops instead of waiting on a closed socket.
+            self.game_over = True
+            self.parent.command_queue.put(None)
+            self.parent.signal.sig_with_strs.emit(data)
+            time.sleep(1)
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+            self.parent.signal.sig_quit.emit()
 
     def start(self):
         print("Starting Socket")
         self.sock.connect((self.parent.connected_ip, 52000))
-        self.sock.send("Tiny-PyRPG Client".encode())
-        data = self.sock.recv(4096)
+        # Offer the server our codecs along with the handshake; it names the one it picked.
+        # Servers on this machine or network are offered JSON first, see codec_offer.
+        address = ipaddress.IPv4Address(self.parent.connected_ip)
+        remote = not (address.is_loopback or address.is_private)
+        self.conn.send("Tiny-PyRPG Client\n{}".format(codec_offer(remote)).encode())
+        data = self.conn.recv()
+        data, _, codec = (data if data is not None else b"").partition(b"\n")
 
         if not data or data != "Tiny-PyRPG Server".encode():
-            self.sock.shutdown(socket.SHUT_RDWR)()
+            self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
             emsg = QErrorMessage(self.parent)
             emsg.showMessage("Error: Tried to connect to server. Server failed handshake. Closing connection.")
             self.parent.go_to_main_menu()
             return
+        if codec:
+            self.codec = CODECS.get(codec.decode(), JSON_CODEC)
 
         data = {}
         data["request"] = "JOIN LOBBY"
         data["data"] = self.parent.username
-        data = json.dumps(data).encode()
-        self.sock.sendall(data)
+        data = self.codec.encode(data)
+        self.conn.send(data)
 
-        response = self.sock.recv(4096)
-        response = json.loads(response)
+        response = self.conn.recv()
+        if response is None:
+            self.sock.close()
+            self.connection_closed()
+            return
+        response = self.codec.decode(response)
         data = response["data"]
         response = response["response"] 
 
@@ -369,23 +468,34 @@ class ClientSocket:
                 self.parent.player = lobby["p5"]
             elif pnum == 6:
                 self.parent.player = lobby["p6"]
-                            
-        self.parent.command_queue.put("GET UPDATE")
+
+        # From here on the server may push updates at any time, so a listener thread reads the socket.
+        self.listener = threading.Thread(target=self.listen)
+        self.listener.daemon = True
+        self.listener.start()
+        # Ask for a full lobby and deltas from then on, then have every change pushed.
+        self.parent.command_queue.put("SYNC")
+        self.parent.command_queue.put("SUBSCRIBE")
 
 
 #################################  LOBBY LOOP    #######################################
         while True:
             command = self.parent.command_queue.get()
+            if command is None:
+                # The game ended, see apply_push.
+                return
 
             ##  Update Profession
             if command == "UPDATE PROFESSION":
                 data = {}
                 data["request"] = "UPDATE PROFESSION"
                 data["data"] = self.parent.player["profession"]
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 game = response["data"]
                 response = response["response"]
                 if response == "GAME START":
@@ -407,10 +517,12 @@ class ClientSocket:
                     data = {}
                     data["request"] = "UPDATE READY"
                     data["data"] = not self.parent.ready
-                    data = json.dumps(data).encode()
-                    self.sock.sendall(data)
-                    response = self.sock.recv(4096)
-                    response = json.loads(response.decode())
+                    data = self.codec.encode(data)
+                    self.conn.send(data)
+                    response = self.recv_response()
+                    if response is None:
+                        self.connection_closed()
+                        return
                     game = response["data"]
                     response = response["response"]
                     if response == "GAME START":
@@ -426,15 +538,17 @@ class ClientSocket:
                     self.parent.window._update_players(game)
                     print("Ready state is now {}".format(self.parent.ready))
             
-            ## Update Lobby
-            elif command == "GET UPDATE":
+            ## Update Lobby, sync it, or subscribe to have every update pushed
+            elif command == "GET UPDATE" or command == "SUBSCRIBE" or command == "SYNC":
                 data = {}
-                data["request"] = "GET UPDATE"
+                data["request"] = command
                 data["data"] = None
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 game = response["data"]
                 response = response["response"]
                 if response == "GAME START":
@@ -458,10 +572,12 @@ class ClientSocket:
                 data = {}
                 data["request"] = "TRY START"
                 data["data"] = ""
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 resp = response["response"]
                 game = response["data"]
                 if resp == "GAME START":
@@ -485,8 +601,8 @@ class ClientSocket:
                 data = {}
                 data["request"] = "EXIT"
                 data["data"] = ""
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
+                data = self.codec.encode(data)
+                self.conn.send(data)
                 time.sleep(1)
                 self.sock.shutdown(socket.SHUT_RDWR)
                 self.sock.close()
@@ -498,10 +614,14 @@ class ClientSocket:
                 pass
         
 ##################################   Game Loop    #################################
+        self.in_game = True
         time.sleep(1)
         self.parent.window._update_players(game)
         while True:
             command = self.parent.command_queue.get()
+            if command is None:
+                # The game ended, see apply_push.
+                return
 
 ####################### Do Action  #################
             if command == "DO ACTION":
@@ -511,13 +631,16 @@ class ClientSocket:
                 data["request"] = "DO ACTION"
                 actionData = self.parent.window.action
                 data["data"] = actionData
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 game = response["data"]
                 response = response["response"]
                 if response == "END GAME":
+                    self.game_over = True
                     msg = game
                     self.parent.signal.sig_with_strs.emit(msg)
                     time.sleep(1)
@@ -541,13 +664,16 @@ class ClientSocket:
                 data = {}
                 data["request"] = "GET UPDATE"
                 data["data"] = None
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 game = response["data"]
                 response = response["response"]
                 if response == "END GAME":
+                    self.game_over = True
                     msg = game
                     self.parent.signal.sig_with_strs.emit(msg)
                     time.sleep(1)
@@ -567,13 +693,16 @@ class ClientSocket:
                 data = {}
                 data["request"] = "END TURN"
                 data["data"] = None
-                data = json.dumps(data).encode()
-                self.sock.sendall(data)
-                response = self.sock.recv(4096)
-                response = json.loads(response.decode())
+                data = self.codec.encode(data)
+                self.conn.send(data)
+                response = self.recv_response()
+                if response is None:
+                    self.connection_closed()
+                    return
                 game = response["data"]
                 response = response["response"]
                 if response == "END GAME":
+                    self.game_over = True
                     msg = game
                     self.parent.signal.sig_with_strs.emit(msg)
                     time.sleep(1)
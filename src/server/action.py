@@ -1,5 +1,3 @@
-ACTION_LIST = {}
-
 class Action:
     def __init__(self, name, costs, modifier_list, status_list):
         self.name = name
@@ -17,3 +15,13 @@ class Status:
         self.modifier = modifier
         self.duration = duration
         self.duration_delta = duration_delta
+
+def compile_action(action):
+    # Flattens an action into a tuple of (ap cost, mana cost, effects, statuses), where
+    # the effects are (attribute, change) pairs with the changes to each attribute
+    # summed up, so resolving it is a single loop over plain tuples.
+    changes = {}
+    for modifier in action.modifier_list:
+        changes[modifier.attribute] = changes.get(modifier.attribute, 0) + modifier.change
+    effects = tuple((attribute, change) for attribute, change in changes.items() if change)
+    return (action.costs["ap"], action.costs["mana"], effects, tuple(action.status_list))
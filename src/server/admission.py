@@ -0,0 +1,61 @@
+""" This module holds the limits and timing counters for admitting new clients.
+    A client is admitted in stages: it waits for a free admission thread, sends
+    its handshake, may look at or create rooms, and finally joins a lobby. Each
+    stage has a deadline, so a slow or silent client is dropped instead of
+    holding on to an admission thread. """
+from threading import Lock
+
+# How many clients may be going through admission at once.
+ADMISSION_WORKERS = 64
+
+# How many connections the kernel may queue before they are accepted.
+ACCEPT_BACKLOG = 128
+
+# Seconds a client has to send its handshake once accepted.
+HANDSHAKE_TIMEOUT = 5.0
+
+# Seconds a client has after its handshake to send JOIN LOBBY, including any room requests.
+JOIN_TIMEOUT = 30.0
+
+class AdmissionStats:
+    """ Counts how many clients went through each admission stage, how long the
+        stage took them, and how many were dropped for missing its deadline. """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = Lock()
+
+    def _stage(self, stage):
+        counters = self.stages.get(stage)
+        if counters is None:
+            counters = {"count": 0, "total": 0.0, "max": 0.0, "timeouts": 0}
+            self.stages[stage] = counters
+        return counters
+
+    def record(self, stage, seconds):
+        """ Records that a client finished a stage in the given number of seconds. """
+        self.lock.acquire()
+        counters = self._stage(stage)
+        counters["count"] += 1
+        counters["total"] += seconds
+        if seconds > counters["max"]:
+            counters["max"] = seconds
+        self.lock.release()
+
+    def timed_out(self, stage):
+        """ Records that a client was dropped for missing a stage's deadline. """
+        self.lock.acquire()
+        self._stage(stage)["timeouts"] += 1
+        self.lock.release()
+
+    def report(self):
+        """ Returns the counters as a table for the server console. """
+        self.lock.acquire()
+        lines = ["{:<10} {:>8} {:>10} {:>10} {:>9}".format("STAGE", "COUNT", "MEAN MS", "MAX MS", "TIMEOUTS")]
+        for stage, counters in self.stages.items():
+            mean = counters["total"] / counters["count"] if counters["count"] else 0.0
+            lines.append("{:<10} {:>8} {:>10.2f} {:>10.2f} {:>9}".format(
+                stage, counters["count"], mean * 1000, counters["max"] * 1000, counters["timeouts"]
+            ))
+        self.lock.release()
+        return "\n".join(lines)
@@ -0,0 +1,207 @@
+""" This module runs the Tiny-PyRPG Server on a single asyncio event loop.
+    Every client connection is a coroutine instead of a thread, so idle
+    connections only cost a socket and a suspended coroutine. The lobby and
+    game requests are answered by the same handlers the threaded server uses. """
+import asyncio
+import socket
+import threading
+import time
+
+from admission import HANDSHAKE_TIMEOUT, JOIN_TIMEOUT
+from bot import BOTS
+from codec import CODECS, CodecError, JSON_CODEC
+from framing import FrameError, pack_frame, read_frame
+from logs import client_log, network_log
+from start_server import (
+    HOST, PORT, admit_player, answer_handshake, check_request, leave_room, process_room_request,
+    process_game_request, process_lobby_request, send_client_error
+)
+
+# Async mode is meant to hold many idle connections, so allow a deeper accept queue.
+BACKLOG = 1024
+
+# How many bytes may wait to be sent to a client before it is dropped for not reading them.
+OUTBOX_BYTES = 1024 * 1024
+
+class StreamConnection:
+    """ Adapts an asyncio stream pair to the connection calls made by the request handlers.
+        Writes are buffered by the transport and flushed with drain(), so sending never
+        blocks. A client that lets more than OUTBOX_BYTES pile up is dropped. """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = JSON_CODEC
+        self.deltas = False
+        self.lobby_version = None
+        self.game_version = None
+        self.send_lock = threading.RLock()
+
+    async def recv(self):
+        """ Reads one whole message, returning None once the client has gone away
+            or has sent something that is not a valid frame. """
+        try:
+            return await read_frame(self.reader)
+        except FrameError:
+            return None
+
+    async def recv_package(self):
+        """ Returns the next request, or None once the client has gone away. """
+        data = await self.recv()
+        if data is None:
+            return None
+        return check_request(self.codec.decode(data))
+
+    async def drain(self):
+        """ Waits until the buffered responses have been handed to the kernel. """
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def send(self, payload):
+        if self.writer.is_closing():
+            return
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() > OUTBOX_BYTES:
+            # The client has stopped reading. Aborting ends its coroutine's read, which cleans up.
+            network_log.warning("Dropping a client that has %s bytes waiting.", transport.get_write_buffer_size())
+            transport.abort()
+            return
+        self.writer.write(pack_frame(payload))
+
+    def send_package(self, spkg):
+        self.send(self.codec.encode(spkg))
+
+    def shutdown(self, how):
+        # Closing the transport flushes and shuts the socket down, so there is nothing to do here.
+        pass
+
+    def close(self):
+        self.writer.close()
+
+async def handle_client(reader, writer, rooms, stats):
+    """ This coroutine handles the connection with a single client instance,
+        from the handshake until the client leaves or the game ends. """
+    conn = StreamConnection(reader, writer)
+    addr = writer.get_extra_info("peername")
+    network_log.debug("Accepted connection from %s.", addr)
+
+    started = time.monotonic()
+    stage = "handshake"
+    try:
+        data = await asyncio.wait_for(conn.recv(), HANDSHAKE_TIMEOUT)
+        # If the incoming client does not validate as a Tiny-PyRPG Client, close the connection.
+        if data is None or not answer_handshake(conn, data):
+            conn.close()
+            return
+        handshaken = time.monotonic()
+        stats.record(stage, handshaken - started)
+        # The client may look at or create rooms, and then its request should be to join a lobby.
+        stage = "rooms"
+        deadline = handshaken + JOIN_TIMEOUT
+        while True:
+            cpkg = await asyncio.wait_for(conn.recv_package(), deadline - time.monotonic())
+            if cpkg is None or not process_room_request(conn, rooms, cpkg):
+                break
+            await conn.drain()
+    except asyncio.TimeoutError:
+        network_log.warning("Dropped %s, which did not finish the %s stage in time.", addr, stage)
+        stats.timed_out(stage)
+        cpkg = None
+    except (CodecError, ValueError):
+        network_log.warning("Dropped %s, which sent an invalid %s message.", addr, stage)
+        cpkg = None
+    if cpkg is None:
+        conn.close()
+        return
+    stats.record(stage, time.monotonic() - handshaken)
+    started = time.monotonic()
+    joined = admit_player(conn, addr, rooms, cpkg)
+    stats.record("join", time.monotonic() - started)
+    await conn.drain()
+    if joined is None:
+        return
+    name, game = joined
+    await serve_player(conn, name, game, rooms)
+
+async def recv_request(conn, name):
+    """ Returns the client's next request, or None once they have gone away.
+        A message that cannot be decoded, or that is not shaped like a request,
+        is answered with an error and skipped. """
+    while True:
+        try:
+            return await conn.recv_package()
+        except (CodecError, ValueError):
+            client_log.warning("%s: sent a message that is not a valid request.", name)
+            send_client_error(conn, "INVALID REQUEST")
+            await conn.drain()
+
+async def serve_player(conn, name, game, rooms):
+    """ This coroutine serves a client that has joined a lobby until they leave or the game ends. """
+    client_log.debug("Starting client coroutine for %s.", name)
+    try:
+        await serve_client(conn, name, game)
+    finally:
+        # However the client left, even on a request that broke a handler, clean up after them.
+        leave_room(conn, name, game, rooms)
+
+async def serve_client(conn, name, game):
+    """ Answers a client's lobby requests, and then its game requests, until they
+        leave or the game ends. """
+    # Process lobby requests until the game starts.
+    while True:
+        cpkg = await recv_request(conn, name)
+        if cpkg is None:
+            client_log.info("%s: disconnected from the lobby.", name)
+            return
+        result = process_lobby_request(conn, name, game, cpkg)
+        await conn.drain()
+        if result == -1:
+            return
+        if result == 1:
+            break
+
+    client_log.info("%s has entered the game sequence.", name)
+    # Process game requests until the game ends.
+    while True:
+        cpkg = await recv_request(conn, name)
+        if cpkg is None:
+            client_log.info("%s: disconnected from the game.", name)
+            return
+        result = process_game_request(conn, name, game, cpkg)
+        await conn.drain()
+        if result == -1:
+            return
+
+async def serve_adopted(sock, state, rooms):
+    """ This coroutine takes over a client that a sharded server's front listener
+        has already read a JOIN LOBBY request from, and serves it from there. """
+    reader, writer = await asyncio.open_connection(sock=sock)
+    conn = StreamConnection(reader, writer)
+    conn.codec = CODECS[state["codec"]]
+    if state["buffered"]:
+        reader.feed_data(state["buffered"])
+    joined = admit_player(conn, state["addr"], rooms, state["request"])
+    await conn.drain()
+    if joined is None:
+        return
+    name, game = joined
+    await serve_player(conn, name, game, rooms)
+
+async def serve(rooms, stats):
+    """ Listens for incoming connections and serves each one as a coroutine. """
+    network_log.info("Starting asyncio listener.")
+    # Bots think on their own thread, but their moves are played on the loop like everything else.
+    BOTS.dispatch = asyncio.get_running_loop().call_soon_threadsafe
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client(reader, writer, rooms, stats),
+        HOST, PORT, family=socket.AF_INET, backlog=BACKLOG
+    )
+    async with server:
+        await server.serve_forever()
+
+def start_async_listener(rooms, stats):
+    """ This method is designed to be used in a separate thread from the main program.
+        It runs the event loop that serves every client connection. """
+    asyncio.run(serve(rooms, stats))
@@ -0,0 +1,4 @@
+""" This module names the attributes every player has. """
+
+# The attributes every player has, in a fixed order.
+ATTRIBUTES = ("hp", "max_hp", "ap", "max_ap", "mana", "max_mana")
@@ -0,0 +1,85 @@
+""" Times resolving actions through the compiled programs in Content.programs against
+    interpreting the Action objects the way Game.try_action used to.
+    Run it from src/server: python benchmarks/bench_actions.py """
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from content import load_content
+from game import Game
+
+ROUNDS = 200000
+REPEATS = 7
+
+def interpret_action(game, source, target_number, action):
+    # Game._apply_action before actions were compiled, kept here for comparison.
+    actions = game.content.actions
+    if action not in actions or not 1 <= target_number <= len(game.players):
+        return -4
+    target = game.players[target_number - 1]
+    action = actions[action]
+    costs = action.costs
+    ap_cost = costs["ap"]
+    mana_cost = costs["mana"]
+    modifiers = action.modifier_list
+    statuses = action.status_list
+    if source.attributes["ap"] - ap_cost < 0:
+        return -1
+    if source.attributes["mana"] - mana_cost < 0:
+        return -2
+    for modifier in modifiers:
+        attribute = modifier.attribute
+        change = modifier.change
+        target.attributes[attribute] -= change
+    source.attributes["ap"] -= ap_cost
+    source.attributes["mana"] -= mana_cost
+    target.statuses.add_all(statuses)
+    if target.attributes["hp"] <= 0:
+        target.is_alive = False
+    return 0
+
+def make_game():
+    game = Game()
+    for name, profession in (("alice", "Cleric"), ("bobby", "Warrior")):
+        game.add_player(name)
+        game.set_player_profession(name, profession)
+    return game
+
+def refill(player):
+    # Keeps every action affordable and the target alive, so each round does the full work.
+    for attribute in ("hp", "ap", "mana"):
+        player.attributes[attribute] = 1000000
+
+def timer(resolve):
+    """ Returns a function that resolves ROUNDS actions with the given resolver. """
+    game = make_game()
+    source, target = game.players
+    actions = [name for name in game.content.actions]
+
+    def run():
+        refill(source)
+        refill(target)
+        target.statuses.clear()
+        for index in range(ROUNDS):
+            resolve(game, source, 2, actions[index % len(actions)])
+
+    return run
+
+def main():
+    load_content()
+    resolvers = (("interpreted", interpret_action), ("compiled", Game._apply_action))
+    runs = [(label, timer(resolve)) for label, resolve in resolvers]
+    # Alternate between the two so they see the same machine conditions, and keep the best of each.
+    best = {}
+    for _ in range(REPEATS):
+        for label, run in runs:
+            elapsed = timeit.timeit(run, number=1)
+            best[label] = min(best.get(label, elapsed), elapsed)
+    for label, _ in runs:
+        print("{:<12} {:8.1f} ns per action".format(label, best[label] / ROUNDS * 1e9))
+    print("speedup      {:8.2f}x".format(best["interpreted"] / best["compiled"]))
+
+if __name__ == "__main__":
+    main()
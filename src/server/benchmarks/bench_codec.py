@@ -0,0 +1,59 @@
+""" Times encoding a game update with each codec, both as a plain package and as
+    a SplicedPackage with the shared game spliced in, the way game_package builds
+    it. For JSON it also times walking the plain package by hand, which is what
+    every package cost before plain ones went straight to json.dumps.
+    Run it from src/server: python benchmarks/bench_codec.py """
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from codec import BINARY_CODEC, JSON_CODEC, Spliced, SplicedPackage
+from content import load_content
+from game import Game
+
+ROUNDS = 20000
+REPEATS = 7
+
+def make_game():
+    game = Game()
+    for name, profession in (("alice", "Cleric"), ("bobby", "Warrior"), ("carol", "Wizard"), ("dylan", "Rogue")):
+        game.add_player(name)
+        game.set_player_profession(name, profession)
+        game.set_player_ready(name, True)
+    game.try_start()
+    return game
+
+def plain_package(game):
+    game_dict = dict(game.get_game_snapshot()[1])
+    game_dict["player-number"] = 1
+    return {"response": "GAME DATA", "data": {"actions": game.get_player_actions("alice"), "game": game_dict}}
+
+def spliced_package(game, codec):
+    game_dict = Spliced(codec.encode_items(game.get_game_snapshot()[1]))
+    game_dict["player-number"] = 1
+    return SplicedPackage({"response": "GAME DATA", "data": {"actions": game.get_player_actions("alice"), "game": game_dict}})
+
+def best_of(function):
+    return min(timeit.repeat(function, number=ROUNDS, repeat=REPEATS)) / ROUNDS * 1e6
+
+def main():
+    load_content()
+    game = make_game()
+    plain = plain_package(game)
+    runs = []
+    for codec in (JSON_CODEC, BINARY_CODEC):
+        spliced = spliced_package(game, codec)
+        # Both kinds of package must come out the same once decoded.
+        assert codec.decode(codec.encode(plain)) == codec.decode(codec.encode(spliced))
+        runs.append((codec.name, "plain", lambda codec=codec: codec.encode(plain)))
+        runs.append((codec.name, "spliced", lambda codec=codec, spliced=spliced: codec.encode(spliced)))
+        if codec is JSON_CODEC:
+            runs.append((codec.name, "walked", lambda: JSON_CODEC._encode_value(plain)))
+    print("{:<8}{:<10}{:>12}".format("codec", "package", "us each"))
+    for name, package, run in runs:
+        print("{:<8}{:<10}{:>12.1f}".format(name, package, best_of(run)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+""" Times loading a large content set, about 10000 asset files, and measures the
+    memory it takes. Each scenario runs in a fresh process, so that the times and
+    the resident memory of one do not include the others:
+        cold serial    no bundle, every file parsed in this process
+        cold parallel  no bundle, the files parsed by a pool of worker processes
+        warm           an up to date bundle
+        reload         one file changed since the bundle was built
+        materialized   a warm load, then every lazily kept action looked up
+        pack           the same assets packed into a content pack by pack.py
+        pack decoded   the pack loaded, then every action in it looked up
+    Run it from src/server: python benchmarks/bench_content.py """
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import initializer
+import pack
+from content import Content
+
+PROFESSIONS = 1000
+ACTIONS = 9000
+ACTIONS_PER_PROFESSION = 4
+ATTRIBUTES = ("hp", "ap", "mana")
+
+SCENARIOS = ("cold serial", "cold parallel", "warm", "reload", "materialized", "pack", "pack decoded")
+
+def write_asset(path, asset):
+    with open(path, "w") as asset_file:
+        json.dump(asset, asset_file, indent=4)
+
+def random_modifier(rng):
+    return {"attribute": rng.choice(ATTRIBUTES), "change": rng.randint(-10, 10)}
+
+def generate_assets(root, professions, actions, seed=0):
+    """ Writes the given numbers of random professions and actions under root/assets.
+        Each profession uses a few of the first actions, so about half of them are
+        used by no profession. """
+    rng = random.Random(seed)
+    os.makedirs(root + initializer.PROFESSION_BASE_PATH)
+    os.makedirs(root + initializer.ACTION_BASE_PATH)
+    for number in range(actions):
+        write_asset(root + initializer.ACTION_BASE_PATH + "action_{}.json".format(number), {
+            "TPR-Type": "action",
+            "name": "action_{}".format(number),
+            "costs": {"ap": rng.randint(0, 5), "mana": rng.randint(0, 20)},
+            "modifiers": [random_modifier(rng) for _ in range(rng.randint(0, 3))],
+            "statuses": [
+                {"modifier": random_modifier(rng), "duration": rng.randint(1, 5), "duration_delta": -1}
+                for _ in range(rng.randint(0, 2))
+            ]
+        })
+    for number in range(professions):
+        write_asset(root + initializer.PROFESSION_BASE_PATH + "profession_{}.json".format(number), {
+            "TPR-Type": "profession",
+            "name": "Profession {}".format(number),
+            "description": "Generated for bench_content.py.",
+            "base_attributes": {"base_hp": 100, "base_ap": 5, "base_mana": 40},
+            "actions": [
+                "action_{}".format(rng.randrange(actions // 2)) for _ in range(ACTIONS_PER_PROFESSION)
+            ]
+        })
+
+def resident_memory():
+    """ Returns the current and peak resident memory of this process, in MiB. """
+    sizes = {}
+    with open("/proc/self/status") as status_file:
+        for line in status_file:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, size = line.split(":")
+                sizes[name] = int(size.split()[0]) / 1024
+    return sizes.get("VmRSS", 0.0), sizes.get("VmHWM", 0.0)
+
+def run_scenario(scenario, root):
+    """ Runs one scenario in this process and returns what it measured. """
+    bundle_path = root + initializer.BUNDLE_PATH
+    if scenario.startswith("cold") and os.path.exists(bundle_path):
+        os.remove(bundle_path)
+    previous = None
+    if scenario == "reload":
+        previous = initializer.read_bundle(bundle_path)
+        path = root + initializer.ACTION_BASE_PATH + "action_0.json"
+        with open(path) as asset_file:
+            asset = json.load(asset_file)
+        asset["costs"]["ap"] = (asset["costs"]["ap"] + 1) % 6
+        write_asset(path, asset)
+    started = time.perf_counter()
+    processes = 1 if scenario == "cold serial" else None
+    if scenario.startswith("pack"):
+        bundle = initializer.load_pack(root)
+    else:
+        bundle = initializer.load_bundle(root, previous, processes)
+    content = Content(
+        1, bundle["professions"], bundle["actions"], bundle["programs"],
+        bundle["lazy_actions"], bundle.get("materialize")
+    )
+    seconds = time.perf_counter() - started
+    if scenario in ("materialized", "pack decoded"):
+        started = time.perf_counter()
+        for name in list(bundle["lazy_actions"]):
+            content.programs[name]
+        seconds = time.perf_counter() - started
+    rss, peak = resident_memory()
+    return {
+        "seconds": seconds,
+        "rss": rss,
+        "peak": peak,
+        "built": len(bundle["actions"]),
+        "lazy": len(bundle["lazy_actions"])
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Time loading a large Tiny-PyRPG content set.")
+    parser.add_argument("--professions", type=int, default=PROFESSIONS)
+    parser.add_argument("--actions", type=int, default=ACTIONS)
+    parser.add_argument("--scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.scenario is not None:
+        print(json.dumps(run_scenario(args.scenario, args.root)))
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        generate_assets(root, args.professions, args.actions)
+        print("{} professions and {} actions, {} cores".format(args.professions, args.actions, os.cpu_count()))
+        print("{:<15}{:>10}{:>10}{:>10}{:>8}{:>8}".format("scenario", "seconds", "rss MiB", "peak MiB", "built", "lazy"))
+        for scenario in SCENARIOS:
+            if scenario == "pack":
+                pack.pack_assets(root)
+            output = subprocess.run(
+                [sys.executable, __file__, "--scenario", scenario, "--root", root],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            print("{:<15}{:>10.3f}{:>10.1f}{:>10.1f}{:>8}{:>8}".format(
+                scenario, result["seconds"], result["rss"], result["peak"], result["built"], result["lazy"]
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+""" This module lets the server fill empty lobby slots with bots.
+    A bot is a Player whose turns the server plays. Whenever a game changes
+    and it may have become a bot's turn, the game is queued for a pool of bot
+    threads. A bot thread snapshots the game and runs a Monte Carlo tree search
+    over the bot's possible turns on a scratch game, restored from the
+    snapshot for every rollout, until the turn's time budget runs out. Then it
+    plays the best turn it found as one batch. The search never runs
+    on a thread that answers requests, so bots add no latency for humans. """
+import random
+import threading
+import time
+from math import log, sqrt
+from queue import Queue
+
+import simulation
+from game import Game
+from logs import game_log
+from player import Player
+
+# How long a bot may think about each turn, in seconds, counted from when its game is queued.
+TURN_BUDGET = 1.0
+
+# How many games the bots think about at once. The searches share the interpreter,
+# so this does not add CPU, but a room no longer waits for every room queued
+# before it to use up its whole budget.
+BOT_WORKERS = 4
+
+# How many turns a rollout plays before the match is scored as it stands.
+ROLLOUT_TURNS = 20
+
+# How strongly the search favours trying moves it has rarely tried.
+EXPLORATION = 1.4
+
+class Bot(Player):
+    is_bot = True
+
+def legal_moves(game, pnum):
+    """ Returns every move player pnum can make: None to end the turn, and a
+        (target number, action) pair for each affordable action, aimed at every
+        living opponent if it does harm and at the player themselves otherwise. """
+    moves = [None]
+    harm = game.content.harm
+    opponents = simulation.living_opponents(game, pnum)
+    for action in simulation.affordable_actions(game, pnum):
+        if harm[action] > 0:
+            moves.extend((target, action) for target in opponents)
+        else:
+            moves.append((pnum + 1, action))
+    return moves
+
+def score(game, pnum):
+    """ Scores how well the match is going for player pnum, from 0 when they are
+        dead to 1 when they are the last one standing, by their share of the hp left. """
+    player = game.players[pnum]
+    if not player.is_alive:
+        return 0.0
+    total = sum(other.attributes["hp"] for other in game.players if other.is_alive)
+    return player.attributes["hp"] / total if total else 0.0
+
+class Node:
+    """ A point in the bot's turn, reached by making the moves on the path to it. """
+    __slots__ = ("move", "parent", "children", "untried", "visits", "total")
+
+    def __init__(self, move, parent, untried):
+        self.move = move
+        self.parent = parent
+        self.children = []
+        self.untried = untried
+        self.visits = 0
+        self.total = 0.0
+
+    def best_child(self):
+        """ Returns the child with the highest upper confidence bound. """
+        scale = EXPLORATION * sqrt(log(self.visits))
+        return max(
+            self.children,
+            key=lambda child: child.total / child.visits + scale / sqrt(child.visits)
+        )
+
+def rollout(game, pnum, ended, rng):
+    """ Plays the match on from the end of the search's moves, with every player,
+        including the bot finishing its turn if it has not ended it, using the
+        mixed simulation policy. Returns the score for player pnum. """
+    names = [player.name for player in game.players]
+    policy = simulation.mixed_policy
+    if not ended:
+        simulation.play_turn(game, pnum, names[pnum], policy, rng)
+    last_turn = game.turn_number + ROLLOUT_TURNS
+    while game.in_game and game.cycle_turn() == 0 and game.turn_number < last_turn:
+        active = game.active_player
+        simulation.play_turn(game, active, names[active], policy, rng)
+    return score(game, pnum)
+
+def search(state, pnum, deadline, rng):
+    """ Searches player pnum's turn from a GameState until the deadline from
+        time.monotonic() passes. Returns the list of moves to make before
+        ending the turn, and how many rollouts were played. """
+    game = Game(content=state.content, track_changes=False)
+    game.restore(state)
+    tree = Node(None, None, legal_moves(game, pnum))
+    name = state.players[pnum].name
+    rollouts = 0
+    # There is always one rollout, so a turn queued past its deadline still gets a plan.
+    while not rollouts or time.monotonic() < deadline:
+        game.restore(state)
+        node = tree
+        # Follow the most promising moves down to a point that still has untried ones.
+        while not node.untried and node.children:
+            node = node.best_child()
+            if node.move is not None:
+                game.try_action(name, *node.move)
+        # Try one of them, unless the turn has already been ended on this path.
+        if node.untried:
+            move = node.untried.pop(rng.randrange(len(node.untried)))
+            untried = []
+            if move is not None:
+                game.try_action(name, *move)
+                untried = legal_moves(game, pnum)
+            child = Node(move, node, untried)
+            node.children.append(child)
+            node = child
+        result = rollout(game, pnum, node.move is None and node is not tree, rng)
+        rollouts += 1
+        while node is not None:
+            node.visits += 1
+            node.total += result
+            node = node.parent
+        # Let any request thread waiting on the interpreter lock have it.
+        time.sleep(0)
+
+    # The turn is the most visited path through the tree.
+    moves = []
+    node = tree
+    while node.children:
+        node = max(node.children, key=lambda child: child.visits)
+        if node.move is None:
+            break
+        moves.append(node.move)
+    return moves, rollouts
+
+class BotRunner:
+    """ Plays the bots' turns on a small pool of threads. Games are queued whenever
+        they change, along with the deadline for their turn, and each game is only
+        thought about by one thread at a time. """
+
+    def __init__(self, budget=TURN_BUDGET, workers=BOT_WORKERS):
+        self.budget = budget
+        self.workers = workers
+        self.queue = Queue()
+        # The deadline of every game in the queue, by game.
+        self.queued = {}
+        # The games a thread is thinking about, and the deadline to look at each
+        # again with if it changed in the meantime, or None.
+        self.thinking = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.rng = random.Random()
+        # Runs the function that plays a planned turn. The asyncio server swaps in
+        # its loop's call_soon_threadsafe, so that the pushes to clients are sent
+        # from the event loop's thread.
+        self.dispatch = lambda function, *args: function(*args)
+
+    def notify(self, game):
+        """ Queues the game to be looked at. This is a game subscriber callback,
+            so it is called from whichever thread changed the game and must be quick. """
+        self.lock.acquire()
+        # The threads are started on first use, so a sharded server starts them in the
+        # worker process that hosts the game.
+        if not self.threads:
+            for number in range(self.workers):
+                thread = threading.Thread(target=self.run, name="bots-{}".format(number + 1))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self._enqueue(game, time.monotonic() + self.budget)
+        self.lock.release()
+
+    def _enqueue(self, game, deadline):
+        # Must be called with the lock held. A game already waiting keeps its earlier
+        # deadline, and one being thought about is looked at again once that is done.
+        if game in self.queued:
+            return
+        if game in self.thinking:
+            if self.thinking[game] is None:
+                self.thinking[game] = deadline
+            return
+        self.queued[game] = deadline
+        self.queue.put(game)
+
+    def run(self):
+        while True:
+            game = self.queue.get()
+            self.lock.acquire()
+            deadline = self.queued.pop(game)
+            self.thinking[game] = None
+            self.lock.release()
+            try:
+                self.think(game, deadline)
+            except Exception:
+                game_log.exception("A bot failed to play its turn in room %s.", game.room_id)
+            self.lock.acquire()
+            again = self.thinking.pop(game)
+            if again is not None:
+                self._enqueue(game, again)
+            self.lock.release()
+
+    def think(self, game, deadline=None):
+        """ Plans the turn of the bot whose turn it is, if it is a bot's turn, and
+            hands it to dispatch to be played. The search stops at the deadline from
+            time.monotonic(), or one budget from now. Bots stop once no human is left. """
+        if not game.has_humans():
+            return
+        state = game.snapshot()
+        pnum = state.active_player
+        if not state.in_game or not state.players[pnum].player_class.is_bot:
+            return
+        name = state.players[pnum].name
+        if deadline is None:
+            deadline = time.monotonic() + self.budget
+        moves, rollouts = search(state, pnum, deadline, self.rng)
+        game_log.debug("%s planned %s actions from %s rollouts.", name, len(moves), rollouts)
+        self.dispatch(self.play, game, name, moves, state.version)
+
+    def play(self, game, name, moves, version):
+        """ Plays a planned turn and ends it, unless the game has changed since it was planned. """
+        results = game.try_batch(name, moves, True, version)
+        if results[0] == -3:
+            # Plan again if it is still the bot's turn.
+            self.notify(game)
+
+# The runner for every bot in this process.
+BOTS = BotRunner()
+
+def add_bot(game, profession=None, rng=random):
+    """ Adds a ready bot of the given profession, or of a random one, to the
+        game's lobby. Returns the bot's name, or None if the lobby is full. """
+    playable = game.content.playable_professions()
+    if profession not in playable:
+        profession = rng.choice(playable)
+    number = 1
+    while True:
+        name = "Bot {}".format(number)
+        result = game.add_player(name, Bot)
+        if result >= 0:
+            break
+        if result != -2:
+            return None
+        number += 1
+    game.set_player_profession(name, profession)
+    game.set_player_ready(name, True)
+    game.subscribe(name, BOTS.notify)
+    return name
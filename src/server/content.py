@@ -0,0 +1,204 @@
+""" This module holds the professions and actions that games are played with.
+    The assets are loaded once per process into an immutable, numbered Content.
+    Every Game keeps a reference to the Content it was created with, so
+    creating a room does no I/O. When new content is published, only games
+    created from then on use it. Games already running keep the version
+    they started with, so the assets can be reloaded while the server runs. """
+import threading
+import time
+from os import getcwd
+from os.path import exists
+from types import MappingProxyType
+
+import initializer
+import pack
+from initializer import AssetError
+from logs import content_log
+
+class LazyCatalog(dict):
+    """ A dict that also answers for entries it has not built yet. Looking one of
+        those up has materialize build it, which adds it here and to any related
+        catalogs. Entries already built are looked up as fast as in a plain dict. """
+
+    def __init__(self, entries, pending, materialize):
+        dict.__init__(self, entries)
+        self.pending = pending
+        self.materialize = materialize
+
+    def __missing__(self, name):
+        if name not in self.pending:
+            raise KeyError(name)
+        self.materialize(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.pending
+
+    def __iter__(self):
+        yield from list(dict.keys(self))
+        yield from [name for name in list(self.pending) if not dict.__contains__(self, name)]
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.pending)
+
+class Content:
+    """ One version of the content. The mappings are read-only, and neither they
+        nor the professions, actions and compiled programs in them are ever changed.
+        Actions in lazy_actions are only built the first time they are looked up, by
+        passing their entry to materialize, and are then kept like the rest. By default
+        the entries are compact JSON, for initializer.materialize_action. """
+
+    def __init__(self, version, professions, actions, programs, lazy_actions=None, materialize=None):
+        self.version = version
+        self.professions = MappingProxyType(dict(professions))
+        self._pending = dict(lazy_actions or {})
+        self._build = materialize or initializer.materialize_action
+        self._lock = threading.Lock()
+        self._actions = LazyCatalog(actions, self._pending, self._materialize)
+        # Each action compiled by action.compile_action, by name.
+        self._programs = LazyCatalog(programs, self._pending, self._materialize)
+        # How much hp each action takes from its target, negative if it heals.
+        harm = {}
+        for name, program in programs.items():
+            harm[name] = self.harm_of(program)
+        self._harm = LazyCatalog(harm, self._pending, self._materialize)
+        self.actions = MappingProxyType(self._actions)
+        self.programs = MappingProxyType(self._programs)
+        self.harm = MappingProxyType(self._harm)
+        # The rankings made by ranked_actions, by the id of the action list. Each entry
+        # keeps the list it was made from, so a reused id is never mistaken for it.
+        self._rankings = {}
+
+    @staticmethod
+    def harm_of(program):
+        return dict(program[2]).get("hp", 0)
+
+    def ranked_actions(self, actions):
+        """ Returns (harm, ap cost, mana cost, action) for each of the actions, the most
+            harmful first and ties in their original order. Players of a profession share
+            its action list, so each list is only ranked once for each version. """
+        entry = self._rankings.get(id(actions))
+        if entry is None or entry[0] is not actions:
+            ranking = []
+            for action in actions:
+                ap_cost, mana_cost, _, _ = self.programs[action]
+                ranking.append((self.harm[action], ap_cost, mana_cost, action))
+            ranking.sort(key=lambda item: item[0], reverse=True)
+            entry = self._rankings[id(actions)] = (actions, ranking)
+        return entry[1]
+
+    def _materialize(self, name):
+        self._lock.acquire()
+        entry = self._pending.get(name)
+        if entry is not None:
+            action, program = self._build(entry)
+            dict.__setitem__(self._actions, name, action)
+            dict.__setitem__(self._programs, name, program)
+            dict.__setitem__(self._harm, name, self.harm_of(program))
+            del self._pending[name]
+        self._lock.release()
+
+    def playable_professions(self):
+        """ Returns every profession a player can pick, by name. """
+        return sorted(name for name in self.professions if name != "None")
+
+_current = None
+_lock = threading.Lock()
+# Only one thread at a time loads the assets, and it keeps the last bundle here.
+_load_lock = threading.Lock()
+_bundle = None
+
+# How often the asset watcher looks for changed files, in seconds.
+WATCH_INTERVAL = 1.0
+
+def current_content():
+    """ Returns the latest content, loading it from the assets the first time. """
+    if _current is None:
+        _load_lock.acquire()
+        try:
+            if _current is None:
+                _load(force=True)
+        finally:
+            _load_lock.release()
+    return _current
+
+def load_content():
+    """ Loads the content pack if there is one, or else the assets through the
+        bundle when it is up to date, and publishes them as the latest content.
+        Returns the new Content. """
+    _load_lock.acquire()
+    try:
+        return _load(force=True)
+    finally:
+        _load_lock.release()
+
+def reload_content():
+    """ Publishes the assets as a new version if any file has changed since they
+        were last loaded, parsing only the changed files. Returns the new Content,
+        or None if nothing changed. Invalid assets raise AssetError and the
+        current version stays in place. """
+    _load_lock.acquire()
+    try:
+        return _load(force=False)
+    finally:
+        _load_lock.release()
+
+def _load(force):
+    # Must be called with _load_lock held.
+    global _bundle
+    previous = _bundle
+    bundle = initializer.load_assets(getcwd(), previous)
+    _bundle = bundle
+    if not force and previous is not None:
+        # Files that were only touched give a new bundle with the same contents.
+        if [(entry[0], entry[3]) for entry in bundle["manifest"]] == \
+                [(entry[0], entry[3]) for entry in previous["manifest"]]:
+            return None
+    return publish(
+        bundle["professions"], bundle["actions"], bundle["programs"],
+        bundle["lazy_actions"], bundle.get("materialize")
+    )
+
+def publish(professions, actions, programs, lazy_actions=None, materialize=None):
+    """ Makes the given content the latest version, for games created from now on. """
+    global _current
+    _lock.acquire()
+    version = _current.version + 1 if _current is not None else 1
+    content = Content(version, professions, actions, programs, lazy_actions, materialize)
+    _current = content
+    _lock.release()
+    return content
+
+def watch_assets(interval=WATCH_INTERVAL):
+    """ Starts a thread that looks for changed asset files every interval seconds and
+        publishes them as a new version. Running games keep the version they started
+        with, and only rooms created afterwards get the new one. The requests never
+        wait on a reload, as they only ever read the latest published version.
+        While there is a content pack, it is the pack that is watched. """
+    if exists(getcwd() + pack.PACK_PATH):
+        content_log.warning(
+            "Watching %s, so edits to the JSON assets are ignored until pack.py is run again.", pack.PACK_PATH[1:]
+        )
+    thread = threading.Thread(target=_watch, args=(interval,), name="asset-watcher")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _watch(interval):
+    last_error = None
+    while True:
+        time.sleep(interval)
+        try:
+            content = reload_content()
+        except (AssetError, OSError) as error:
+            # A file caught halfway through being saved fails too, so only say so once.
+            if str(error) != last_error:
+                content_log.warning("Not reloading the content: %s", error)
+                last_error = str(error)
+            continue
+        last_error = None
+        if content is not None:
+            content_log.info("Published content version %s.", content.version)
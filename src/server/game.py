@@ -1,82 +1,252 @@
-from threading import Lock
+from collections import namedtuple
+
 from player import Player, get_empty_lobby_dict, get_empty_game_dict
-from action import ACTION_LIST
-from profession import PROFESSION_LIST
+from content import current_content
+from logs import game_log
+from responses import ResponseCache
+from rwlock import RWLock
 
-import initializer
+# An immutable record of a game, as taken by Game.snapshot, with a PlayerState for each player.
+GameState = namedtuple(
+    "GameState", ("version", "content", "in_lobby", "in_game", "turn_number", "active_player", "players")
+)
 
 class Game:
-    def __init__(self):
-        initializer.init()
+    def __init__(self, content=None, track_changes=True):
+        # The game plays with the same content from start to finish, the latest by default.
+        self.content = content if content is not None else current_content()
+        # Simulations have no clients to send deltas to, so they can skip tracking changes.
+        self.track_changes = track_changes
+        self.room_id = None
         self.in_lobby = True
         self.in_game = False
         self.turn_number = 0
         self.active_player = 0
         self.players = []
-        self.lock = Lock()
+        # Maps each player's name to their index in self.players.
+        self.slots = {}
+        self.subscribers = {}
+        # Every change bumps the version. For each slot ("p1" to "p6", and "game" for
+        # the turn fields) we keep the last value of every field and the version it changed at.
+        self.version = 0
+        self.resync_version = 0
+        self.published = {}
+        self.field_versions = {}
+        self.response_cache = ResponseCache()
+        # Readers share the lock and only the methods that change the game take it alone.
+        self.lock = RWLock()
+
+    def _record_changes(self):
+        # Must be called with the lock held, after the state has changed.
+        self.version += 1
+        if not self.track_changes:
+            # Without the field versions, anyone asking for changes needs a full snapshot.
+            # Games that skip tracking are never served, so there are no responses to drop.
+            self.resync_version = self.version
+            return
+        self.response_cache.invalidate(self.version)
+        current = {}
+        current["game"] = {
+            "turn-number": self.turn_number,
+            "active-player": self.active_player + 1
+        }
+        for pnum, player in enumerate(self.players):
+            current["p{}".format(pnum + 1)] = player.state_dict()
+        for key, fields in current.items():
+            published = self.published.setdefault(key, {})
+            versions = self.field_versions.setdefault(key, {})
+            for field, value in fields.items():
+                if field not in published or published[field] != value:
+                    published[field] = value
+                    versions[field] = self.version
+        for key in list(self.published.keys()):
+            if key not in current:
+                del self.published[key]
+                del self.field_versions[key]
+
+    def snapshot(self):
+        # Returns a GameState, which shares nothing that changes during play with the
+        # game, so it can be kept, handed to another thread, and restored any number of times.
+        self.lock.acquire_read()
+        state = GameState(
+            self.version, self.content, self.in_lobby, self.in_game,
+            self.turn_number, self.active_player,
+            tuple([player.snapshot() for player in self.players])
+        )
+        self.lock.release_read()
+        return state
 
-    def add_player(self, name):
+    def restore(self, state):
+        # Rolls the game back, or forward, to a GameState. The players are reused when the
+        # state has the same ones, so looking ahead on a scratch game restored over and
+        # over again creates next to nothing. The version still moves forward.
+        _, content, in_lobby, in_game, turn_number, active_player, player_states = state
         self.lock.acquire()
+        players = self.players
+        if [player.name for player in players] != [player_state[1] for player_state in player_states]:
+            players = [player_state.player_class(player_state.name) for player_state in player_states]
+            self.players = players
+            self.slots = {player.name: pnum for pnum, player in enumerate(players)}
+        for player, player_state in zip(players, player_states):
+            player.restore(player_state)
+        self.content = content
+        self.in_lobby = in_lobby
+        self.in_game = in_game
+        self.turn_number = turn_number
+        self.active_player = active_player
+        self._record_changes()
+        self.resync_version = self.version
+        self.lock.release()
+        self.publish()
+
+    def clone(self):
+        # Returns a scratch copy of the game to look ahead on, with no subscribers
+        # or change tracking.
+        game = Game(content=self.content, track_changes=False)
+        game.restore(self.snapshot())
+        return game
+
+    def get_changes(self, since):
+        # Returns the current version and the fields that changed after the given one,
+        # by slot. The changes are None when the caller needs a full snapshot instead.
+        self.lock.acquire_read()
+        version = self.version
+        if since is None or since < self.resync_version or since > version:
+            self.lock.release_read()
+            return version, None
+        changes = {}
+        for key, versions in self.field_versions.items():
+            published = self.published[key]
+            changed = {}
+            for field, changed_at in versions.items():
+                if changed_at > since:
+                    changed[field] = published[field]
+            if changed:
+                changes[key] = changed
+        self.lock.release_read()
+        return version, changes
+
+    def subscribe(self, name, callback):
+        # The callback is called with the game whenever its state changes.
+        self.lock.acquire()
+        self.subscribers[name] = callback
+        self.lock.release()
+
+    def unsubscribe(self, name):
+        self.lock.acquire()
+        self.subscribers.pop(name, None)
+        self.lock.release()
+
+    def publish(self, exclude=None):
+        # Callbacks run outside of the lock so they are free to read the game.
+        # The player who caused the change already gets a response, so they can be excluded.
+        if not self.subscribers:
+            return
+        self.lock.acquire_read()
+        callbacks = [
+            callback for name, callback in self.subscribers.items() if name != exclude
+        ]
+        self.lock.release_read()
+        for callback in callbacks:
+            callback(self)
+
+    def add_player(self, name, player_class=Player):
+        # Bots join through here too, as a subclass of Player, see bot.py. Returns the
+        # player's number, or -1 if the lobby is full, -2 if the name is taken and -3
+        # if the game has already left its lobby.
+        self.lock.acquire()
+        if not self.in_lobby:
+            self.lock.release()
+            return -3
         if len(self.players) == 6:
+            self.lock.release()
             return -1
-        for player in self.players:
-            if player.name == name:
-                return -2
-        player = Player(name)
+        if name in self.slots:
+            self.lock.release()
+            return -2
+        player = player_class(name)
+        pnum = len(self.players)
         self.players.append(player)
-        pnum = self.players.index(player)
+        self.slots[name] = pnum
+        self._record_changes()
         self.lock.release()
+        self.publish(name)
         return pnum
 
     def remove_player(self, name):
         self.lock.acquire()
-        for player in self.players:
-            if player.name == name:
-                self.players.remove(player)
-                self.lock.release()
-                return True
+        pnum = self.slots.pop(name, None)
+        if pnum is None:
+            self.lock.release()
+            return False
+        del self.players[pnum]
+        self.subscribers.pop(name, None)
+        # Everyone after this player moves up a slot, so old deltas no longer line up.
+        for index in range(pnum, len(self.players)):
+            self.slots[self.players[index].name] = index
+        self._record_changes()
+        self.resync_version = self.version
+        self.lock.release()
+        self.publish(name)
+        return True
+
+    def disconnect_player(self, name):
+        # Marks a player whose client has gone. They keep their slot, but no longer
+        # count as a human keeping the room open.
+        self.lock.acquire()
+        pnum = self.slots.get(name)
+        if pnum is not None:
+            self.players[pnum].connected = False
         self.lock.release()
-        return False
+        return pnum is not None
+
+    def has_humans(self):
+        # Whether any player who is not a bot is still connected and in the running.
+        self.lock.acquire_read()
+        humans = any(not player.is_bot and player.is_alive and player.connected for player in self.players)
+        self.lock.release_read()
+        return humans
 
     def get_player_number(self, name):
-        for player in self.players:
-            if player.name == name:
-                pnum = self.players.index(player)
-                return pnum
-        return -1
+        return self.slots.get(name, -1)
 
     def get_player_status(self, name):
-        self.lock.acquire()
+        self.lock.acquire_read()
         pnum = self.get_player_number(name)
         if not self.players[pnum].is_alive:
-            self.lock.release()
+            self.lock.release_read()
             return -1
         if pnum != self.active_player:
-            self.lock.release()
+            self.lock.release_read()
             return -2
-        self.lock.release()
+        self.lock.release_read()
         return 0
 
     def get_player_actions(self, name):
-        self.lock.acquire()
+        self.lock.acquire_read()
         pnum = self.get_player_number(name)
         actions = self.players[pnum].actions
-        self.lock.release()
+        self.lock.release_read()
         return actions
 
     def set_player_profession(self, name, profession):
         self.lock.acquire()
         pnum = self.get_player_number(name)
-        self.players[pnum].set_profession(profession)
+        self.players[pnum].set_profession(self.content.professions[profession])
+        self._record_changes()
         self.lock.release()
+        self.publish(name)
 
     def set_player_ready(self, name, ready):
         self.lock.acquire()
         pnum = self.get_player_number(name)
         self.players[pnum].set_ready(ready)
+        self._record_changes()
         self.lock.release()
+        self.publish(name)
 
-    def try_start(self):
+    def try_start(self, name=None):
+        # name is the player asking to start, who gets a response rather than a push.
         self.lock.acquire()
         for player in self.players:
             if not player.ready:
@@ -86,72 +256,129 @@ class Game:
         self.in_game = True
         self.turn_number = 1
         self.active_player = 0
+        self._record_changes()
         self.lock.release()
+        self.publish(name)
         return True
 
     def try_action(self, source_name, target_number, action):
         self.lock.acquire()
         source = self.players[self.get_player_number(source_name)]
-        target = self.players[target_number - 1]
-
-        action = ACTION_LIST[action]
-        costs = action.costs
-        ap_cost = costs["ap"]
-        mana_cost = costs["mana"]
-        modifiers = action.modifier_list
-        statuses = action.status_list
+        result = self._apply_action(source, target_number, action)
+        if result != 0:
+            self.lock.release()
+            return result
+        self._record_changes()
+        self.lock.release()
+        self.publish(source_name)
+        return 0
 
-        if source.attributes["ap"] - ap_cost < 0:
+    def try_batch(self, source_name, actions, end_turn, version=None):
+        # Applies a list of (target number, action) pairs and then, if asked, ends the turn,
+        # all under one acquisition of the lock so nothing else can happen in between.
+        # Returns a result for each action, and for the end of the turn if there was one.
+        # Every result is -3 if it was not the source's turn, or if a version was given
+        # and the game has changed since then.
+        self.lock.acquire()
+        pnum = self.get_player_number(source_name)
+        count = len(actions) + (1 if end_turn else 0)
+        stale = version is not None and version != self.version
+        if pnum != self.active_player or not self.in_game or stale:
             self.lock.release()
+            return [-3] * count
+        source = self.players[pnum]
+        results = []
+        for target_number, action in actions:
+            results.append(self._apply_action(source, target_number, action))
+        if end_turn:
+            results.append(self._cycle_turn())
+        if 0 in results or end_turn:
+            self._record_changes()
+        self.lock.release()
+        if 0 in results or end_turn:
+            self.publish(source_name)
+        return results
+
+    def _apply_action(self, source, target_number, action):
+        # Must be called with the lock held. Returns 0 if the action was performed,
+        # -1 or -2 if the source lacks the AP or mana for it, or -4 if it makes no sense.
+        players = self.players
+        if not 0 < target_number <= len(players):
+            return -4
+        try:
+            ap_cost, mana_cost, effects, statuses = self.content.programs[action]
+        except KeyError:
+            return -4
+        target = players[target_number - 1]
+
+        attributes = source.attributes
+        if attributes["ap"] < ap_cost:
             return -1
-        if source.attributes["mana"] - mana_cost < 0:
-            self.lock.release()
+        if attributes["mana"] < mana_cost:
             return -2
-        for modifier in modifiers:
-            attribute = modifier.attribute
-            change = modifier.change
-            target.attributes[attribute] -= change
-        source.attributes["ap"] -= ap_cost
-        source.attributes["mana"] -= mana_cost
-        target.statuses.extend(statuses)
-        if target.attributes["hp"] <= 0:
+        target_attributes = target.attributes
+        for attribute, change in effects:
+            target_attributes[attribute] -= change
+        attributes["ap"] -= ap_cost
+        attributes["mana"] -= mana_cost
+        if statuses:
+            target.statuses.add_all(statuses)
+        if target_attributes["hp"] <= 0:
             target.is_alive = False
-        self.lock.release()
         return 0
 
     def cycle_turn(self):
         self.lock.acquire()
-        print("TN Before cycle: {}".format(self.turn_number))
+        # The player ending their turn gets a response, everyone else gets a push.
+        ended_by = self.players[self.active_player].name
+        result = self._cycle_turn()
+        self._record_changes()
+        self.lock.release()
+        self.publish(ended_by)
+        return result
+
+    def _cycle_turn(self):
+        # Must be called with the lock held. Returns -1 if the game is over, otherwise 0.
         self.turn_number += 1
-        print("TN After cycle: {}".format(self.turn_number))
         num_alive = 0
         for player in self.players:
             if player.is_alive:
                 num_alive += 1
         if num_alive <= 1:
-            self.lock.release()
+            self.in_game = False
             return -1
-        print("Active player before cycle: {}".format(self.active_player))
-        self.active_player = (self.active_player + 1) % len(self.players)
-        print("Active player after cycle: {}".format(self.active_player))
-        self.players[self.active_player].attributes["ap"] = self.players[self.active_player].attributes["max_ap"]
-        self.players[self.active_player].process_statuses()
-
-        while not self.players[self.active_player].is_alive:
+        # The turn passes to the next living player, who gets their AP back and whose
+        # statuses tick once as it starts. If their statuses kill them, it passes on again.
+        while True:
             self.active_player = (self.active_player + 1) % len(self.players)
-        self.players[self.active_player].process_statuses()
-        num_alive = 0
-        for player in self.players:
+            player = self.players[self.active_player]
+            if not player.is_alive:
+                continue
+            player.attributes["ap"] = player.attributes["max_ap"]
+            player.process_statuses()
             if player.is_alive:
-                num_alive += 1
-        if num_alive <= 1:
-            self.lock.release()
-            return -1
-        self.lock.release()
+                break
+            num_alive -= 1
+            if num_alive <= 1:
+                self.in_game = False
+                return -1
+        game_log.debug("Turn %s passes to player %s.", self.turn_number, self.active_player)
         return 0
 
     def get_lobby_dict(self):
-        self.lock.acquire()
+        self.lock.acquire_read()
+        lobby_dict = self._lobby_dict()
+        self.lock.release_read()
+        return lobby_dict
+
+    def get_lobby_snapshot(self):
+        # Returns the version along with the lobby, so they are known to match.
+        self.lock.acquire_read()
+        snapshot = (self.version, self._lobby_dict())
+        self.lock.release_read()
+        return snapshot
+
+    def _lobby_dict(self):
         lobby_dict = {}
 
         if len(self.players) >= 1:
@@ -183,11 +410,22 @@ class Game:
             lobby_dict["p6"] = self.players[5].lobby_dict()
         else:
             lobby_dict["p6"] = get_empty_lobby_dict()
-        self.lock.release()
         return lobby_dict
 
     def get_game_dict(self):
-        self.lock.acquire()
+        self.lock.acquire_read()
+        game_dict = self._game_dict()
+        self.lock.release_read()
+        return game_dict
+
+    def get_game_snapshot(self):
+        # Returns the version along with the game, so they are known to match.
+        self.lock.acquire_read()
+        snapshot = (self.version, self._game_dict())
+        self.lock.release_read()
+        return snapshot
+
+    def _game_dict(self):
         game_dict = {}
         player_dict = {}
         game_dict["turn-number"] = self.turn_number
@@ -224,5 +462,4 @@ class Game:
         else:
             player_dict["p6"] = get_empty_game_dict()
 
-        self.lock.release()
         return game_dict
@@ -1,47 +1,260 @@
-from json import load
-from os import getcwd, listdir
+""" This module reads the professions and actions from the JSON files under
+    assets for content.py. Parsing and checking every file is slow, so the
+    finished content is also kept in a bundle: one pickle file alongside the
+    assets, with a manifest of the files it was built from and what each one
+    parsed to. As long as no file has been added, removed or changed since,
+    loading is a stat of each file and a single unpickle. Otherwise only the
+    changed files are parsed again. If the assets have been packed into a
+    content pack with pack.py, that is loaded instead, see load_assets. """
+import pickle
+from hashlib import sha256
+from json import dumps, loads
+from multiprocessing import Pool, cpu_count, current_process
+from os import getpid, listdir, replace, stat
+from os.path import exists
 
-from action import ACTION_LIST, Action, Modifier, Status
-from profession import PROFESSION_LIST, Profession
+import pack
+
+from action import Action, Modifier, Status, compile_action
+from attributes import ATTRIBUTES
+from logs import content_log
+from profession import NO_PROFESSION, Profession
 
 PROFESSION_BASE_PATH = "/assets/professions/"
 ACTION_BASE_PATH = "/assets/actions/"
+BUNDLE_PATH = "/assets/bundle.pickle"
+
+# Bump this whenever the content classes or compile_action change, so older bundles are rebuilt.
+BUNDLE_FORMAT = 3
+
+# Parsing in worker processes only pays off past this many files.
+PARALLEL_PARSE_MIN = 256
+
+class AssetError(ValueError):
+    """ Raised when an asset file is not a valid profession or action. """
+
+def scan_sources(cwd):
+    """ Returns the (path, modification time, size) of every asset file, in a fixed order. """
+    sources = []
+    for base_path in (PROFESSION_BASE_PATH, ACTION_BASE_PATH):
+        for file_name in sorted(listdir(cwd + base_path)):
+            if file_name.endswith(".json"):
+                path = base_path + file_name
+                info = stat(cwd + path)
+                sources.append((path, info.st_mtime_ns, info.st_size))
+    return sources
+
+def load_assets(cwd, previous=None, processes=None):
+    """ Returns the content bundle from the content pack if there is one, and
+        otherwise from the JSON asset files through load_bundle. previous is the
+        last bundle this process loaded, if any. """
+    if exists(cwd + pack.PACK_PATH):
+        return load_pack(cwd, previous)
+    if previous is not None and previous["format"] != BUNDLE_FORMAT:
+        previous = None
+    return load_bundle(cwd, previous, processes)
+
+def load_pack(cwd, previous=None):
+    """ Returns a bundle for the content pack, the same as previous if the pack has not
+        changed since. Only its professions and the names of its actions are read
+        now. The lazy_actions hold the number of each action's record, and the
+        bundle's materialize decodes one of those into an Action and its program. """
+    info = stat(cwd + pack.PACK_PATH)
+    source = (pack.PACK_PATH, info.st_mtime_ns, info.st_size)
+    if previous is not None and previous["manifest"][0][:3] == source:
+        return previous
+    content_pack = pack.ContentPack(cwd + pack.PACK_PATH)
+    professions = content_pack.professions()
+    professions["None"] = NO_PROFESSION
+    return {
+        "format": "pack",
+        "manifest": [source + (content_pack.digest,)],
+        "professions": professions,
+        "actions": {},
+        "programs": {},
+        "lazy_actions": content_pack.action_numbers(),
+        "materialize": content_pack.action
+    }
+
+def load_bundle(cwd, previous=None, processes=None):
+    """ Returns the content bundle for the asset files as they are now. previous is the
+        last bundle this process loaded, if any, and otherwise the one on disk is tried.
+        If no file has changed since that bundle was built, it is returned as it is.
+        Otherwise only the files that were added or changed are parsed again, and a new
+        bundle is put together and written out, with processes workers parsing them,
+        one per core by default. Raises AssetError for an invalid file. """
+    sources = scan_sources(cwd)
+    bundle = previous if previous is not None else read_bundle(cwd + BUNDLE_PATH)
+    if bundle is None:
+        bundle = {"manifest": [], "parsed": {}}
+    elif [entry[:3] for entry in bundle["manifest"]] == sources:
+        return bundle
+    known = {entry[0]: entry for entry in bundle["manifest"]}
+    manifest = []
+    parsed = {}
+    changed = []
+    for source in sources:
+        path = source[0]
+        entry = known.get(path)
+        if entry is not None and entry[1:3] == source[1:]:
+            manifest.append(entry)
+            parsed[path] = bundle["parsed"][path]
+            continue
+        with open(cwd + path, "rb") as asset_file:
+            data = asset_file.read()
+        digest = sha256(data).hexdigest()
+        manifest.append(source + (digest,))
+        # A file that was only touched, or copied over with the same contents, still matches.
+        if entry is not None and entry[3] == digest:
+            parsed[path] = bundle["parsed"][path]
+            continue
+        changed.append((path, data))
+    for (path, _), result in zip(changed, parse_assets(changed, processes)):
+        parsed[path] = result
+    content_log.info("Parsed %s of %s asset files for the content bundle.", len(changed), len(sources))
+    bundle = assemble_bundle(manifest, parsed)
+    write_bundle(cwd + BUNDLE_PATH, bundle)
+    return bundle
+
+def read_bundle(path):
+    """ Returns the bundle at the path, or None if there is none that this version can use. """
+    try:
+        with open(path, "rb") as bundle_file:
+            bundle = pickle.load(bundle_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as error:
+        content_log.warning("Ignoring the unreadable content bundle: %s", error)
+        return None
+    if not isinstance(bundle, dict) or bundle.get("format") != BUNDLE_FORMAT:
+        return None
+    return bundle
+
+def write_bundle(path, bundle):
+    # The bundle is written beside the old one and then swapped in, so a reader
+    # never sees half of it. Without write access, the assets are parsed every time.
+    # Each process writes its own temporary file, as shard workers may load at once.
+    temporary_path = "{}.{}.tmp".format(path, getpid())
+    try:
+        with open(temporary_path, "wb") as bundle_file:
+            pickle.dump(bundle, bundle_file, pickle.HIGHEST_PROTOCOL)
+        replace(temporary_path, path)
+    except OSError as error:
+        content_log.warning("Could not write the content bundle: %s", error)
+
+def parse_asset(path, data):
+    """ Parses and checks the bytes of an asset file. Returns ("profession", its name,
+        the Profession), ("action", its name, the action as compact JSON), or
+        (None, None, None) for other files. Actions are only turned into objects once
+        they are needed, see assemble_bundle. This runs in the parsing pool's workers. """
+    try:
+        asset = loads(data)
+    except ValueError as error:
+        raise AssetError("{} is not valid JSON: {}".format(path, error))
+    if not isinstance(asset, dict):
+        raise AssetError("{} does not hold a JSON object".format(path))
+    kind = asset.get("TPR-Type")
+    if path.startswith(PROFESSION_BASE_PATH) and kind == "profession":
+        profession = build_profession(asset, path)
+        return kind, profession.name, profession
+    if path.startswith(ACTION_BASE_PATH) and kind == "action":
+        action = build_action(asset, path)
+        return kind, action.name, dumps(asset, separators=(",", ":"))
+    return None, None, None
+
+def parse_assets(items, processes=None):
+    """ Parses a list of (path, bytes) pairs with parse_asset and returns the results
+        in the same order. Large lists are spread over a pool of worker processes,
+        unless this is a daemonic process, such as a shard worker, which cannot have any. """
+    if processes is None:
+        processes = cpu_count()
+    if processes <= 1 or len(items) < PARALLEL_PARSE_MIN or current_process().daemon:
+        return [parse_asset(path, data) for path, data in items]
+    with Pool(processes) as pool:
+        return pool.starmap(parse_asset, items, chunksize=max(1, len(items) // (processes * 4)))
+
+def materialize_action(text):
+    """ Returns the Action for the compact JSON from parse_asset, and its compiled program. """
+    action = build_action(loads(text), "")
+    return action, compile_action(action)
+
+def check(condition, path, problem):
+    if not condition:
+        raise AssetError("{} {}".format(path, problem))
+
+def is_whole(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def build_modifier(modifier, path):
+    check(isinstance(modifier, dict), path, "has a modifier that is not an object")
+    check(modifier.get("attribute") in ATTRIBUTES, path, "modifies an unknown attribute")
+    check(is_whole(modifier.get("change")), path, "has a modifier without a whole number change")
+    return Modifier(modifier["attribute"], modifier["change"])
+
+def build_action(action, path):
+    check(isinstance(action.get("name"), str), path, "has no name")
+    costs = action.get("costs")
+    check(isinstance(costs, dict), path, "has no costs")
+    check(is_whole(costs.get("ap")) and is_whole(costs.get("mana")), path, "needs whole number ap and mana costs")
+    check(isinstance(action.get("modifiers"), list), path, "has no list of modifiers")
+    check(isinstance(action.get("statuses"), list), path, "has no list of statuses")
+    modifier_list = [build_modifier(modifier, path) for modifier in action["modifiers"]]
+    status_list = []
+    for status in action["statuses"]:
+        check(isinstance(status, dict), path, "has a status that is not an object")
+        check(is_whole(status.get("duration")), path, "has a status without a whole number duration")
+        check(is_whole(status.get("duration_delta")), path, "has a status without a whole number duration_delta")
+        status_list.append(
+            Status(build_modifier(status.get("modifier"), path), status["duration"], status["duration_delta"])
+        )
+    return Action(action["name"], costs, modifier_list, status_list)
+
+def build_profession(profession, path):
+    check(isinstance(profession.get("name"), str), path, "has no name")
+    check(isinstance(profession.get("description"), str), path, "has no description")
+    base_attributes = profession.get("base_attributes")
+    check(isinstance(base_attributes, dict), path, "has no base_attributes")
+    for attribute in ("base_hp", "base_ap", "base_mana"):
+        check(is_whole(base_attributes.get(attribute)), path, "needs a whole number " + attribute)
+    actions = profession.get("actions")
+    check(isinstance(actions, list) and all(isinstance(action, str) for action in actions),
+          path, "needs a list of action names")
+    return Profession(profession["name"], profession["description"], base_attributes, actions)
 
-def init():
-    PROFESSION_LIST.clear()
-    ACTION_LIST.clear()
-    cwd = getcwd()
-    prof_path = cwd + PROFESSION_BASE_PATH
-    for prof_file in listdir(prof_path):
-        if prof_file.endswith('.json'):
-            profession = load(open(prof_path + prof_file))
-            if profession["TPR-Type"] == "profession":
-                name = profession["name"]
-                description = profession["description"]
-                base_attributes = profession["base_attributes"]
-                actions = profession["actions"]
-                PROFESSION_LIST[name] = Profession(name, description, base_attributes, actions)
-    PROFESSION_LIST["None"] = Profession("None", "Someone who has not chosen a profession", {}, [])
-    action_path = cwd + ACTION_BASE_PATH
-    for action_file in listdir(action_path):
-        if action_file.endswith('.json'):
-            action = load(open(action_path + action_file))
-            if action["TPR-Type"] == "action":
-                name = action["name"]
-                costs = action["costs"]
-                modifier_list = []
-                for modifier in action["modifiers"]:
-                    attribute = modifier["attribute"]
-                    change = modifier["change"]
-                    modifier_list.append(Modifier(attribute, change))
-                status_list = []
-                for status in action["statuses"]:
-                    modifier = status["modifier"]
-                    attribute = modifier["attribute"]
-                    change = modifier["change"]
-                    duration = status["duration"]
-                    duration_delta = status["duration_delta"]
-                    status_list.append(
-                        Status(Modifier(attribute, change), duration, duration_delta)
-                    )
-                ACTION_LIST[name] = Action(name, costs, modifier_list, status_list)
+def assemble_bundle(manifest, parsed):
+    """ Puts the parsed asset files together into a bundle, checking that every
+        profession only uses actions that exist. Only the actions some profession
+        uses are turned into objects. The rest are kept as compact JSON under
+        "lazy_actions", to be materialized if anything ever asks for them. """
+    professions = {}
+    action_texts = {}
+    for entry in manifest:
+        kind, name, value = parsed[entry[0]]
+        if kind == "profession":
+            professions[name] = value
+        elif kind == "action":
+            action_texts[name] = value
+    professions["None"] = NO_PROFESSION
+    used = set()
+    for profession in professions.values():
+        for action in profession.actions:
+            if action not in action_texts:
+                raise AssetError("The {} profession uses the unknown action {}".format(profession.name, action))
+            used.add(action)
+    actions = {}
+    programs = {}
+    lazy_actions = {}
+    for name, text in action_texts.items():
+        if name in used:
+            actions[name], programs[name] = materialize_action(text)
+        else:
+            lazy_actions[name] = text
+    return {
+        "format": BUNDLE_FORMAT,
+        "manifest": manifest,
+        "parsed": parsed,
+        "professions": professions,
+        "actions": actions,
+        "programs": programs,
+        "lazy_actions": lazy_actions
+    }
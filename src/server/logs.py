@@ -0,0 +1,62 @@
+""" This module sets up logging for the Tiny-PyRPG Server.
+    Request handlers only put log records on a queue, and a background thread
+    formats them and writes them out, so a slow terminal never holds up a
+    request or a game lock. Messages use %-style arguments, which are only
+    formatted if the record's level is enabled. """
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+ROOT = "tiny_pyrpg"
+
+network_log = logging.getLogger(ROOT + ".network")
+client_log = logging.getLogger(ROOT + ".client")
+lobby_log = logging.getLogger(ROOT + ".lobby")
+game_log = logging.getLogger(ROOT + ".game")
+rooms_log = logging.getLogger(ROOT + ".rooms")
+shard_log = logging.getLogger(ROOT + ".shard")
+content_log = logging.getLogger(ROOT + ".content")
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+_listener = None
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Queues records as they are. The stock QueueHandler formats each message before
+        queueing it, which would leave that work on the thread doing the logging. """
+
+    def prepare(self, record):
+        return record
+
+def setup_logging(level="INFO", stream=None):
+    """ Sends every server log record at or above the given level through a queue
+        to a background writer. Calling it again, as a forked worker process
+        must, replaces the previous writer. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    _listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger(ROOT)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+    root.propagate = False
+    _listener.start()
+    return _listener
+
+def stop_logging():
+    """ Writes out whatever is still queued and stops the background writer. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,175 @@
+""" This module estimates how every profession fares against every other one.
+    It simulates matches for each pairing, and optionally for every lobby
+    composition of larger sizes, across a multiprocessing pool. Results stream
+    back in chunks and are folded into a matrix of win rates with Wilson score
+    confidence intervals. Each chunk carries its own seed drawn from the run's
+    seed, so a run is repeatable however the chunks land on the workers.
+
+    Run it from src/server, for example:
+        python matchups.py --games 100000 --sizes 2 3 """
+import argparse
+import multiprocessing
+import random
+import time
+from itertools import combinations_with_replacement
+from math import sqrt
+
+import simulation
+from content import load_content
+
+# How many matches a worker plays before sending its counts back.
+CHUNK_SIZE = 500
+
+# The z score for 95% confidence intervals.
+Z_95 = 1.959964
+
+def wilson_interval(wins, games, z=Z_95):
+    """ Returns the (low, high) Wilson score interval for a win rate. """
+    if not games:
+        return 0.0, 1.0
+    rate = wins / games
+    denominator = 1 + z * z / games
+    centre = (rate + z * z / (2 * games)) / denominator
+    margin = z * sqrt(rate * (1 - rate) / games + z * z / (4 * games * games)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+def lineups(professions, sizes):
+    """ Returns every lobby composition of the given sizes, as sorted tuples. """
+    compositions = []
+    for size in sizes:
+        compositions.extend(combinations_with_replacement(professions, size))
+    return compositions
+
+def play_chunk(task):
+    """ Plays one chunk of matches for a lineup in a worker process. Seats are
+        shuffled for every match so no profession always moves first. Returns the
+        lineup, the number of matches and draws, and the wins of each profession. """
+    lineup, games, seed, policy, max_turns = task
+    rng = random.Random(seed)
+    policies = [policy] * len(lineup)
+    seats = list(lineup)
+    draws = 0
+    wins = {}
+    for _ in range(games):
+        rng.shuffle(seats)
+        winner = simulation.play_match(seats, policies, rng, max_turns).winning_profession()
+        if winner is None:
+            draws += 1
+        else:
+            wins[winner] = wins.get(winner, 0) + 1
+    return lineup, games, draws, wins
+
+class MatchupMatrix:
+    """ Match counts for every lineup, folded in as the chunks arrive. """
+
+    def __init__(self, professions):
+        self.professions = professions
+        self.games = {}
+        self.draws = {}
+        self.wins = {}
+        self.seconds = 0.0
+
+    def add(self, lineup, games, draws, wins):
+        self.games[lineup] = self.games.get(lineup, 0) + games
+        self.draws[lineup] = self.draws.get(lineup, 0) + draws
+        totals = self.wins.setdefault(lineup, {})
+        for profession, won in wins.items():
+            totals[profession] = totals.get(profession, 0) + won
+
+    def total_games(self):
+        return sum(self.games.values())
+
+    def win_rate(self, lineup, profession):
+        """ Returns the share of the lineup's matches won by the profession,
+            along with its confidence interval, as (rate, low, high). """
+        games = self.games.get(lineup, 0)
+        won = self.wins.get(lineup, {}).get(profession, 0)
+        low, high = wilson_interval(won, games)
+        return (won / games if games else 0.0), low, high
+
+    def pair_report(self):
+        """ Returns the head to head matrix: the win rate of each row's profession
+            against each column's, with the interval half-width. """
+        width = 15
+        lines = ["{:<10}".format("") + "".join("{:>{}}".format(name, width) for name in self.professions)]
+        for row in self.professions:
+            cells = []
+            for column in self.professions:
+                lineup = tuple(sorted((row, column)))
+                if row == column or lineup not in self.games:
+                    cells.append("{:>{}}".format("-", width))
+                    continue
+                rate, low, high = self.win_rate(lineup, row)
+                cells.append("{:>{}}".format("{:.1f}±{:.1f}".format(rate * 100, (high - low) * 50), width))
+            lines.append("{:<10}".format(row) + "".join(cells))
+        return "\n".join(lines)
+
+    def lineup_report(self, size):
+        """ Returns the win rate of each profession in every lineup of the given size. """
+        lines = []
+        for lineup in sorted(lineup for lineup in self.games if len(lineup) == size):
+            results = []
+            for profession in sorted(set(lineup)):
+                rate, low, high = self.win_rate(lineup, profession)
+                results.append("{} {:.1f}% [{:.1f}, {:.1f}]".format(profession, rate * 100, low * 100, high * 100))
+            draws = 100.0 * self.draws[lineup] / self.games[lineup]
+            lines.append("{}: {}; draws {:.1f}%".format(" / ".join(lineup), ", ".join(results), draws))
+        return "\n".join(lines)
+
+    def report(self):
+        sizes = sorted(set(len(lineup) for lineup in self.games))
+        rate = self.total_games() / self.seconds if self.seconds else 0.0
+        sections = ["{} matches in {:.1f}s ({:.0f} matches/s)".format(self.total_games(), self.seconds, rate)]
+        if 2 in sizes:
+            sections.append("Head to head win % (row against column, ± 95% interval):\n" + self.pair_report())
+        for size in sizes:
+            sections.append("Lobbies of {}:\n".format(size) + self.lineup_report(size))
+        return "\n\n".join(sections)
+
+def run_matchups(games, sizes=(2,), policy=simulation.mixed_policy, seed=None,
+                 processes=None, max_turns=simulation.MAX_TURNS, chunk_size=CHUNK_SIZE, progress=None):
+    """ Plays the given number of matches for every lineup of the given sizes and
+        returns a MatchupMatrix. progress, if given, is called with the matrix after
+        each chunk arrives. The policy must be a module level function so workers can load it. """
+    professions = load_content().playable_professions()
+    rng = random.Random(seed)
+    tasks = []
+    for lineup in lineups(professions, sizes):
+        remaining = games
+        while remaining > 0:
+            count = min(chunk_size, remaining)
+            tasks.append((lineup, count, rng.getrandbits(64), policy, max_turns))
+            remaining -= count
+    # Interleave the lineups, so a partial run already covers all of them.
+    rng.shuffle(tasks)
+
+    matrix = MatchupMatrix(professions)
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes, initializer=load_content) as pool:
+        for result in pool.imap_unordered(play_chunk, tasks):
+            matrix.add(*result)
+            matrix.seconds = time.perf_counter() - started
+            if progress is not None:
+                progress(matrix)
+    return matrix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate Tiny-PyRPG profession win rates.")
+    parser.add_argument("--games", type=int, default=10000, help="matches to play for every lineup")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2], help="lobby sizes to try every composition of")
+    parser.add_argument("--policy", choices=sorted(simulation.POLICIES), default="mixed", help="how players choose actions")
+    parser.add_argument("--seed", type=int, help="seed for a repeatable run")
+    parser.add_argument("--processes", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--max-turns", type=int, default=simulation.MAX_TURNS, help="turns before a match is a draw")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="matches per unit of work")
+    args = parser.parse_args()
+
+    def show_progress(matrix):
+        print("\r{} matches played".format(matrix.total_games()), end="", flush=True)
+
+    matrix = run_matchups(
+        args.games, args.sizes, simulation.POLICIES[args.policy], args.seed,
+        args.processes, args.max_turns, args.chunk_size, show_progress
+    )
+    print()
+    print(matrix.report())
@@ -0,0 +1,218 @@
+""" This module reads and writes content packs: all of the professions and actions
+    in one file, so loading them takes a single open instead of one per asset.
+    A pack starts with a header that gives the number and position of the records
+    in each table. Every table holds records of one fixed layout, so a record is
+    found by its number alone. Text lives in a blob at the end, referred to by
+    its number in the strings table. The file is memory mapped, and a record is
+    only decoded when something asks for it.
+
+    To build assets/content.pack from the JSON files under assets, run this
+    from src/server:
+        python pack.py
+    While the pack exists the server loads it instead of the JSON files, so
+    run this again after changing them, or delete the pack. """
+import argparse
+import mmap
+import struct
+from hashlib import sha256
+from os import getcwd, getpid, replace
+
+import initializer
+from action import Action, Modifier, Status, compile_action
+from profession import Profession
+
+PACK_PATH = "/assets/content.pack"
+
+MAGIC = b"TPRPACK\x00"
+
+# Bump this whenever a record layout changes.
+PACK_FORMAT = 1
+
+# The tables, in the order they follow the header.
+TABLES = ("strings", "professions", "action_refs", "actions", "modifiers", "statuses")
+
+# The layout of a record in each table. Numbers are little-endian, and fields
+# that refer to other records hold their number in that table.
+LAYOUTS = {
+    # Where the text starts in the blob, and its length in bytes of UTF-8.
+    "strings": struct.Struct("<II"),
+    # Name, description, base hp, ap and mana, and the first of its action_refs and how many.
+    "professions": struct.Struct("<IIiiiII"),
+    # An action a profession has.
+    "action_refs": struct.Struct("<I"),
+    # Name, ap and mana costs, and the first of its modifiers and statuses and how many of each.
+    "actions": struct.Struct("<IiiIIII"),
+    # Attribute name and change.
+    "modifiers": struct.Struct("<Ii"),
+    # Modifier, duration and duration_delta.
+    "statuses": struct.Struct("<Iii"),
+}
+
+# Magic, format, where the blob starts, the digest of everything after the
+# header, and the number of records and offset of each table.
+HEADER = struct.Struct("<8sII32s" + "II" * len(TABLES))
+
+def write_pack(path, professions, actions):
+    """ Writes a pack of the given professions and actions, both by name. Actions are
+        stored sorted by name. The pack is written beside the old one and then swapped
+        in, so a server that has the old one mapped keeps reading it unchanged. """
+    strings = {}
+    rows = {table: [] for table in TABLES}
+
+    def string(text):
+        number = strings.get(text)
+        if number is None:
+            number = strings[text] = len(strings)
+        return number
+
+    def modifier(entry):
+        rows["modifiers"].append(LAYOUTS["modifiers"].pack(string(entry.attribute), entry.change))
+        return len(rows["modifiers"]) - 1
+
+    try:
+        names = sorted(actions)
+        action_numbers = {name: number for number, name in enumerate(names)}
+        for name in names:
+            action = actions[name]
+            first_modifier = len(rows["modifiers"])
+            for entry in action.modifier_list:
+                modifier(entry)
+            modifier_count = len(rows["modifiers"]) - first_modifier
+            first_status = len(rows["statuses"])
+            for status in action.status_list:
+                rows["statuses"].append(
+                    LAYOUTS["statuses"].pack(modifier(status.modifier), status.duration, status.duration_delta)
+                )
+            rows["actions"].append(LAYOUTS["actions"].pack(
+                string(name), action.costs["ap"], action.costs["mana"],
+                first_modifier, modifier_count, first_status, len(action.status_list)
+            ))
+        for name in sorted(professions):
+            profession = professions[name]
+            base = profession.base_attributes
+            first_ref = len(rows["action_refs"])
+            for action in profession.actions:
+                rows["action_refs"].append(LAYOUTS["action_refs"].pack(action_numbers[action]))
+            rows["professions"].append(LAYOUTS["professions"].pack(
+                string(name), string(profession.description), base["base_hp"], base["base_ap"],
+                base["base_mana"], first_ref, len(profession.actions)
+            ))
+        blob = bytearray()
+        for text in strings:
+            encoded = text.encode("utf-8")
+            rows["strings"].append(LAYOUTS["strings"].pack(len(blob), len(encoded)))
+            blob += encoded
+    except struct.error as error:
+        raise initializer.AssetError("The content does not fit in a pack: {}".format(error))
+
+    body = bytearray()
+    tables = []
+    for table in TABLES:
+        tables += [len(rows[table]), HEADER.size + len(body)]
+        body += b"".join(rows[table])
+    blob_offset = HEADER.size + len(body)
+    body += blob
+    header = HEADER.pack(MAGIC, PACK_FORMAT, blob_offset, sha256(body).digest(), *tables)
+    temporary_path = "{}.{}.tmp".format(path, getpid())
+    with open(temporary_path, "wb") as pack_file:
+        pack_file.write(header)
+        pack_file.write(body)
+    replace(temporary_path, path)
+
+class ContentPack:
+    """ A pack file, memory mapped. Only the header is read when it is opened.
+        The map stays open for as long as anything refers to the pack, so games
+        on an older content version can still decode from it after it is replaced. """
+
+    def __init__(self, path):
+        with open(path, "rb") as pack_file:
+            try:
+                self.map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise initializer.AssetError("{} is empty".format(path))
+        if len(self.map) < HEADER.size:
+            raise initializer.AssetError("{} is too short to be a content pack".format(path))
+        magic, pack_format, self.blob, digest, *tables = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise initializer.AssetError("{} is not a content pack".format(path))
+        if pack_format != PACK_FORMAT:
+            raise initializer.AssetError("{} is a version {} content pack, run pack.py again".format(path, pack_format))
+        # The digest is only compared with other packs, never checked against the file, as that would read all of it.
+        self.digest = digest.hex()
+        self.tables = {}
+        for number, table in enumerate(TABLES):
+            count, offset = tables[2 * number], tables[2 * number + 1]
+            if offset + count * LAYOUTS[table].size > len(self.map):
+                raise initializer.AssetError("{} is cut short in its {} table".format(path, table))
+            self.tables[table] = (count, offset)
+
+    def count(self, table):
+        return self.tables[table][0]
+
+    def record(self, table, number):
+        """ Returns the fields of a record, by its number in the table. """
+        layout = LAYOUTS[table]
+        return layout.unpack_from(self.map, self.tables[table][1] + number * layout.size)
+
+    def string(self, number):
+        start, length = self.record("strings", number)
+        start += self.blob
+        return str(self.map[start:start + length], "utf-8")
+
+    def action_numbers(self):
+        """ Returns the number of every action's record, by name. Only the names are decoded. """
+        return {self.string(self.record("actions", number)[0]): number for number in range(self.count("actions"))}
+
+    def professions(self):
+        """ Returns every Profession in the pack, by name. """
+        professions = {}
+        for number in range(self.count("professions")):
+            name, description, hp, ap, mana, first_ref, ref_count = self.record("professions", number)
+            actions = [
+                self.string(self.record("actions", self.record("action_refs", ref)[0])[0])
+                for ref in range(first_ref, first_ref + ref_count)
+            ]
+            base_attributes = {"base_hp": hp, "base_ap": ap, "base_mana": mana}
+            professions[self.string(name)] = Profession(self.string(name), self.string(description), base_attributes, actions)
+        return professions
+
+    def modifier(self, number):
+        attribute, change = self.record("modifiers", number)
+        return Modifier(self.string(attribute), change)
+
+    def action(self, number):
+        """ Decodes an action's record, with its modifiers and statuses. Returns the
+            Action and its compiled program, like initializer.materialize_action. """
+        name, ap, mana, first_modifier, modifier_count, first_status, status_count = self.record("actions", number)
+        modifier_list = [self.modifier(modifier) for modifier in range(first_modifier, first_modifier + modifier_count)]
+        status_list = []
+        for status in range(first_status, first_status + status_count):
+            modifier, duration, duration_delta = self.record("statuses", status)
+            status_list.append(Status(self.modifier(modifier), duration, duration_delta))
+        action = Action(self.string(name), {"ap": ap, "mana": mana}, modifier_list, status_list)
+        return action, compile_action(action)
+
+def pack_assets(cwd, processes=None):
+    """ Parses and checks every JSON asset file and writes them to the pack. Returns
+        how many professions and actions it holds. Raises AssetError for an invalid file. """
+    sources = initializer.scan_sources(cwd)
+    items = []
+    for path, _, _ in sources:
+        with open(cwd + path, "rb") as asset_file:
+            items.append((path, asset_file.read()))
+    parsed = dict(zip([path for path, _ in items], initializer.parse_assets(items, processes)))
+    bundle = initializer.assemble_bundle(sources, parsed)
+    professions = dict(bundle["professions"])
+    del professions["None"]
+    actions = dict(bundle["actions"])
+    for name, text in bundle["lazy_actions"].items():
+        actions[name] = initializer.materialize_action(text)[0]
+    write_pack(cwd + PACK_PATH, professions, actions)
+    return len(professions), len(actions)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the Tiny-PyRPG JSON assets into assets/content.pack.")
+    parser.add_argument("--processes", type=int, help="worker processes to parse with, one per core by default")
+    args = parser.parse_args()
+    professions, actions = pack_assets(getcwd(), args.processes)
+    print("Packed {} professions and {} actions into {}.".format(professions, actions, PACK_PATH[1:]))
@@ -1,20 +1,35 @@
+from collections import namedtuple
 from copy import deepcopy
-from profession import PROFESSION_LIST
+from attributes import ATTRIBUTES
+from profession import NO_PROFESSION
+from statuses import StatusEngine
 import json
 
+# An immutable record of a player, as taken by Player.snapshot. The attributes are
+# a tuple in the order of ATTRIBUTES, or None before a profession is chosen.
+PlayerState = namedtuple(
+    "PlayerState",
+    ("player_class", "name", "profession", "actions", "attributes", "ready", "is_alive", "statuses")
+)
+
 class Player:
+    # Bots are players whose turns the server plays, see bot.py.
+    is_bot = False
 
     def __init__(self, name):
         self.name = name
-        self.profession = PROFESSION_LIST["None"]
+        self.profession = NO_PROFESSION
         self.attributes = None
         self.ready = False
-        self.statuses = []
+        self.statuses = StatusEngine()
         self.is_alive = True
+        # Cleared once the player's client has gone, however it left.
+        self.connected = True
         self.actions = []
 
     def set_profession(self, profession):
-        self.profession = PROFESSION_LIST[profession]
+        # Takes the Profession itself, from the content of the player's game.
+        self.profession = profession
         self.attributes = {}
         self.attributes["hp"] = 0 + self.profession.base_attributes["base_hp"]
         self.attributes["max_hp"] = 0 + self.profession.base_attributes["base_hp"]
@@ -27,22 +42,28 @@ class Player:
     def set_ready(self, ready):
         self.ready = ready
 
+    def snapshot(self):
+        # Everything about the player that changes during play. Professions and action
+        # lists are only ever replaced, never changed, so the record can share them.
+        attributes = None
+        if self.attributes is not None:
+            attributes = tuple([self.attributes[attribute] for attribute in ATTRIBUTES])
+        return PlayerState(
+            type(self), self.name, self.profession, self.actions, attributes,
+            self.ready, self.is_alive, self.statuses.snapshot()
+        )
+
+    def restore(self, state):
+        # Puts the player back as they were in the given PlayerState, which must be their own.
+        _, _, self.profession, self.actions, attributes, self.ready, self.is_alive, statuses = state
+        if attributes is None:
+            self.attributes = None
+        else:
+            self.attributes = dict(zip(ATTRIBUTES, attributes))
+        self.statuses.restore(statuses)
+
     def process_statuses(self):
-        for status in self.statuses:
-            modifier = status.modifier
-            attribute = modifier.attribute
-            change = modifier.change
-            duration = status.duration
-            duration_delta = status.duration_delta
-            self.attributes[attribute] = self.attributes[attribute] - change
-            if self.attributes[attribute] < 0:
-                self.attributes[attribute] = 0
-            duration -= 1
-            change -= duration_delta
-            if change < 0:
-                change = 0
-            if duration == 0:
-                self.statuses.remove(status)
+        self.statuses.process(self.attributes)
         if self.attributes["hp"] <= 0:
             self.is_alive = False
 
@@ -63,6 +84,16 @@ class Player:
         game_dict["mana"] = [self.attributes["mana"], self.attributes["max_mana"]]
         return game_dict
 
+    def state_dict(self):
+        # Every field a client can see for this player, used to work out what changed.
+        state_dict = self.lobby_dict()
+        if self.attributes is not None:
+            state_dict["hp"] = [self.attributes["hp"], self.attributes["max_hp"]]
+            state_dict["ap"] = [self.attributes["ap"], self.attributes["max_ap"]]
+            state_dict["mana"] = [self.attributes["mana"], self.attributes["max_mana"]]
+        state_dict["actions"] = self.actions
+        return state_dict
+
 def get_empty_lobby_dict():
     lobby_dict = {}
     lobby_dict["name"] = ""
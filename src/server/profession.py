@@ -1,5 +1,3 @@
-PROFESSION_LIST = {}
-
 class Profession:
 
     def __init__(self, name, description, base_attributes, actions):
@@ -15,3 +13,6 @@ class Profession:
         player_dict["base_attributes"] = self.base_attributes
         player_dict["actions"] = self.actions
         return player_dict
+
+# The profession of a player who has not picked one yet.
+NO_PROFESSION = Profession("None", "Someone who has not chosen a profession", {}, [])
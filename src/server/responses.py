@@ -0,0 +1,69 @@
+""" This module caches the encoded parts of packages that every player in a game is sent.
+    When six clients ask for the same game, its state is encoded once per codec
+    and only the parts that differ between players are encoded per package. """
+from threading import Lock
+
+class CacheCounters:
+    """ Hits and misses summed over every response cache in this process. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def record(self, hit):
+        self.lock.acquire()
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+
+    def report(self):
+        """ Returns the counters as a line for the server console. """
+        self.lock.acquire()
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        line = "Response cache: {} hits, {} misses ({:.1f}% hit rate)".format(self.hits, self.misses, rate)
+        self.lock.release()
+        return line
+
+CACHE_COUNTERS = CacheCounters()
+
+class ResponseCache:
+    """ Holds encoded bodies for a single version of one game. The game invalidates
+        the cache whenever it changes, and bodies built from an older version are
+        never stored, so a hit is always current. """
+
+    def __init__(self):
+        self.version = 0
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def invalidate(self, version):
+        """ Drops every body and starts caching the given version. """
+        self.lock.acquire()
+        self.version = version
+        self.entries.clear()
+        self.lock.release()
+
+    def get(self, key):
+        """ Returns the body cached under the key, or None. """
+        self.lock.acquire()
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.lock.release()
+        CACHE_COUNTERS.record(body is not None)
+        return body
+
+    def put(self, key, version, body):
+        """ Caches a body built from the given version of the game, unless the game has moved on. """
+        self.lock.acquire()
+        if version == self.version:
+            self.entries[key] = body
+        self.lock.release()
@@ -0,0 +1,91 @@
+""" This module keeps track of every game a Tiny-PyRPG Server is hosting. """
+from threading import Lock
+
+from game import Game
+
+MAX_PLAYERS = 6
+
+class RoomRegistry:
+    """ Holds any number of concurrent games, each in its own room with a numeric id.
+        Rooms are looked up by id in a dict, and rooms still in their lobby are
+        also kept in insertion order so quick joins fill the oldest room first. """
+
+    def __init__(self, first_id=1, id_step=1):
+        # Sharded servers give each registry its own first id and a step of the shard
+        # count, so every room id is unique across shards and names the shard it lives on.
+        self.rooms = {}
+        self.lobbies = {}
+        self.next_id = first_id
+        self.id_step = id_step
+        self.lock = Lock()
+
+    def create_room(self):
+        """ Creates a new room and returns its game. """
+        game = Game()
+        self.lock.acquire()
+        self._add_room(game)
+        self.lock.release()
+        return game
+
+    def _add_room(self, game):
+        # Must be called with the lock held.
+        game.room_id = self.next_id
+        self.next_id += self.id_step
+        self.rooms[game.room_id] = game
+        self.lobbies[game.room_id] = game
+
+    def get_room(self, room_id):
+        """ Returns the game in the given room, or None if there is no such room. """
+        return self.rooms.get(room_id)
+
+    def join_open_room(self, name):
+        """ Adds a player to the oldest room that is still in its lobby and has a free
+            slot, creating a room if every one is full or has already started. Finding
+            the room and taking the slot happen in one step under the lock, so two quick
+            joins are never both sent to the last slot of a room. Returns the game and
+            the result of Game.add_player, which is -2 if the name is taken there. """
+        self.lock.acquire()
+        for room_id, game in list(self.lobbies.items()):
+            if not game.in_lobby:
+                del self.lobbies[room_id]
+                continue
+            if len(game.players) >= MAX_PLAYERS:
+                continue
+            result = game.add_player(name)
+            # A join naming the room, or a bot, may still have taken the last slot,
+            # and the game may have started since, so then the next room is tried.
+            if result != -1 and result != -3:
+                self.lock.release()
+                return game, result
+        game = Game()
+        self._add_room(game)
+        result = game.add_player(name)
+        self.lock.release()
+        return game, result
+
+    def list_rooms(self):
+        """ Returns a summary of every room for clients choosing where to play. """
+        self.lock.acquire()
+        rooms = []
+        for room_id, game in self.rooms.items():
+            room = {}
+            room["room"] = room_id
+            room["players"] = len(game.players)
+            room["in-lobby"] = game.in_lobby
+            rooms.append(room)
+        self.lock.release()
+        return rooms
+
+    def close_room_if_done(self, game):
+        """ Forgets a room once its game has ended or every human has left it, died
+            or disconnected. Bots are never left playing on their own. """
+        if game.has_humans() and (game.in_lobby or game.in_game):
+            return False
+        self.lock.acquire()
+        self.rooms.pop(game.room_id, None)
+        self.lobbies.pop(game.room_id, None)
+        self.lock.release()
+        return True
+
+    def __len__(self):
+        return len(self.rooms)
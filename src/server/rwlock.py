@@ -0,0 +1,61 @@
+""" This module provides a reader/writer lock for state that is read far more often than it is changed. """
+from threading import Condition, Lock
+
+class RWLock:
+    """ Any number of readers may hold the lock at once, but a writer holds it alone.
+        Once a writer is waiting, new readers wait behind it, so a steady stream of
+        readers cannot starve the writers. acquire and release take the lock for
+        writing, so the lock can stand in for a plain Lock.
+
+        Neither side is reentrant. A thread holding the read lock must not take the
+        write lock, which waits for every reader to leave, including itself. Nor may
+        it take the read lock again while a writer waits, since the second read waits
+        behind that writer, which waits for the first. Either one deadlocks. """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self._readers_waiting = 0
+
+    def acquire_read(self):
+        self._cond.acquire()
+        if self._writing or self._writers_waiting:
+            self._readers_waiting += 1
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers_waiting -= 1
+        self._readers += 1
+        self._cond.release()
+
+    def release_read(self):
+        self._cond.acquire()
+        self._readers -= 1
+        # Only writers wait for readers to leave, so there is no one to wake otherwise.
+        if not self._readers and self._writers_waiting:
+            self._cond.notify_all()
+        self._cond.release()
+
+    def acquire(self):
+        self._cond.acquire()
+        self._writers_waiting += 1
+        while self._writing or self._readers:
+            self._cond.wait()
+        self._writers_waiting -= 1
+        self._writing = True
+        self._cond.release()
+
+    def release(self):
+        self._cond.acquire()
+        self._writing = False
+        if self._writers_waiting or self._readers_waiting:
+            self._cond.notify_all()
+        self._cond.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,201 @@
+""" This module runs a Tiny-PyRPG Server as one front listener and several worker processes.
+    Each worker owns its own rooms and serves its own clients, so games are
+    spread over every core instead of sharing one interpreter lock. The front
+    listener only does the handshake and reads the JOIN LOBBY request, then
+    passes the socket itself to the worker that owns the room being joined. """
+import asyncio
+import multiprocessing
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.reduction import recv_handle, send_handle
+
+from admission import ACCEPT_BACKLOG, ADMISSION_WORKERS
+from bot import BOTS
+from codec import CODECS
+from content import load_content, watch_assets
+from logs import network_log, setup_logging, shard_log
+from rooms import MAX_PLAYERS, RoomRegistry
+from start_server import (
+    HOST, PORT, ClientConnection, admit_player, client_thread, read_join_request, send_client_error
+)
+
+def shard_of(room_id, shard_count):
+    """ Returns the index of the worker that owns the given room. """
+    return (room_id - 1) % shard_count
+
+class Shard:
+    """ The front listener's handle on one worker process. Requests to the worker
+        and their replies share one pipe, so they are sent one at a time. """
+
+    def __init__(self, index, shard_count, use_asyncio, log_level, watch):
+        self.index = index
+        self.pipe, worker_pipe = multiprocessing.Pipe()
+        self.lock = threading.Lock()
+        self.process = multiprocessing.Process(
+            target=run_worker, args=(
+                index, shard_count, worker_pipe, use_asyncio, log_level, watch
+            )
+        )
+        self.process.daemon = True
+        self.process.start()
+
+    def request(self, *message):
+        self.lock.acquire()
+        self.pipe.send(message)
+        reply = self.pipe.recv()
+        self.lock.release()
+        return reply
+
+    def hand_off(self, conn, addr, cpkg):
+        """ Passes a connected client, along with what the front listener has
+            already read from it, to this worker. """
+        state = {}
+        state["addr"] = addr
+        state["codec"] = conn.codec.name
+        state["request"] = cpkg
+        state["buffered"] = conn.buffer.take()
+        self.lock.acquire()
+        self.pipe.send(("client", state))
+        send_handle(self.pipe, conn.sock.fileno(), self.process.pid)
+        self.lock.release()
+        # The worker holds its own copy of the socket now.
+        conn.close()
+
+class ShardedListener:
+    """ Accepts every connection on the public port and routes each client to a worker. """
+
+    def __init__(self, shard_count, use_asyncio=False, log_level="INFO", watch=False):
+        self.shards = [
+            Shard(index, shard_count, use_asyncio, log_level, watch)
+            for index in range(shard_count)
+        ]
+        self.next_create = 0
+        self.quick_joins = 0
+        # Clients are admitted on several threads at once, so the counters above share a lock.
+        self.lock = threading.Lock()
+
+    def pick_shard(self, cpkg):
+        """ Returns the worker a JOIN LOBBY request should go to. Joins naming a
+            room go to its owner, and quick joins go to the same worker in groups
+            the size of a lobby so they still end up playing together. """
+        data = cpkg["data"]
+        if isinstance(data, dict) and isinstance(data.get("room"), int) and data["room"] > 0:
+            return self.shards[shard_of(data["room"], len(self.shards))]
+        self.lock.acquire()
+        shard = self.shards[(self.quick_joins // MAX_PLAYERS) % len(self.shards)]
+        self.quick_joins += 1
+        self.lock.release()
+        return shard
+
+    def process_room_request(self, conn, cpkg):
+        """ Answers LIST ROOMS and CREATE ROOM by asking the workers.
+            Returns True if the request was one of them. """
+        request = cpkg["request"]
+        if request == "LIST ROOMS":
+            rooms = []
+            for shard in self.shards:
+                rooms.extend(shard.request("list"))
+            spkg = {}
+            spkg["response"] = "ROOM LIST"
+            spkg["data"] = rooms
+            conn.send_package(spkg)
+            return True
+        if request == "CREATE ROOM":
+            self.lock.acquire()
+            shard = self.shards[self.next_create % len(self.shards)]
+            self.next_create += 1
+            self.lock.release()
+            spkg = {}
+            spkg["response"] = "ROOM CREATED"
+            spkg["data"] = shard.request("create")
+            conn.send_package(spkg)
+            return True
+        return False
+
+    def admit_client(self, conn, addr, stats, accepted):
+        """ This method is run on an admission thread for each accepted connection.
+            It reads the client's JOIN LOBBY request and hands the client to a worker. """
+        cpkg = read_join_request(conn, addr, stats, accepted, self.process_room_request)
+        if cpkg is None:
+            return
+        if cpkg["request"] != "JOIN LOBBY":
+            send_client_error(conn, "INVALID REQUEST")
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+            return
+        started = time.monotonic()
+        self.pick_shard(cpkg).hand_off(conn, addr, cpkg)
+        stats.record("hand off", time.monotonic() - started)
+
+    def listen(self, stats):
+        """ This method is designed to be used in a separate thread from the main program. """
+        network_log.info("Starting sharded listener with %s workers.", len(self.shards))
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((HOST, PORT))
+        listener.listen(ACCEPT_BACKLOG)
+        admission = ThreadPoolExecutor(max_workers=ADMISSION_WORKERS, thread_name_prefix="admission")
+
+        while True:
+            sock, addr = listener.accept()
+            network_log.debug("Accepted connection from %s.", addr)
+            admission.submit(self.admit_client, ClientConnection(sock), addr, stats, time.monotonic())
+
+def adopt_client(sock, state, rooms):
+    """ Rebuilds a connection handed over by the front listener and joins the
+        client to a lobby. Returns the connection along with the name and game
+        it joined, or None if it was refused. """
+    conn = ClientConnection(sock)
+    conn.codec = CODECS[state["codec"]]
+    conn.buffer.feed(state["buffered"])
+    return conn, admit_player(conn, state["addr"], rooms, state["request"])
+
+def run_worker(index, shard_count, pipe, use_asyncio, log_level, watch):
+    """ The main loop of a worker process. It answers the front listener's
+        requests and serves every client the front listener hands it. """
+    # The background log writer is a thread, so it does not survive the fork.
+    setup_logging(log_level)
+    # Each worker has its own content, so each one watches the assets for itself.
+    load_content()
+    if watch:
+        watch_assets()
+    rooms = RoomRegistry(first_id=index + 1, id_step=shard_count)
+    shard_log.info("Shard %s: Worker started.", index)
+
+    loop = None
+    # The event loop only keeps weak references to its tasks, so hold on to them here.
+    adopted = set()
+    if use_asyncio:
+        from async_server import serve_adopted
+        loop = asyncio.new_event_loop()
+        BOTS.dispatch = loop.call_soon_threadsafe
+        loop_thread = threading.Thread(target=loop.run_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+    while True:
+        message = pipe.recv()
+        kind = message[0]
+        if kind == "list":
+            pipe.send(rooms.list_rooms())
+        elif kind == "create":
+            game = rooms.create_room()
+            shard_log.info("Shard %s: Created room %s.", index, game.room_id)
+            pipe.send(game.room_id)
+        elif kind == "client":
+            state = message[1]
+            sock = socket.socket(fileno=recv_handle(pipe))
+            if loop is not None:
+                future = asyncio.run_coroutine_threadsafe(serve_adopted(sock, state, rooms), loop)
+                adopted.add(future)
+                future.add_done_callback(adopted.discard)
+                continue
+            conn, joined = adopt_client(sock, state, rooms)
+            if joined is None:
+                continue
+            name, game = joined
+            c_thread = threading.Thread(target=client_thread, args=(conn, name, game, rooms))
+            c_thread.daemon = True
+            c_thread.start()
@@ -0,0 +1,263 @@
+""" This module plays Tiny-PyRPG matches headlessly, without sockets or clients.
+    A match is a Game driven through the same methods the server's request
+    handlers call, with a policy choosing each player's actions. Running many
+    matches in a batch load-tests the rules and gives balance statistics.
+
+    Run it from src/server, for example:
+        python simulation.py --games 5000 --professions Warrior Wizard --policy greedy """
+import argparse
+import multiprocessing
+import random
+import time
+from content import current_content, load_content
+from game import Game
+
+# A match that goes on this long is called a draw.
+MAX_TURNS = 500
+
+# A policy is called as policy(game, pnum, rng) during player pnum's turn, with pnum
+# counting from 0. It returns the (target number, action) to try next, with target
+# numbers counting from 1 like the protocol, or None to end the turn.
+
+def affordable_actions(game, pnum):
+    """ Returns the actions player pnum has enough AP and mana for. """
+    player = game.players[pnum]
+    programs = game.content.programs
+    attributes = player.attributes
+    actions = []
+    for action in player.actions:
+        ap_cost, mana_cost, _, _ = programs[action]
+        if ap_cost <= attributes["ap"] and mana_cost <= attributes["mana"]:
+            actions.append(action)
+    return actions
+
+def living_opponents(game, pnum):
+    """ Returns the target numbers of every other player still alive. """
+    return [
+        index + 1 for index, player in enumerate(game.players)
+        if index != pnum and player.is_alive
+    ]
+
+def random_policy(game, pnum, rng):
+    """ Plays random affordable actions on random targets, ending the turn now and then. """
+    actions = affordable_actions(game, pnum)
+    if not actions or rng.random() < 0.1:
+        return None
+    action = rng.choice(actions)
+    # Actions that hurt go to an opponent, and the rest are used on the player themselves.
+    if game.content.harm[action] > 0:
+        opponents = living_opponents(game, pnum)
+        if not opponents:
+            return None
+        return rng.choice(opponents), action
+    return pnum + 1, action
+
+def greedy_policy(game, pnum, rng):
+    """ Hits the weakest opponent with the most damaging affordable action.
+        With nothing left to hit with, it heals if it has lost over half its hp. """
+    player = game.players[pnum]
+    attributes = player.attributes
+    ap = attributes["ap"]
+    mana = attributes["mana"]
+    affordable = [
+        (harm, action) for harm, ap_cost, mana_cost, action in game.content.ranked_actions(player.actions)
+        if ap_cost <= ap and mana_cost <= mana
+    ]
+    if not affordable:
+        return None
+    harm, best = affordable[0]
+    if harm > 0:
+        opponents = living_opponents(game, pnum)
+        if not opponents:
+            return None
+        weakest = min(opponents, key=lambda target: game.players[target - 1].attributes["hp"])
+        return weakest, best
+    if attributes["hp"] * 2 >= attributes["max_hp"] or affordable[-1][0] >= 0:
+        return None
+    # The most healing action, and of those the first in the player's list.
+    least = affordable[-1][0]
+    for harm, action in affordable:
+        if harm == least:
+            return pnum + 1, action
+
+def mixed_policy(game, pnum, rng):
+    """ Plays like greedy_policy, but picks a random move one time in five,
+        so repeated matches between the same lineup do not all play out alike. """
+    if rng.random() < 0.2:
+        return random_policy(game, pnum, rng)
+    return greedy_policy(game, pnum, rng)
+
+POLICIES = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "mixed": mixed_policy
+}
+
+class MatchResult:
+    """ How a single match went. The winner is a player number counting from 0,
+        or None for a draw. """
+
+    def __init__(self, professions, winner, turns, actions):
+        self.professions = professions
+        self.winner = winner
+        self.turns = turns
+        self.actions = actions
+
+    def winning_profession(self):
+        if self.winner is None:
+            return None
+        return self.professions[self.winner]
+
+def play_turn(game, pnum, name, policy, rng):
+    """ Plays the actions the policy chooses for player pnum, without ending the turn,
+        and returns how many were performed. A turn ends when the policy says so,
+        when it asks for something it cannot do, or when no opponent is left. """
+    actions = 0
+    while True:
+        choice = policy(game, pnum, rng)
+        if choice is None:
+            break
+        target, action = choice
+        if game.try_action(name, target, action) != 0:
+            break
+        actions += 1
+        # Opponents only need counting again when this action was the one to kill.
+        if not game.players[target - 1].is_alive and not living_opponents(game, pnum):
+            break
+    return actions
+
+def play_match(professions, policies, rng, max_turns=MAX_TURNS):
+    """ Plays one match between players of the given professions, each using
+        the policy at the same index, and returns a MatchResult. """
+    game = Game(track_changes=False)
+    names = []
+    for pnum, profession in enumerate(professions):
+        name = "p{}".format(pnum + 1)
+        names.append(name)
+        game.add_player(name)
+        game.set_player_profession(name, profession)
+        game.set_player_ready(name, True)
+    game.try_start()
+
+    actions = 0
+    while game.in_game and game.turn_number <= max_turns:
+        pnum = game.active_player
+        actions += play_turn(game, pnum, names[pnum], policies[pnum], rng)
+        game.cycle_turn()
+
+    winner = None
+    if not game.in_game:
+        alive = [pnum for pnum, player in enumerate(game.players) if player.is_alive]
+        if len(alive) == 1:
+            winner = alive[0]
+    return MatchResult(list(professions), winner, game.turn_number, actions)
+
+class BatchResult:
+    """ Totals over a batch of matches. """
+
+    def __init__(self):
+        self.matches = 0
+        self.draws = 0
+        self.turns = 0
+        self.actions = 0
+        self.seconds = 0.0
+        # Per profession: how many matches it played in and how many it won.
+        self.played = {}
+        self.wins = {}
+
+    def merge(self, other):
+        """ Adds the totals of another batch, such as one played by a worker process. """
+        self.matches += other.matches
+        self.draws += other.draws
+        self.turns += other.turns
+        self.actions += other.actions
+        for profession, played in other.played.items():
+            self.played[profession] = self.played.get(profession, 0) + played
+        for profession, won in other.wins.items():
+            self.wins[profession] = self.wins.get(profession, 0) + won
+
+    def add(self, result):
+        self.matches += 1
+        self.turns += result.turns
+        self.actions += result.actions
+        for profession in set(result.professions):
+            self.played[profession] = self.played.get(profession, 0) + 1
+        winner = result.winning_profession()
+        if winner is None:
+            self.draws += 1
+        else:
+            self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    def report(self):
+        """ Returns a summary of the batch for the terminal. """
+        rate = self.matches / self.seconds if self.seconds else 0.0
+        lines = [
+            "{} matches in {:.2f}s ({:.0f} matches/s), {} draws".format(
+                self.matches, self.seconds, rate, self.draws
+            ),
+            "{:.1f} turns and {:.1f} actions per match".format(
+                self.turns / max(self.matches, 1), self.actions / max(self.matches, 1)
+            ),
+            "{:<10} {:>8} {:>8} {:>8}".format("PROFESSION", "PLAYED", "WON", "WIN %")
+        ]
+        for profession in sorted(self.played):
+            played = self.played[profession]
+            won = self.wins.get(profession, 0)
+            lines.append("{:<10} {:>8} {:>8} {:>8.1f}".format(profession, played, won, 100.0 * won / played))
+        return "\n".join(lines)
+
+def play_batch(games, players, professions, policy, seed, max_turns):
+    """ Plays a batch of matches in this process and returns a BatchResult. """
+    rng = random.Random(seed)
+    choices = current_content().playable_professions()
+    policies = [policy] * (len(professions) if professions else players)
+    batch = BatchResult()
+    for _ in range(games):
+        lineup = professions or [rng.choice(choices) for _ in range(players)]
+        batch.add(play_match(lineup, policies, rng, max_turns))
+    return batch
+
+def play_batch_in_worker(args):
+    load_content()
+    return play_batch(*args)
+
+def run_batch(games, players=2, professions=None, policy=greedy_policy, seed=None,
+              max_turns=MAX_TURNS, processes=1):
+    """ Plays a batch of independent matches and returns a BatchResult. Each match
+        uses the given professions in order, or random ones when there are none.
+        With more than one process, the matches are split between worker processes,
+        each seeded from the given seed, and the policy must be a module level function. """
+    started = time.perf_counter()
+    if processes <= 1:
+        load_content()
+        batch = play_batch(games, players, professions, policy, seed, max_turns)
+    else:
+        rng = random.Random(seed)
+        chunks = []
+        for index in range(processes):
+            count = games // processes + (1 if index < games % processes else 0)
+            chunks.append((count, players, professions, policy, rng.getrandbits(64), max_turns))
+        batch = BatchResult()
+        with multiprocessing.Pool(processes) as pool:
+            for result in pool.imap_unordered(play_batch_in_worker, chunks):
+                batch.merge(result)
+    batch.seconds = time.perf_counter() - started
+    return batch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play Tiny-PyRPG matches headlessly.")
+    parser.add_argument("--games", type=int, default=1000, help="number of matches to play")
+    parser.add_argument("--players", type=int, default=2, help="players per match with random professions")
+    parser.add_argument("--professions", nargs="+", help="play every match with these professions")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="greedy", help="how players choose actions")
+    parser.add_argument("--seed", type=int, help="seed for a repeatable batch")
+    parser.add_argument("--max-turns", type=int, default=MAX_TURNS, help="turns before a match is a draw")
+    parser.add_argument(
+        "--processes", type=int, default=multiprocessing.cpu_count(),
+        help="worker processes to split the matches between"
+    )
+    args = parser.parse_args()
+    print(run_batch(
+        args.games, args.players, args.professions, POLICIES[args.policy], args.seed,
+        args.max_turns, args.processes
+    ).report())
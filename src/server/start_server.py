@@ -1,10 +1,20 @@
 """ This module is the starting point of a Tiny-PyRPG Server."""
-import json
+import argparse
 import socket
 import sys
 import threading
-
-from game import Game
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+
+from admission import ACCEPT_BACKLOG, ADMISSION_WORKERS, HANDSHAKE_TIMEOUT, JOIN_TIMEOUT, AdmissionStats
+from bot import add_bot
+from codec import CodecError, JSON_CODEC, Spliced, SplicedPackage, choose_codec
+from content import load_content, watch_assets
+from framing import FrameError, FramedSocket
+from logs import LEVELS, client_log, game_log, lobby_log, network_log, rooms_log, setup_logging
+from responses import CACHE_COUNTERS
+from rooms import RoomRegistry
 
 CLIENT_HANDSHAKE = "Tiny-PyRPG Client".encode()
 SERVER_HANDSHAKE = "Tiny-PyRPG Server".encode()
@@ -12,101 +22,519 @@ SERVER_HANDSHAKE = "Tiny-PyRPG Server".encode()
 HOST = ""
 PORT = 52000
 
+# How many messages may wait to be sent to a client before it is dropped for not reading them.
+OUTBOX_SIZE = 256
+
+# The types the data of a request may have, for the requests that use their data.
+REQUEST_DATA = {
+    "JOIN LOBBY": (str, dict),
+    "UPDATE PROFESSION": (str,),
+    "UPDATE READY": (bool,),
+    "ADD BOT": (str, type(None)),
+    "DO ACTION": (dict,),
+    "BATCH": (dict,)
+}
+
+# The fields of a player that belong in lobby and game packages.
+LOBBY_FIELDS = ("name", "profession", "profession_description", "ready")
+GAME_FIELDS = ("name", "profession", "hp", "ap", "mana")
+
+class ClientConnection(FramedSocket):
+    """ A framed client socket that also knows which codec the client picked
+        and, for clients that asked for deltas, which versions they hold.
+        Once the client has joined, messages are queued in an outbox and sent
+        by a writer thread, so a slow client never holds up the thread that
+        changed the game and pushed to it. """
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.codec = JSON_CODEC
+        self.deltas = False
+        self.lobby_version = None
+        self.game_version = None
+        # Pushes are built on whichever thread changed the game, so building a
+        # package against the client's versions and queueing it must not interleave.
+        self.send_lock = threading.RLock()
+        self.outbox = None
+        self.dropped = False
+        self.closed = False
+
+    def start_writer(self):
+        """ Queues every message from now on, for a thread of this connection's own to send. """
+        self.outbox = Queue(OUTBOX_SIZE)
+        writer = threading.Thread(target=self.write_outbox, name="writer")
+        writer.daemon = True
+        writer.start()
+
+    def write_outbox(self):
+        # Replies, pushes, and the shutdown and close after them, go out in the order they were queued.
+        while True:
+            kind, value = self.outbox.get()
+            if kind == "close":
+                super().close()
+                return
+            try:
+                if kind == "send":
+                    super().send(value)
+                else:
+                    super().shutdown(value)
+            except OSError:
+                # The client is gone. Its thread notices and closes the connection.
+                pass
+
+    def post(self, kind, value=None):
+        # Queues a message for the writer thread. Returns False if there is no writer yet.
+        if self.outbox is None:
+            return False
+        try:
+            self.outbox.put_nowait((kind, value))
+        except Full:
+            # The client has stopped reading. Cutting it off wakes its thread, which cleans up,
+            # and makes the writer's sends fail fast so the close below gets a place in the queue.
+            if not self.dropped:
+                network_log.warning("Dropping a client that has %s messages waiting.", OUTBOX_SIZE)
+                self.dropped = True
+            super().shutdown(socket.SHUT_RDWR)
+            if kind == "close":
+                self.outbox.put((kind, value))
+        return True
+
+    def send(self, payload):
+        with self.send_lock:
+            if not self.post("send", payload):
+                super().send(payload)
+
+    def shutdown(self, how):
+        if not self.post("shutdown", how):
+            super().shutdown(how)
+
+    def close(self):
+        # Only the first close is queued, since the writer thread stops once it has closed the socket.
+        if self.closed:
+            return
+        self.closed = True
+        if not self.post("close"):
+            super().close()
+
+    def send_package(self, spkg):
+        self.send(self.codec.encode(spkg))
+
+    def recv(self, deadline=None):
+        """ Blocks until a whole message has arrived and returns it, or None once the
+            client has gone away. Given a deadline from time.monotonic(), raises
+            socket.timeout if the message has not fully arrived by then. """
+        if deadline is None:
+            try:
+                return super().recv()
+            except OSError:
+                # The socket was shut down or closed while waiting, which is the same as the client leaving.
+                return None
+        while True:
+            payload = self.buffer.next_frame()
+            if payload is not None:
+                return payload
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("deadline passed")
+            self.sock.settimeout(remaining)
+            if not self.buffer.read_from(self.sock):
+                return None
+
+    def recv_package(self, deadline=None):
+        """ Returns the next request, or None once the client has gone away. """
+        data = self.recv(deadline)
+        if data is None:
+            return None
+        return check_request(self.codec.decode(data))
+
+def answer_handshake(conn, data):
+    """ Checks a client's handshake and answers it. A client may follow the
+        handshake with a newline and the codecs it supports, in which case the
+        server picks one and names it in its reply. Returns False if the
+        client is not a Tiny-PyRPG Client. """
+    handshake, _, offer = data.partition(b"\n")
+    if handshake != CLIENT_HANDSHAKE:
+        return False
+    if not offer:
+        conn.send(SERVER_HANDSHAKE)
+        return True
+    conn.codec = choose_codec(offer.decode(errors="replace"))
+    conn.send(SERVER_HANDSHAKE + b"\n" + conn.codec.name.encode())
+    return True
+
 def send_client_error(conn, msg):
     """ Sends the client a specific error message. """
     spkg = {}
     spkg["response"] = "ERROR"
     spkg["data"] = msg
-    print(json.dumps(spkg, indent=4))
-    spkg = json.dumps(spkg).encode()
-    conn.sendall(spkg)
+    client_log.debug("Sending error %s.", msg)
+    conn.send_package(spkg)
+
+def is_action(item):
+    """ Whether a DO ACTION request's data, or an item of a batch, names an action and a target player. """
+    return isinstance(item, dict) and isinstance(item.get("action"), str) and type(item.get("target")) is int
+
+def check_request(cpkg):
+    """ Returns a decoded package if it has the shape of a request, which is a dict
+        naming the request and holding data of the types that request takes.
+        Raises ValueError otherwise, so the handlers can trust what they index. """
+    if type(cpkg) is not dict or not isinstance(cpkg.get("request"), str) or "data" not in cpkg:
+        raise ValueError("not a request")
+    request = cpkg["request"]
+    data = cpkg["data"]
+    if not isinstance(data, REQUEST_DATA.get(request, object)):
+        raise ValueError("invalid data for {}".format(request))
+    if request == "JOIN LOBBY" and isinstance(data, dict):
+        room = data.get("room")
+        if not isinstance(data.get("name"), str) or not (room is None or type(room) is int):
+            raise ValueError("invalid data for {}".format(request))
+    elif request == "DO ACTION" and not is_action(data):
+        raise ValueError("invalid data for {}".format(request))
+    elif request == "BATCH":
+        actions = data.get("actions", [])
+        if type(actions) is not list or not all(is_action(item) for item in actions):
+            raise ValueError("invalid data for {}".format(request))
+        if not isinstance(data.get("end-turn", False), bool):
+            raise ValueError("invalid data for {}".format(request))
+    return cpkg
+
+def recv_request(conn, name):
+    """ Returns the client's next request, or None once they have gone away.
+        A message that cannot be decoded, such as an empty one, or that is not
+        shaped like a request, is answered with an error and skipped. """
+    while True:
+        try:
+            return conn.recv_package()
+        except (CodecError, ValueError):
+            client_log.warning("%s: sent a message that is not a valid request.", name)
+            send_client_error(conn, "INVALID REQUEST")
 
-def send_client_lobby(conn, name, game, response="LOBBY DATA"):
-    """ Sends the client the current state of the lobby. """
+def pick_fields(changes, fields):
+    """ Returns the given fields of each player slot that has changed. """
+    players = {}
+    for key, changed in changes.items():
+        if key == "game":
+            continue
+        picked = {}
+        for field in fields:
+            if field in changed:
+                picked[field] = changed[field]
+        if picked:
+            players[key] = picked
+    return players
+
+def shared_items(conn, game, kind):
+    """ Returns the lobby or game, whichever kind names, encoded with the client's
+        codec. It is the same for every player, so it comes from the game's response
+        cache and is only encoded once for each version of the game. """
+    key = (kind, conn.codec.name)
+    items = game.response_cache.get(key)
+    if items is None:
+        if kind == "lobby":
+            version, body = game.get_lobby_snapshot()
+        else:
+            version, body = game.get_game_snapshot()
+        items = conn.codec.encode_items(body)
+        game.response_cache.put(key, version, items)
+    return items
+
+def lobby_package(conn, name, game, response="LOBBY DATA"):
+    """ Builds a package holding the state of the lobby. Clients that asked for
+        deltas only get what changed since the last lobby they were sent. """
     spkg = {}
     spkg["response"] = response
     data = {}
     pnum = game.get_player_number(name) + 1
+    data["room"] = game.room_id
     data["player-number"] = pnum
-    data["lobby"] = game.get_lobby_dict()
+    if conn.deltas:
+        version, changes = game.get_changes(conn.lobby_version)
+        data["version"] = version
+        conn.lobby_version = version
+        if changes is not None and response == "LOBBY DATA":
+            spkg["response"] = "LOBBY DELTA"
+            data["lobby"] = pick_fields(changes, LOBBY_FIELDS)
+            spkg["data"] = data
+            return spkg
+    data["lobby"] = Spliced(shared_items(conn, game, "lobby"))
     spkg["data"] = data
-    spkg = json.dumps(spkg).encode()
-    conn.sendall(spkg)
+    return SplicedPackage(spkg)
 
-def send_client_game(conn, name, game, response="GAME DATA"):
-    """ Sends the client the current state of the game. """
+def game_package(conn, name, game, response="GAME DATA"):
+    """ Builds a package holding the state of the game. Clients that asked for
+        deltas only get what changed since the last game they were sent. """
     spkg = {}
     spkg["response"] = response
     pnum = game.get_player_number(name) + 1
     data = {}
-    game_dict = game.get_game_dict()
+    if conn.deltas:
+        version, changes = game.get_changes(conn.game_version)
+        data["version"] = version
+        conn.game_version = version
+        if changes is not None and response == "GAME DATA":
+            spkg["response"] = "GAME DELTA"
+            game_dict = {}
+            game_dict.update(changes.get("game", {}))
+            game_dict["players"] = pick_fields(changes, GAME_FIELDS)
+            game_dict["player-number"] = pnum
+            own = changes.get("p{}".format(pnum), {})
+            if "actions" in own:
+                data["actions"] = own["actions"]
+            data["game"] = game_dict
+            spkg["data"] = data
+            return spkg
+    # Only the player number and actions differ between players, so the rest is spliced in.
+    game_dict = Spliced(shared_items(conn, game, "game"))
     game_dict["player-number"] = pnum
     data["actions"] = game.get_player_actions(name)
     data["game"] = game_dict
     spkg["data"] = data
-    spkg = json.dumps(spkg).encode()
-    conn.sendall(spkg)
+    return SplicedPackage(spkg)
 
-def send_client_end_game(conn, won="YOU LOSE"):
-    """ Sends the client an end game response. """
+def end_game_package(won="YOU LOSE"):
+    """ Builds an end game package. """
     spkg = {}
     spkg["response"] = "END GAME"
     spkg["data"] = won
-    spkg = json.dumps(spkg).encode()
-    conn.sendall(spkg)
+    return spkg
+
+def send_client_lobby(conn, name, game, response="LOBBY DATA"):
+    """ Sends the client the current state of the lobby. """
+    with conn.send_lock:
+        conn.send_package(lobby_package(conn, name, game, response))
+
+def send_client_game(conn, name, game, response="GAME DATA"):
+    """ Sends the client the current state of the game. """
+    with conn.send_lock:
+        conn.send_package(game_package(conn, name, game, response))
+
+def send_client_end_game(conn, won="YOU LOSE"):
+    """ Sends the client an end game response. """
+    conn.send_package(end_game_package(won))
     conn.shutdown(socket.SHUT_RDWR)
     conn.close()
 
-def process_lobby_request(conn, name, game):
-    """ This method is used to process requests while in the lobby. """
+def push_update(conn, name, game):
+    """ Pushes the latest lobby or game to a subscribed client, wrapped in a PUSH
+        response so the client can tell it apart from the answer to a request.
+        A player who has died, or whose game has ended, is told the game is over
+        and disconnected. """
+    try:
+        with conn.send_lock:
+            if game.in_lobby:
+                package = lobby_package(conn, name, game)
+            elif not game.in_game or game.get_player_status(name) == -1:
+                game.unsubscribe(name)
+                # Only the last player standing is still alive once the game ends.
+                won = "YOU LOSE"
+                if game.get_player_status(name) != -1:
+                    won = "YOU WIN"
+                spkg = {}
+                spkg["response"] = "PUSH"
+                spkg["data"] = end_game_package(won)
+                conn.send_package(spkg)
+                # The client's own thread sees the connection end and closes it.
+                conn.shutdown(socket.SHUT_RDWR)
+                return
+            else:
+                package = game_package(conn, name, game)
+            # The push is a SplicedPackage whenever the package it wraps is one.
+            spkg = type(package)()
+            spkg["response"] = "PUSH"
+            spkg["data"] = package
+            conn.send_package(spkg)
+    except OSError:
+        # The client is gone; its own handler will notice and clean up.
+        game.unsubscribe(name)
+
+def subscribe_client(conn, name, game):
+    """ Signs the client up to be pushed every change to the game. """
+    game.subscribe(name, lambda game: push_update(conn, name, game))
+
+def sync_client(conn):
+    """ Switches the client over to deltas. Forgetting the versions it holds
+        means the next lobby or game it is sent will be a full snapshot. """
+    with conn.send_lock:
+        conn.deltas = True
+        conn.lobby_version = None
+        conn.game_version = None
+
+def process_lobby_request(conn, name, game, cpkg):
+    """ This method is used to process requests while in the lobby.
+        Returns 1 when the client has moved into the game, -1 when the client
+        has left and 0 otherwise. """
+
+    valid_commands = [
+        "ADD BOT",
+        "EXIT",
+        "GET UPDATE",
+        "SUBSCRIBE",
+        "SYNC",
+        "UPDATE PROFESSION",
+        "UPDATE READY",
+        "TRY START"
+    ]
+
+    # After hearing the request, if the game has started, reply as such and move into the game.
+    if game.in_game:
+        client_log.debug("%s: was in lobby when a game was already running.", name)
+        send_client_game(conn, name, game, "GAME START")
+        return 1
+
+    request = cpkg["request"]
+    data = cpkg["data"]
+
+    # If the request was to exit the lobby, remove the player from the lobby and stop talking.
+    if request == "EXIT":
+        client_log.debug("%s: is exiting the lobby.", name)
+        game.remove_player(name)
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        return -1
+
+    # If the request is to get an update, send the client the lobby.
+    if request == "GET UPDATE":
+        client_log.debug("%s: is getting an updated lobby.", name)
+        send_client_lobby(conn, name, game)
+
+    # If the request is to subscribe, push the client every change from now on and send the lobby.
+    if request == "SUBSCRIBE":
+        client_log.debug("%s: subscribed to lobby updates.", name)
+        subscribe_client(conn, name, game)
+        send_client_lobby(conn, name, game)
+
+    # If the request is to sync, send a full lobby and only send what has changed from then on.
+    if request == "SYNC":
+        client_log.debug("%s: is syncing the lobby.", name)
+        sync_client(conn)
+        send_client_lobby(conn, name, game)
+
+    # If the request is to update the clients profession, do that and send back the lobby.
+    if request == "UPDATE PROFESSION":
+        # A profession the game does not have is an invalid request.
+        if data not in game.content.professions:
+            client_log.warning("%s: asked for a profession that does not exist.", name)
+            send_client_error(conn, "INVALID REQUEST")
+        else:
+            client_log.debug("%s: has updated their profession to %s.", name, data)
+            game.set_player_profession(name, data)
+            client_log.debug("%s: is getting an updated lobby.", name)
+            send_client_lobby(conn, name, game)
+
+    # If the request is to update the client's ready state, do that and send back the lobby.
+    if request == "UPDATE READY":
+        client_log.debug("%s: has updated their ready state to %s.", name, data)
+        game.set_player_ready(name, data)
+        client_log.debug("%s: is getting an updated lobby.", name)
+        send_client_lobby(conn, name, game)
+
+    # If the request is to add a bot, fill a free slot with one and send back the lobby.
+    # The data may name the bot's profession, otherwise it picks one at random.
+    if request == "ADD BOT":
+        client_log.debug("%s: is adding a bot.", name)
+        bot_name = add_bot(game, data)
+        if bot_name is None:
+            send_client_error(conn, "LOBBY FULL")
+        else:
+            lobby_log.info("%s added %s to room %s.", name, bot_name, game.room_id)
+            send_client_lobby(conn, name, game)
+
+    # If the request is to try and start the game...
+    if request == "TRY START":
+        client_log.debug("%s: is trying to start the game.", name)
+        # Make sure all players are ready...
+        if game.try_start(name):
+            # And if the game was started, send the client the game and move to the game.
+            client_log.debug("%s: tried to start the game and all players were ready.", name)
+            send_client_game(conn, name, game, "GAME START")
+            return 1
+        # Otherwise send the client the lobby.
+        client_log.debug("%s: tried to start the game but not all players were ready.", name)
+        send_client_lobby(conn, name, game)
+
+    # If we don't know what the request is, send the client an error.
+    if request not in valid_commands:
+        client_log.warning("%s: sent an invalid request.", name)
+        send_client_error(conn, "INVALID REQUEST")
 
-    
+    return 0
 
 def client_do_action(conn, name, game, data, status):
     """ This method is to break apart the DO ACTION request from
         the main, overloaded game request method. """
-    print("{}: is trying to perform the {} action.".format(name, data["action"]))
+    client_log.debug("%s: is trying to perform the %s action.", name, data["action"])
 
     # If it is not the player's turn, they cannot do an action.
     if status == -2:
-        print("{}: tried to perform an action when it wasn't their turn.".format(name))
+        client_log.debug("%s: tried to perform an action when it wasn't their turn.", name)
         send_client_error(conn, "NOT PLAYER TURN")
     # Otherwise, see what action they want to perform.
     else:
         action = data["action"]
         target = data["target"]
-        target = int(target)
         # Try to have them perform the action.
         result = game.try_action(name, target, action)
         # If they don't have enough AP, tell them such.
         if result == -1:
-            print("{}: did not have enough AP to perform this action.".format(name))
+            client_log.debug("%s: did not have enough AP to perform this action.", name)
             send_client_error(conn, "NOT ENOUGH AP")
         # If they don't have enough mana, tell them such.
         elif result == -2:
-            print("{}: did not have enough mana to perform this action.".format(name))
+            client_log.debug("%s: did not have enough mana to perform this action.", name)
             send_client_error(conn, "NOT ENOUGH MANA")
+        # If there is no such action or target, the request was invalid.
+        elif result == -4:
+            client_log.debug("%s: asked for an action or target that does not exist.", name)
+            send_client_error(conn, "INVALID REQUEST")
         # Otherwise, they performed the action.
         else:
-            print("{}: performed the action.".format(name))
-            print("{}: is getting an updated game.".format(name))
+            client_log.debug("%s: performed the action.", name)
+            client_log.debug("%s: is getting an updated game.", name)
             send_client_game(conn, name, game)
 
-def process_game_request(conn, name, game):
+# What each of Game.try_batch's results means to the client.
+BATCH_RESULTS = {
+    0: "OK",
+    -1: "NOT ENOUGH AP",
+    -2: "NOT ENOUGH MANA",
+    -3: "NOT PLAYER TURN",
+    -4: "INVALID REQUEST"
+}
+
+def client_do_batch(conn, name, game, data):
+    """ This method handles the BATCH request, which carries a list of actions and
+        whether to end the turn after them, so a whole turn costs one round trip.
+        The client gets back one game package holding a result for each item. """
+    client_log.debug("%s: is trying to perform a batch of actions.", name)
+    actions = [(item["target"], item["action"]) for item in data.get("actions", [])]
+    end_turn = data.get("end-turn", False)
+    results = game.try_batch(name, actions, end_turn)
+    # If ending the turn ended the game, the client won.
+    if end_turn and results[-1] == -1:
+        game_log.info("%s won the game!", name)
+        send_client_end_game(conn, "YOU WIN")
+        return -1
+    with conn.send_lock:
+        spkg = game_package(conn, name, game)
+        spkg["data"]["results"] = [BATCH_RESULTS[result] for result in results]
+        conn.send_package(spkg)
+    return 0
+
+def process_game_request(conn, name, game, cpkg):
     """ This method is used to process a request while in the game. """
 
     valid_commands = [
         "GET UPDATE",
+        "SUBSCRIBE",
+        "SYNC",
         "DO ACTION",
+        "BATCH",
         "END TURN"
     ]
 
-    # Listen for the request.
-    cpkg = json.loads(conn.recv(4096).decode())
-
     # If the game has ended not on the client's turn, then they must have lost.
     if not game.in_game:
-        print("{}: was in game but the game has ended.")
+        client_log.debug("%s: was in game but the game has ended.", name)
         send_client_end_game(conn)
         return -1
 
@@ -115,203 +543,325 @@ def process_game_request(conn, name, game):
 
     # Check the status of the player, and if they died, then they have lost.
     status = game.get_player_status(name)
-    print("{}: has the status of {}.".format(name, status))
+    client_log.debug("%s: has the status of %s.", name, status)
     if status == -1:
-        print("{}: died and is leaving the game.".format(name))
+        game_log.info("%s: died and is leaving the game.", name)
         send_client_end_game(conn)
         return -1
 
     # If the request is to get an update, send them the game.
     if request == "GET UPDATE":
-        print("{}: is getting an updated game.".format(name))
+        client_log.debug("%s: is getting an updated game.", name)
+        send_client_game(conn, name, game)
+
+    # If the request is to subscribe, push the client every change from now on and send the game.
+    if request == "SUBSCRIBE":
+        client_log.debug("%s: subscribed to game updates.", name)
+        subscribe_client(conn, name, game)
+        send_client_game(conn, name, game)
+
+    # If the request is to sync, send a full game and only send what has changed from then on.
+    if request == "SYNC":
+        client_log.debug("%s: is syncing the game.", name)
+        sync_client(conn)
         send_client_game(conn, name, game)
 
     # If the request is to do an action, try it.
     if request == "DO ACTION":
         client_do_action(conn, name, game, data, status)
 
+    # If the request is a batch of actions, try them all at once.
+    if request == "BATCH":
+        if client_do_batch(conn, name, game, data) == -1:
+            return -1
+
     # If the request is to end their turn...
     if request == "END TURN":
-        print("{}: is trying to end their turn.".format(name))
+        client_log.debug("%s: is trying to end their turn.", name)
 
         # But is isn't their turn...
-        if status == -1:
+        if status == -2:
             # Tell them such.
-            print("{}: tried to end their turn when it wasn't their turn.".format(name))
+            client_log.debug("%s: tried to end their turn when it wasn't their turn.", name)
             send_client_error(conn, "NOT PLAYER TURN")
 
         # Otherwise, end the turn and cycle turns.
         else:
-            print("CLIENT: cycling turns.")
+            client_log.debug("cycling turns.")
             result = game.cycle_turn()
             # If there are multiple clients remaining, update the game.
             if result == 0:
-                print("CLIENT: {} is getting an updated game.".format(name))
+                client_log.debug("%s is getting an updated game.", name)
                 send_client_game(conn, name, game)
             # Otherwise the client won and the game ends.
             elif result == -1:
-                print("CLIENT: {} won the game!".format(name))
+                game_log.info("%s won the game!", name)
                 send_client_end_game(conn, "YOU WIN")
                 return -1
 
     if request not in valid_commands:
-        print("CLIENT: {} sent an invalid request.".format(name))
+        client_log.warning("%s sent an invalid request.", name)
         send_client_error(conn, "INVALID REQUEST")
 
     return 0
 
-def client_thread(conn, name, game):
+def client_thread(conn, name, game, rooms):
     """ This method is designed to run in a separate thread meant to handle
         the connection with a single client instance. """
 
-    print("CLIENT: Starting client threading.Thread for {}.".format(name))
+    client_log.debug("Starting client threading.Thread for %s.", name)
+    conn.start_writer()
+    try:
+        serve_client(conn, name, game)
+    finally:
+        # However the client left, even on a request that broke a handler, free
+        # its slot, have the writer thread close the socket, and close the room
+        # if this was the last client in it.
+        leave_room(conn, name, game, rooms)
+
+def serve_client(conn, name, game):
+    """ Answers a client's lobby requests, and then its game requests, until they
+        leave or the game ends. """
     # Process lobby requests until the game starts.
     while True:
-        valid_commands = [
-            "EXIT",
-            "GET UPDATE",
-            "UPDATE PROFESSION",
-            "UPDATE READY",
-            "TRY START"
-        ]
-
         # To process a request, one must first hear the request.
-        cpkg = json.loads(conn.recv(4096).decode())
-
-        # After hearing the request, if the game has started, reply as such and move into the game.
-        if game.in_game:
-            print("{}: was in lobby when a game was already running.".format(name))
-            send_client_game(conn, name, game, "GAME START")
-            break
-
-        request = cpkg["request"]
-        data = cpkg["data"]
-
-        # If the request was to exit the lobby, remove the player from the lobby and stop talking.
-        if request == "EXIT":
-            print("{}: is exiting the lobby.".format(name))
-            game.remove_player(name)
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+        cpkg = recv_request(conn, name)
+        if cpkg is None:
+            client_log.info("%s: disconnected from the lobby.", name)
             return
+        result = process_lobby_request(conn, name, game, cpkg)
+        if result == -1:
+            return
+        if result == 1:
+            break
 
-        # If the request is to get an update, send the client the lobby.
-        if request == "GET UPDATE":
-            print("{}: is getting an updated lobby.".format(name))
-            send_client_lobby(conn, name, game)
-
-        # If the request is to update the clients profession, do that and send back the lobby.
-        if request == "UPDATE PROFESSION":
-            print("{}: has updated their profession to {}.".format(name, data))
-            game.set_player_profession(name, data)
-            print("{}: is getting an updated lobby.".format(name))
-            send_client_lobby(conn, name, game)
-
-        # If the request is to update the client's ready state, do that and send back the lobby.
-        if request == "UPDATE READY":
-            print("{}: has updated their ready state to {}.".format(name, data))
-            game.set_player_ready(name, data)
-            print("{}: is getting an updated lobby.".format(name))
-            send_client_lobby(conn, name, game)
-
-        # If the request is to try and start the game...
-        if request == "TRY START":
-            print("{}: is trying to start the game.".format(name))
-            # Make sure all players are ready...
-            if game.try_start():
-                # And if the game was started, send the client the game and move to the game.
-                print("{}: tried to start the game and all players were ready.".format(name))
-                send_client_game(conn, name, game, "GAME START")
-                break
-            # Otherwise send the client the lobby.
-            print("{}: tried to start the game but not all players were ready.".format(name))
-            send_client_lobby(conn, name, game)
-
-        # If we don't know what the request is, send the client an error.
-        if request not in valid_commands :
-            print("{}: sent an invalid request.".format(name))
-            send_client_error(conn, "INVALID REQUEST")
-        continue
-
-    print("CLIENT: {} has entered the game sequence.".format(name))
+    client_log.info("%s has entered the game sequence.", name)
     # Process game requests until the game ends.
     while True:
-        if process_game_request(conn, name, game) == -1:
-            break
-
-def start_listener(game):
-    """ This method is designed to be used in a separate thread from the main program.
-        It listens for incoming connections and joins players to the game. """
+        cpkg = recv_request(conn, name)
+        if cpkg is None:
+            client_log.info("%s: disconnected from the game.", name)
+            return
+        if process_game_request(conn, name, game, cpkg) == -1:
+            return
 
-    # First, a socket is created and bound to all interfaces on a specific port.
-    print("NETWORK: Starting listener.")
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.bind((HOST, PORT))
-    listener.listen(6)
+def leave_room(conn, name, game, rooms):
+    """ Cleans up after a client that has stopped being served. """
+    # If the client left while still in the lobby, free up their lobby slot.
+    if game.in_lobby:
+        game.remove_player(name)
+    game.unsubscribe(name)
+    conn.close()
+    # The last client out of a room closes it, even if the game is still going.
+    game.disconnect_player(name)
+    if rooms.close_room_if_done(game):
+        rooms_log.info("Closed room %s.", game.room_id)
+
+def process_room_request(conn, rooms, cpkg):
+    """ This method handles the requests a new client may make before joining a lobby.
+        Returns True if the request was one of them. """
+    request = cpkg["request"]
 
-    while game.in_lobby:
-        # While the game is in lobby, accept new connections and try to join them to the game.
-        conn, addr = listener.accept()
-        print("NETWORK: Accepted connection from {}.".format(addr))
-        data = conn.recv(4096)
-        # If the incoming client does not validate as a Tiny-PyRPG Client, close the connection.
-        if data != CLIENT_HANDSHAKE:
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
-            continue
-        conn.sendall(SERVER_HANDSHAKE)
-        # The client's first request should be to join the lobby.
-        cpkg = json.loads(conn.recv(4096).decode())
-        request = cpkg["request"]
-        data = cpkg["data"]
-        # If the client does not, then it is an invalid request and the connection is closed.
-        if request != "JOIN LOBBY":
-            send_client_error(conn, "INVALID REQUEST")
+    # If the request is to list the rooms, send the client a summary of each one.
+    if request == "LIST ROOMS":
+        spkg = {}
+        spkg["response"] = "ROOM LIST"
+        spkg["data"] = rooms.list_rooms()
+        conn.send_package(spkg)
+        return True
+
+    # If the request is to create a room, do that and send the client its id so they can join it.
+    if request == "CREATE ROOM":
+        game = rooms.create_room()
+        rooms_log.info("Created room %s.", game.room_id)
+        spkg = {}
+        spkg["response"] = "ROOM CREATED"
+        spkg["data"] = game.room_id
+        conn.send_package(spkg)
+        return True
+
+    return False
+
+def admit_player(conn, addr, rooms, cpkg):
+    """ This method handles a new client's JOIN LOBBY request. Returns the name the
+        client joined as and their game, or None if the connection was refused and closed. """
+    request = cpkg["request"]
+    data = cpkg["data"]
+    # If the first request is not to join the lobby, then it is invalid and the connection is closed.
+    if request != "JOIN LOBBY":
+        send_client_error(conn, "INVALID REQUEST")
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        return None
+    # If the request is to join the lobby, then the "data" key should lead to their username,
+    # or to their username and the room they want to join.
+    if isinstance(data, dict):
+        name = data.get("name")
+        game = rooms.get_room(data.get("room"))
+        if game is None:
+            lobby_log.warning("Client at %s tried to join a room that does not exist.", addr)
+            send_client_error(conn, "NO SUCH ROOM")
             conn.shutdown(socket.SHUT_RDWR)
             conn.close()
-            continue
-        # If the request is to join the lobby, then the "data" key should lead to their username.
-        name = data
-        print("NETWORK: Valid client connected as {}.".format(name))
+            return None
+        network_log.debug("Valid client connected as %s.", name)
         # We then try to add the player to the game.
         result = game.add_player(name)
-        # If the result of this action is -1, then the lobby is full and the connection is closed.
-        if result == -1:
-            print("ERROR: Client at {} tried to join, but the lobby was full.".format(addr))
-            send_client_error(conn, "LOBBY FULL")
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
-            continue
-        # If the result of this action is -2, then someone with that username has already joined
-        # and the connection is closed.
-        if result == -2:
-            print(
-                "ERROR: Client at {} tried to join as {}, but the name was already taken."
-                .format(addr, name)
-            )
-            send_client_error(conn, "NAME TAKEN")
+    # Without a room, they are put in the first lobby with a free slot, in the same step as finding it.
+    else:
+        name = data
+        network_log.debug("Valid client connected as %s.", name)
+        game, result = rooms.join_open_room(name)
+    # A lobby that has already begun its match cannot be joined.
+    if result == -3:
+        lobby_log.warning("Client at %s tried to join, but the game had started.", addr)
+        send_client_error(conn, "GAME STARTED")
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        return None
+    # If the result of this action is -1, then the lobby is full and the connection is closed.
+    if result == -1:
+        lobby_log.warning("Client at %s tried to join, but the lobby was full.", addr)
+        send_client_error(conn, "LOBBY FULL")
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        return None
+    # If the result of this action is -2, then someone with that username has already joined
+    # and the connection is closed.
+    if result == -2:
+        lobby_log.warning("Client at %s tried to join as %s, but the name was already taken.", addr, name)
+        send_client_error(conn, "NAME TAKEN")
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        return None
+    # Finally, if there is not error with the action, the player was successfully joined.
+    lobby_log.info("Player %s joined room %s from connection %s.", name, game.room_id, addr)
+    send_client_lobby(conn, name, game, "JOIN ACCEPT")
+    return name, game
+
+def read_join_request(conn, addr, stats, accepted, process_rooms):
+    """ This method takes a newly accepted client through the handshake and any room
+        requests, with a deadline on each. process_rooms answers a room request and
+        returns True if it was one. Returns the client's next request, which should
+        be to join a lobby, or None if the client was dropped. """
+    started = time.monotonic()
+    stats.record("queue", started - accepted)
+    stage = "handshake"
+    try:
+        data = conn.recv(started + HANDSHAKE_TIMEOUT)
+        # If the incoming client does not validate as a Tiny-PyRPG Client, close the connection.
+        if data is None or not answer_handshake(conn, data):
             conn.shutdown(socket.SHUT_RDWR)
             conn.close()
-            continue
-        # Finally, if there is not error with the action, the player was successfully joined
-        # and a client thread is created to handle client-server communication from here.
-        print("LOBBY: Player {} joined the lobby from connection {}.".format(name, addr))
-        send_client_lobby(conn, name, game, "JOIN ACCEPT")
-        c_thread = threading.Thread(target=client_thread, args=(conn, name, game))
-        c_thread.daemon = True
-        c_thread.start()
-        continue
-
-def start_server():
-    """ This method creates a game and an accompanying listener. """
-    game = Game()
-    listening_thread = threading.Thread(target=start_listener, args=(game,))
+            return None
+        handshaken = time.monotonic()
+        stats.record(stage, handshaken - started)
+        # The client may look at or create rooms, and then its request should be to join a lobby.
+        stage = "rooms"
+        while True:
+            cpkg = conn.recv_package(handshaken + JOIN_TIMEOUT)
+            if cpkg is None or not process_rooms(conn, cpkg):
+                break
+    except socket.timeout:
+        network_log.warning("Dropped %s, which did not finish the %s stage in time.", addr, stage)
+        stats.timed_out(stage)
+        cpkg = None
+    except (OSError, FrameError, CodecError, ValueError):
+        network_log.warning("Dropped %s, which sent an invalid %s message.", addr, stage)
+        cpkg = None
+    if cpkg is None:
+        conn.close()
+        return None
+    stats.record(stage, time.monotonic() - handshaken)
+    # The client's requests from here on have no deadline.
+    conn.settimeout(None)
+    return cpkg
+
+def admit_client(conn, addr, rooms, stats, accepted):
+    """ This method is run on an admission thread for each accepted connection.
+        It joins the client to a lobby and then starts their client thread. """
+    cpkg = read_join_request(
+        conn, addr, stats, accepted, lambda conn, cpkg: process_room_request(conn, rooms, cpkg)
+    )
+    if cpkg is None:
+        return
+    started = time.monotonic()
+    joined = admit_player(conn, addr, rooms, cpkg)
+    stats.record("join", time.monotonic() - started)
+    if joined is None:
+        return
+    name, game = joined
+    # A client thread is created to handle client-server communication from here.
+    c_thread = threading.Thread(target=client_thread, args=(conn, name, game, rooms))
+    c_thread.daemon = True
+    c_thread.start()
+
+def start_listener(rooms, stats):
+    """ This method is designed to be used in a separate thread from the main program.
+        It accepts incoming connections and hands each one to an admission thread,
+        so a slow client never holds up the next one being accepted. """
+
+    # First, a socket is created and bound to all interfaces on a specific port.
+    network_log.info("Starting listener.")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, PORT))
+    listener.listen(ACCEPT_BACKLOG)
+    admission = ThreadPoolExecutor(max_workers=ADMISSION_WORKERS, thread_name_prefix="admission")
+
+    while True:
+        sock, addr = listener.accept()
+        network_log.debug("Accepted connection from %s.", addr)
+        admission.submit(admit_client, ClientConnection(sock), addr, rooms, stats, time.monotonic())
+
+def start_server(use_asyncio=False, shards=1, log_level="INFO", watch=False):
+    """ This method creates a room registry and an accompanying listener. """
+    setup_logging(log_level)
+    # The content is loaded once, up front, so creating a room does no I/O.
+    load_content()
+    if watch and shards <= 1:
+        watch_assets()
+    rooms = RoomRegistry()
+    stats = AdmissionStats()
+    listener = start_listener
+    args = (rooms, stats)
+    # In asyncio mode, one event loop thread serves every client instead of a thread per client.
+    if use_asyncio:
+        from async_server import start_async_listener
+        listener = start_async_listener
+    # With several shards, worker processes own the rooms and this process only routes clients.
+    if shards > 1:
+        from shard import ShardedListener
+        listener = ShardedListener(shards, use_asyncio, log_level, watch).listen
+        args = (stats,)
+    listening_thread = threading.Thread(target=listener, args=args)
     listening_thread.daemon = True
     listening_thread.start()
     while True:
-        cmd = input("Type EXIT to stop: ")
-        if cmd.strip().upper() == "EXIT":
+        cmd = input("Type STATS for admission timings or EXIT to stop: ").strip().upper()
+        if cmd == "EXIT":
             sys.exit(0)
+        if cmd == "STATS":
+            print(stats.report())
+            print(CACHE_COUNTERS.report())
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Start a Tiny-PyRPG Server.")
+    parser.add_argument(
+        "--async", dest="use_asyncio", action="store_true",
+        help="serve every client from a single asyncio event loop"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="number of worker processes to spread rooms over"
+    )
+    parser.add_argument(
+        "--log-level", type=str.upper, choices=LEVELS, default="INFO",
+        help="the least severe log messages to write out"
+    )
+    parser.add_argument(
+        "--watch-assets", action="store_true",
+        help="reload changed profession and action files for new rooms while running"
+    )
+    args = parser.parse_args()
+    start_server(args.use_asyncio, args.shards, args.log_level, args.watch_assets)
@@ -0,0 +1,85 @@
+""" This module keeps track of the status effects on a player.
+    Statuses from an action definition are shared by every player, so they are
+    never changed. Instead each application is recorded as a small tuple
+    along with the ticks it starts and ends on. Identical statuses that start
+    and end on the same ticks are stacked into one record with a count, and
+    records are dropped in order of expiry through a heap. A tick only touches
+    the records that are still active, no matter how many statuses have come
+    and gone. """
+from heapq import heappop, heappush
+
+class StatusEngine:
+    """ The active statuses on one player. Each record is keyed by
+        (attribute, change, duration_delta, start tick, last tick) and maps to
+        how many identical statuses it stands for. A status applies its change
+        on each of the next duration ticks, and the size of its change shrinks
+        towards zero by duration_delta after every tick. """
+    __slots__ = ("tick", "stacks", "expiries")
+
+    def __init__(self):
+        self.tick = 0
+        self.stacks = {}
+        # A heap of (last tick, key), so expired records are found without a scan.
+        self.expiries = []
+
+    def __len__(self):
+        return sum(self.stacks.values())
+
+    def add(self, status):
+        modifier = status.modifier
+        change = modifier.change
+        delta = status.duration_delta
+        ticks = status.duration
+        # A shrinking change stops mattering once it reaches zero.
+        if delta > 0:
+            ticks = min(ticks, -(-abs(change) // delta))
+        if ticks <= 0 or not change:
+            return
+        # The last tick is part of the key, so statuses that only differ in how long
+        # they last are kept apart and each expires on time.
+        end = self.tick + ticks
+        key = (modifier.attribute, change, delta, self.tick, end)
+        count = self.stacks.get(key)
+        if count is None:
+            self.stacks[key] = 1
+            heappush(self.expiries, (end, key))
+        else:
+            self.stacks[key] = count + 1
+
+    def add_all(self, statuses):
+        for status in statuses:
+            self.add(status)
+
+    def process(self, attributes):
+        """ Advances one tick, applying every active status to the attributes
+            and then dropping those that have run their course. """
+        self.tick += 1
+        tick = self.tick
+        totals = {}
+        for (attribute, change, delta, start, _), count in self.stacks.items():
+            if delta:
+                size = abs(change) - delta * (tick - start - 1)
+                change = size if change > 0 else -size
+            totals[attribute] = totals.get(attribute, 0) + change * count
+        for attribute, total in totals.items():
+            value = attributes[attribute] - total
+            attributes[attribute] = value if value > 0 else 0
+        expiries = self.expiries
+        while expiries and expiries[0][0] <= tick:
+            del self.stacks[heappop(expiries)[1]]
+
+    def snapshot(self):
+        """ Returns the statuses as an immutable (tick, stacks, expiries) tuple. """
+        return self.tick, tuple(self.stacks.items()), tuple(self.expiries)
+
+    def restore(self, snapshot):
+        """ Puts the statuses back as they were when the snapshot was taken. """
+        tick, stacks, expiries = snapshot
+        self.tick = tick
+        self.stacks = dict(stacks)
+        # A heap's list stays a heap when copied in the same order.
+        self.expiries = list(expiries)
+
+    def clear(self):
+        self.stacks.clear()
+        del self.expiries[:]
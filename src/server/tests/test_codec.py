@@ -0,0 +1,102 @@
+""" Tests for codec.py. Run from src/server: python -m unittest discover tests """
+import os
+import sys
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from codec import BINARY_CODEC, CODECS, JSON_CODEC, CodecError, Spliced, SplicedPackage
+
+# A package with every kind of value either codec can carry, at every size the
+# binary codec picks a different encoding for.
+PACKAGE = {
+    "response": "GAME DATA",
+    "data": {
+        "nested": {"deeper": {"list": [1, [2, [3, {"x": None}]], {}], "empty": []}},
+        "ints": [0, 1, 127, 128, 255, 256, 32767, 32768, 2 ** 31 - 1, 2 ** 31, 2 ** 40, 2 ** 63 - 1],
+        "negative ints": [-1, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63],
+        "floats": [0.0, -1.5, 3.141592653589793, 1e300, -2.5e-300],
+        "bools": [True, False],
+        "none": None,
+        "strings": ["", "p1", "not interned", "x" * 255, "y" * 256],
+        "unicode": ["héllo", "日本語", "emoji \U0001F600", "Ω" * 200],
+        "ünicode key": "value",
+        "long list": list(range(300)),
+        "big dict": {str(index): index for index in range(300)}
+    }
+}
+
+# The same package without its longest values, to cut at every byte.
+SMALL_PACKAGE = {
+    "response": PACKAGE["response"],
+    "data": {key: value for key, value in PACKAGE["data"].items() if key not in ("long list", "big dict")}
+}
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_every_value_type_round_trips(self):
+        for codec in CODECS.values():
+            with self.subTest(codec=codec.name):
+                self.assertEqual(codec.decode(codec.encode(PACKAGE)), PACKAGE)
+
+    def test_tuples_come_back_as_lists(self):
+        for codec in CODECS.values():
+            with self.subTest(codec=codec.name):
+                self.assertEqual(codec.decode(codec.encode({"hp": (5, 10)})), {"hp": [5, 10]})
+
+    def test_spliced_items_round_trip(self):
+        shared = {"p1": {"name": "a", "hp": [5, 10]}, "p2": {"name": "b", "hp": [-3, 10]}}
+        for codec in CODECS.values():
+            with self.subTest(codec=codec.name):
+                package = SplicedPackage()
+                package["response"] = "GAME DATA"
+                package["data"] = Spliced(codec.encode_items(shared), {"player-number": 1})
+                expected = {"response": "GAME DATA", "data": dict(shared, **{"player-number": 1})}
+                self.assertEqual(codec.decode(codec.encode(package)), expected)
+
+    def test_splicing_another_codecs_items_is_refused(self):
+        package = SplicedPackage(data=Spliced(JSON_CODEC.encode_items({"a": 1})))
+        with self.assertRaises(CodecError):
+            BINARY_CODEC.encode(package)
+
+class BadInputTest(unittest.TestCase):
+
+    def test_truncated_payloads_raise_codec_error(self):
+        for codec in CODECS.values():
+            payload = codec.encode(SMALL_PACKAGE)
+            for size in range(len(payload)):
+                with self.subTest(codec=codec.name, size=size):
+                    with self.assertRaises(CodecError):
+                        codec.decode(payload[:size])
+
+    def test_corrupt_binary_payloads_raise_codec_error(self):
+        corrupt = {
+            "unknown tag": bytes((0x0F,)),
+            "unknown interned string": bytes((0x0A, 250)),
+            "unknown interned key": bytes((0x0D, 1, 0x0A, 250, 0x80)),
+            "list as a dict key": bytes((0x0D, 1, 0x0B, 0, 0x80)),
+            "dict as a dict key": bytes((0x0D, 1, 0x0D, 0, 0x80)),
+            "string longer than the payload": bytes((0x08, 10)) + b"abc",
+            "invalid utf-8": bytes((0x08, 2)) + b"\xff\xfe",
+            "trailing bytes": bytes((0x80, 0x80))
+        }
+        for case, payload in corrupt.items():
+            with self.subTest(case=case):
+                with self.assertRaises(CodecError):
+                    BINARY_CODEC.decode(payload)
+
+    def test_corrupt_json_payloads_raise_codec_error(self):
+        for payload in (b"", b"{not json", b"\xff\xfe", b'{"a": 1} trailing'):
+            with self.subTest(payload=payload):
+                with self.assertRaises(CodecError):
+                    JSON_CODEC.decode(payload)
+
+    def test_values_that_cannot_be_encoded_raise_codec_error(self):
+        for value in (2 ** 63, -2 ** 63 - 1, object(), {1, 2}):
+            with self.subTest(value=value):
+                with self.assertRaises(CodecError):
+                    BINARY_CODEC.encode({"data": value})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,318 @@
+""" Tests for content.py, initializer.py and pack.py. Run from src/server: python -m unittest discover tests """
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import content
+import initializer
+import pack
+from action import compile_action
+from game import Game
+from initializer import AssetError
+
+def describe(value):
+    """ Returns the value as plain lists and tuples, so content objects can be compared. """
+    if isinstance(value, dict):
+        return sorted((key, describe(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    if hasattr(value, "__dict__"):
+        return (type(value).__name__, describe(vars(value)))
+    return value
+
+class AssetsTest(unittest.TestCase):
+    """ Runs each test in a copy of the assets, with no content loaded yet. """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.loaded = (content._current, content._bundle)
+        self.temp = tempfile.TemporaryDirectory()
+        self.root = self.temp.name
+        for kind in ("professions", "actions"):
+            shutil.copytree(os.path.join(SERVER_DIR, "assets", kind), os.path.join(self.root, "assets", kind))
+        os.chdir(self.root)
+        content._current = None
+        content._bundle = None
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        content._current, content._bundle = self.loaded
+        self.temp.cleanup()
+
+    def path(self, asset):
+        return os.path.join(self.root, "assets", asset)
+
+    def read_asset(self, asset):
+        with open(self.path(asset)) as asset_file:
+            return json.load(asset_file)
+
+    def write_asset(self, asset, text):
+        """ Writes an asset file, and moves its modification time on by a second so the change is seen. """
+        mtime = os.stat(self.path(asset)).st_mtime_ns if os.path.exists(self.path(asset)) else 0
+        with open(self.path(asset), "w") as asset_file:
+            asset_file.write(text)
+        self.touch(asset, mtime)
+
+    def touch(self, asset, mtime=None):
+        if mtime is None:
+            mtime = os.stat(self.path(asset)).st_mtime_ns
+        os.utime(self.path(asset), ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+class BundleTest(AssetsTest):
+
+    def load(self, previous=None):
+        """ Loads the bundle, and returns it with the paths of the files that were parsed
+            for it, or None if it was used as it was. """
+        with mock.patch.object(initializer, "parse_assets", wraps=initializer.parse_assets) as parse:
+            bundle = initializer.load_bundle(self.root, previous)
+        if not parse.called:
+            return bundle, None
+        return bundle, [path for path, _ in parse.call_args[0][0]]
+
+    def test_unchanged_assets_reuse_the_bundle(self):
+        bundle, parsed = self.load()
+        self.assertEqual(len(parsed), len(bundle["manifest"]))
+        self.assertIs(self.load(bundle)[0], bundle)
+        # A new process reads the bundle written out the first time.
+        from_disk, parsed = self.load()
+        self.assertIsNone(parsed)
+        self.assertEqual(from_disk["manifest"], bundle["manifest"])
+
+    def test_a_new_mtime_rebuilds_the_bundle_without_parsing(self):
+        bundle, _ = self.load()
+        self.touch("actions/basic_attack.json")
+        rebuilt, parsed = self.load(bundle)
+        self.assertIsNot(rebuilt, bundle)
+        self.assertEqual(parsed, [])
+        mtime = os.stat(self.path("actions/basic_attack.json")).st_mtime_ns
+        self.assertIn(mtime, [entry[1] for entry in rebuilt["manifest"]])
+        self.assertEqual(initializer.read_bundle(self.root + initializer.BUNDLE_PATH)["manifest"], rebuilt["manifest"])
+
+    def test_a_new_size_parses_the_file_again(self):
+        bundle, _ = self.load()
+        asset = self.read_asset("actions/basic_attack.json")
+        self.write_asset("actions/basic_attack.json", json.dumps(asset))
+        rebuilt, parsed = self.load(bundle)
+        self.assertEqual(parsed, ["/assets/actions/basic_attack.json"])
+        self.assertEqual(describe(rebuilt["programs"]), describe(bundle["programs"]))
+
+    def test_a_new_digest_parses_the_file_again(self):
+        bundle, _ = self.load()
+        size = os.stat(self.path("actions/basic_attack.json")).st_size
+        with open(self.path("actions/basic_attack.json")) as asset_file:
+            text = asset_file.read()
+        # The same size, but different contents.
+        self.write_asset("actions/basic_attack.json", text.replace('"change": 5', '"change": 7'))
+        self.assertEqual(os.stat(self.path("actions/basic_attack.json")).st_size, size)
+        rebuilt, parsed = self.load(bundle)
+        self.assertEqual(parsed, ["/assets/actions/basic_attack.json"])
+        self.assertEqual(rebuilt["programs"]["basic_attack"][2], (("hp", 7),))
+
+class ReloadTest(AssetsTest):
+
+    def set_attack_damage(self, damage):
+        asset = self.read_asset("actions/basic_attack.json")
+        asset["modifiers"][0]["change"] = damage
+        self.write_asset("actions/basic_attack.json", json.dumps(asset))
+
+    def test_nothing_is_published_while_nothing_has_changed(self):
+        loaded = content.load_content()
+        self.assertIsNone(content.reload_content())
+        # A file that was only touched still has the same contents.
+        self.touch("actions/basic_attack.json")
+        self.assertIsNone(content.reload_content())
+        self.assertIs(content.current_content(), loaded)
+
+    def test_reload_publishes_a_new_version_and_running_games_keep_theirs(self):
+        old = content.load_content()
+        running = Game()
+        self.set_attack_damage(7)
+        new = content.reload_content()
+        self.assertEqual(new.version, old.version + 1)
+        self.assertIs(content.current_content(), new)
+        self.assertEqual(new.programs["basic_attack"][2], (("hp", 7),))
+        # The game that was already running still plays by the old content.
+        self.assertIs(running.content, old)
+        self.assertEqual(old.programs["basic_attack"][2], (("hp", 5),))
+        for name in ("a", "b"):
+            running.add_player(name)
+            running.set_player_profession(name, "Warrior")
+            running.set_player_ready(name, True)
+        running.try_start()
+        running.try_action("a", 2, "basic_attack")
+        self.assertEqual(running.players[1].attributes["hp"], 115)
+        self.assertIs(Game().content, new)
+
+    def test_a_bad_asset_leaves_the_current_content_in_place(self):
+        loaded = content.load_content()
+        warrior = self.read_asset("professions/warrior.json")
+        broken = dict(warrior, actions=["basic_attack", "no_such_action"])
+        cases = (
+            ("actions/basic_attack.json", "{ not json"),
+            ("actions/basic_attack.json", json.dumps({"TPR-Type": "action", "name": "basic_attack"})),
+            ("professions/warrior.json", json.dumps(broken))
+        )
+        for asset, text in cases:
+            with self.subTest(asset=asset, text=text):
+                with open(self.path(asset)) as asset_file:
+                    good = asset_file.read()
+                self.write_asset(asset, text)
+                with self.assertRaises(AssetError):
+                    content.reload_content()
+                self.assertIs(content.current_content(), loaded)
+                self.write_asset(asset, good)
+        # Once the files are fixed, the next reload goes through.
+        self.set_attack_damage(9)
+        self.assertEqual(content.reload_content().programs["basic_attack"][2], (("hp", 9),))
+
+# An action that no profession uses, so it is only decoded when asked for.
+SPARE_ACTION = {
+    "TPR-Type": "action",
+    "name": "spare_bolt",
+    "costs": {"ap": 2, "mana": 4},
+    "modifiers": [{"attribute": "hp", "change": 3}, {"attribute": "hp", "change": 2}],
+    "statuses": [{"modifier": {"attribute": "mana", "change": 1}, "duration": 2, "duration_delta": -1}]
+}
+
+class LazyActionTest(AssetsTest):
+
+    def test_unused_actions_are_decoded_on_first_access(self):
+        self.write_asset("actions/spare_bolt.json", json.dumps(SPARE_ACTION))
+        loaded = content.load_content()
+        self.assertIn("spare_bolt", loaded.actions)
+        self.assertIn("spare_bolt", list(loaded.programs))
+        # Used actions are built up front, and the spare one is still its compact JSON.
+        self.assertNotIn("basic_attack", loaded._pending)
+        self.assertIn("spare_bolt", loaded._pending)
+        self.assertFalse(dict.__contains__(loaded._actions, "spare_bolt"))
+
+        self.assertEqual(loaded.programs["spare_bolt"][:3], (2, 4, (("hp", 5),)))
+        self.assertNotIn("spare_bolt", loaded._pending)
+        action = loaded.actions["spare_bolt"]
+        self.assertEqual(describe(loaded.programs["spare_bolt"]), describe(compile_action(action)))
+        self.assertEqual(loaded.harm["spare_bolt"], 5)
+        self.assertEqual(describe(action), describe(initializer.build_action(SPARE_ACTION, "")))
+
+    def test_each_action_is_materialized_once(self):
+        action = initializer.build_action(SPARE_ACTION, "")
+        materialize = mock.Mock(return_value=(action, compile_action(action)))
+        lazy = content.Content(1, {}, {}, {}, {"spare_bolt": "entry"}, materialize)
+        self.assertEqual(list(lazy.actions), ["spare_bolt"])
+        self.assertEqual(len(lazy.programs), 1)
+        materialize.assert_not_called()
+        self.assertEqual(lazy.harm["spare_bolt"], 5)
+        self.assertIs(lazy.actions["spare_bolt"], action)
+        self.assertIs(lazy.programs.get("spare_bolt"), lazy.programs["spare_bolt"])
+        materialize.assert_called_once_with("entry")
+        self.assertIsNone(lazy.programs.get("no_such_action"))
+        with self.assertRaises(KeyError):
+            lazy.actions["no_such_action"]
+
+    def test_parsing_in_worker_processes_gives_the_same_results(self):
+        items = []
+        for path, _, _ in initializer.scan_sources(self.root):
+            with open(self.root + path, "rb") as asset_file:
+                items.append((path, asset_file.read()))
+        serial = initializer.parse_assets(items, processes=1)
+        with mock.patch.object(initializer, "PARALLEL_PARSE_MIN", 1):
+            parallel = initializer.parse_assets(items, processes=2)
+        self.assertEqual(describe(parallel), describe(serial))
+
+class PackTest(AssetsTest):
+
+    def setUp(self):
+        super().setUp()
+        self.write_asset("actions/spare_bolt.json", json.dumps(SPARE_ACTION))
+
+    def test_the_pack_round_trips_the_json_assets(self):
+        bundle = initializer.load_bundle(self.root)
+        self.assertEqual(pack.pack_assets(self.root), (6, 4))
+        packed = pack.ContentPack(self.root + pack.PACK_PATH)
+        professions = dict(bundle["professions"])
+        del professions["None"]
+        self.assertEqual(describe(packed.professions()), describe(professions))
+        numbers = packed.action_numbers()
+        self.assertEqual(sorted(numbers), sorted(list(bundle["actions"]) + list(bundle["lazy_actions"])))
+        for name, number in numbers.items():
+            with self.subTest(action=name):
+                if name in bundle["actions"]:
+                    expected = (bundle["actions"][name], bundle["programs"][name])
+                else:
+                    expected = initializer.materialize_action(bundle["lazy_actions"][name])
+                self.assertEqual(describe(packed.action(number)), describe(expected))
+
+    def test_the_pack_is_loaded_instead_of_the_json_assets(self):
+        from_json = content.load_content()
+        pack.pack_assets(self.root)
+        from_pack = content.load_content()
+        self.assertEqual(sorted(from_pack._pending), sorted(from_json.actions))
+        self.assertEqual(describe(dict(from_pack.professions)), describe(dict(from_json.professions)))
+        for name in from_json.actions:
+            with self.subTest(action=name):
+                self.assertEqual(describe(from_pack.programs[name]), describe(from_json.programs[name]))
+        # Edits to the JSON assets are only picked up once they are packed again.
+        asset = self.read_asset("actions/basic_attack.json")
+        asset["modifiers"][0]["change"] = 7
+        self.write_asset("actions/basic_attack.json", json.dumps(asset))
+        self.assertIsNone(content.reload_content())
+        pack.pack_assets(self.root)
+        self.touch("content.pack")
+        self.assertEqual(content.reload_content().programs["basic_attack"][2], (("hp", 7),))
+        self.assertEqual(from_pack.programs["basic_attack"][2], (("hp", 5),))
+
+    def test_a_damaged_pack_raises_asset_error(self):
+        pack.pack_assets(self.root)
+        with open(self.root + pack.PACK_PATH, "rb") as pack_file:
+            packed = pack_file.read()
+        cases = {
+            "empty": b"",
+            "cut short in the header": packed[:pack.HEADER.size - 1],
+            "cut short in a table": packed[:pack.HEADER.size + 4],
+            "not a pack": b"NOTAPACK" + packed[8:],
+            "another format": packed[:8] + (pack.PACK_FORMAT + 1).to_bytes(4, "little") + packed[12:]
+        }
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with open(self.root + pack.PACK_PATH, "wb") as pack_file:
+                    pack_file.write(data)
+                with self.assertRaises(AssetError):
+                    content.load_content()
+
+    def test_watching_warns_that_json_edits_are_ignored(self):
+        with mock.patch.object(content, "_watch"):
+            with self.assertNoLogs(content.content_log, "WARNING"):
+                content.watch_assets().join()
+            pack.pack_assets(self.root)
+            with self.assertLogs(content.content_log, "WARNING") as logs:
+                content.watch_assets().join()
+        self.assertIn("JSON assets are ignored", logs.output[0])
+
+class RankedActionsTest(AssetsTest):
+
+    def test_actions_are_ranked_most_harmful_first(self):
+        loaded = content.load_content()
+        actions = loaded.professions["Warrior"].actions
+        ranking = loaded.ranked_actions(actions)
+        self.assertEqual([item[3] for item in ranking], ["basic_attack", "basic_defend", "basic_rest"])
+        self.assertEqual(ranking[0], (5, 3, 0, "basic_attack"))
+        self.assertIs(loaded.ranked_actions(actions), ranking)
+
+    def test_each_version_ranks_by_its_own_actions(self):
+        old = content.load_content()
+        asset = self.read_asset("actions/basic_rest.json")
+        asset["modifiers"] = [{"attribute": "hp", "change": 50}]
+        self.write_asset("actions/basic_rest.json", json.dumps(asset))
+        new = content.reload_content()
+        # The profession's action list is the same, but the new version ranks it differently.
+        self.assertEqual(new.ranked_actions(new.professions["Warrior"].actions)[0][3], "basic_rest")
+        self.assertEqual(old.ranked_actions(old.professions["Warrior"].actions)[0][3], "basic_attack")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+""" Tests for framing.py, and that the client and the server share the same
+    framing and codec modules. Run from src/server: python -m unittest discover tests """
+import asyncio
+import filecmp
+import os
+import socket
+import sys
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIR = os.path.join(os.path.dirname(SERVER_DIR), "client")
+sys.path.insert(0, SERVER_DIR)
+
+from framing import FrameBuffer, FramedSocket, pack_frame, read_frame
+
+class SharedModuleTest(unittest.TestCase):
+
+    def test_client_and_server_copies_are_identical(self):
+        for module in ("framing.py", "codec.py"):
+            with self.subTest(module=module):
+                self.assertTrue(
+                    filecmp.cmp(os.path.join(SERVER_DIR, module), os.path.join(CLIENT_DIR, module), shallow=False),
+                    "src/client/{0} and src/server/{0} have drifted apart".format(module)
+                )
+
+class FramingTest(unittest.TestCase):
+
+    def test_empty_frame_is_not_a_disconnect(self):
+        left, right = socket.socketpair()
+        with left, right:
+            sender = FramedSocket(left)
+            receiver = FramedSocket(right)
+            sender.send(b"")
+            sender.send(b"after")
+            self.assertEqual(receiver.recv(), b"")
+            self.assertEqual(receiver.recv(), b"after")
+            left.shutdown(socket.SHUT_WR)
+            self.assertIsNone(receiver.recv())
+
+    def test_buffer_tells_partial_frames_from_empty_ones(self):
+        buffer = FrameBuffer()
+        frame = pack_frame(b"")
+        buffer.feed(frame[:2])
+        self.assertIsNone(buffer.next_frame())
+        buffer.feed(frame[2:])
+        self.assertEqual(buffer.next_frame(), b"")
+        self.assertIsNone(buffer.next_frame())
+
+    def test_read_frame_returns_none_at_end_of_stream(self):
+        async def read_all():
+            reader = asyncio.StreamReader()
+            reader.feed_data(pack_frame(b"") + pack_frame(b"x"))
+            reader.feed_eof()
+            return [await read_frame(reader) for _ in range(3)]
+        self.assertEqual(asyncio.run(read_all()), [b"", b"x", None])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+""" Tests for game.py. Run from src/server: python -m unittest discover tests """
+import os
+import sys
+import threading
+import unittest
+from types import MappingProxyType, SimpleNamespace
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from codec import JSON_CODEC
+from bot import Bot
+from game import Game
+from start_server import client_do_batch, lobby_package
+
+# Values that can never change, so sharing them is always safe.
+IMMUTABLE = (type(None), bool, int, float, complex, str, bytes, range, type, frozenset)
+
+def reachable(root, skip=frozenset()):
+    """ Returns the objects that can change and are reachable from root, by id,
+        leaving out those whose ids are in skip and anything reached through them. """
+    found = {}
+    stack = [root]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, IMMUTABLE) or id(value) in skip:
+            continue
+        if isinstance(value, tuple):
+            stack.extend(value)
+            continue
+        if isinstance(value, MappingProxyType):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+            continue
+        if id(value) in found:
+            continue
+        found[id(value)] = value
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, set)):
+            stack.extend(value)
+        elif hasattr(value, "__dict__"):
+            stack.extend(vars(value).values())
+    return found
+
+class GameTest(unittest.TestCase):
+
+    def setUp(self):
+        # The content is loaded from the assets under the working directory.
+        self.cwd = os.getcwd()
+        os.chdir(SERVER_DIR)
+        self.game = Game()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def join(self, *names, profession="Warrior"):
+        for name in names:
+            self.game.add_player(name)
+            self.game.set_player_profession(name, profession)
+
+    def start(self, *names):
+        self.join(*names)
+        for name in names:
+            self.game.set_player_ready(name, True)
+        self.assertTrue(self.game.try_start())
+
+class DeltaTest(GameTest):
+
+    def test_delta_holds_exactly_the_fields_that_changed(self):
+        self.join("a", "b")
+        version = self.game.version
+        self.game.set_player_ready("b", True)
+        self.assertEqual(self.game.get_changes(version), (version + 1, {"p2": {"ready": True}}))
+
+    def test_delta_covers_every_change_since_the_version(self):
+        self.start("a", "b")
+        version = self.game.version
+        self.assertEqual(self.game.try_action("a", 2, "basic_attack"), 0)
+        self.assertEqual(self.game.cycle_turn(), 0)
+        changes = {
+            "game": {"turn-number": 2, "active-player": 2},
+            "p1": {"ap": [2, 5]},
+            "p2": {"hp": [115, 120]}
+        }
+        self.assertEqual(self.game.get_changes(version), (version + 2, changes))
+        # Asking from the version in between leaves out the action.
+        self.assertEqual(
+            self.game.get_changes(version + 1),
+            (version + 2, {"game": {"turn-number": 2, "active-player": 2}})
+        )
+
+    def test_nothing_has_changed_since_the_current_version(self):
+        self.join("a")
+        self.assertEqual(self.game.get_changes(self.game.version), (self.game.version, {}))
+
+    def test_unknown_versions_get_a_full_snapshot(self):
+        self.join("a")
+        for since in (None, self.game.version + 1):
+            with self.subTest(since=since):
+                self.assertEqual(self.game.get_changes(since), (self.game.version, None))
+
+    def test_remove_player_forces_a_full_snapshot(self):
+        self.join("a", "b", "c")
+        version = self.game.version
+        self.assertTrue(self.game.remove_player("b"))
+        self.assertEqual(self.game.resync_version, self.game.version)
+        self.assertEqual(self.game.get_changes(version), (self.game.version, None))
+        # Clients that have caught up get deltas again.
+        self.assertEqual(self.game.get_changes(self.game.version), (self.game.version, {}))
+
+    def test_reused_slot_forces_a_full_package(self):
+        self.join("a", "b", "c")
+        conn = SimpleNamespace(codec=JSON_CODEC, deltas=True, lobby_version=self.game.version)
+        self.game.remove_player("b")
+        self.join("d", profession="Monk")
+        self.assertGreater(self.game.resync_version, conn.lobby_version)
+        spkg = JSON_CODEC.decode(JSON_CODEC.encode(lobby_package(conn, "a", self.game)))
+        self.assertEqual(spkg["response"], "LOBBY DATA")
+        lobby = spkg["data"]["lobby"]
+        self.assertEqual([lobby[key]["name"] for key in ("p1", "p2", "p3", "p4")], ["a", "c", "d", ""])
+        self.assertEqual(lobby["p3"]["profession"], "Monk")
+        self.assertEqual(conn.lobby_version, self.game.version)
+        # The next change is a delta against the full package.
+        self.game.set_player_ready("d", True)
+        spkg = JSON_CODEC.decode(JSON_CODEC.encode(lobby_package(conn, "a", self.game)))
+        self.assertEqual(spkg["response"], "LOBBY DELTA")
+        self.assertEqual(spkg["data"]["lobby"], {"p3": {"ready": True}})
+
+    def test_publish_calls_every_subscriber_but_the_one_who_changed_it(self):
+        self.join("a", "b")
+        calls = []
+        self.game.subscribe("a", lambda game: calls.append("a"))
+        self.game.subscribe("b", lambda game: calls.append("b"))
+        self.game.set_player_ready("a", True)
+        self.assertEqual(calls, ["b"])
+        self.game.unsubscribe("b")
+        self.game.set_player_ready("a", False)
+        self.assertEqual(calls, ["b"])
+
+class BatchTest(GameTest):
+
+    def test_each_item_gets_its_own_result(self):
+        self.start("a", "b")
+        actions = [(2, "basic_attack"), (2, "basic_attack"), (2, "basic_defend")]
+        self.assertEqual(self.game.try_batch("a", actions, False), [0, -1, 0])
+        self.assertEqual(self.game.players[0].attributes["ap"], 0)
+        self.assertEqual(self.game.players[1].attributes["hp"], 115)
+
+    def test_ending_the_turn_adds_a_result(self):
+        self.start("a", "b")
+        self.assertEqual(self.game.try_batch("a", [(2, "basic_attack")], True), [0, 0])
+        self.assertEqual(self.game.active_player, 1)
+
+    def test_every_item_fails_when_it_is_not_your_turn(self):
+        self.start("a", "b")
+        version = self.game.version
+        self.assertEqual(self.game.try_batch("b", [(1, "basic_attack")], True), [-3, -3])
+        self.assertEqual(self.game.version, version)
+        self.assertEqual(self.game.active_player, 0)
+
+    def test_every_item_fails_when_the_version_is_stale(self):
+        self.start("a", "b")
+        version = self.game.version
+        self.game.try_action("a", 2, "basic_defend")
+        self.assertEqual(self.game.try_batch("a", [(2, "basic_attack")], True, version), [-3, -3])
+        self.assertEqual(self.game.players[1].attributes["hp"], 120)
+        self.assertEqual(self.game.try_batch("a", [(2, "basic_attack")], False, self.game.version), [0])
+
+    def test_unknown_targets_and_actions_are_invalid(self):
+        self.start("a", "b")
+        version = self.game.version
+        actions = [(0, "basic_attack"), (3, "basic_attack"), (2, "no_such_action")]
+        self.assertEqual(self.game.try_batch("a", actions, False), [-4, -4, -4])
+        self.assertEqual(self.game.version, version)
+
+class BatchRequestTest(GameTest):
+
+    def batch(self, name, actions, end_turn=False):
+        """ Sends a BATCH request as the given player and returns the results in the reply. """
+        sent = []
+        conn = SimpleNamespace(codec=JSON_CODEC, deltas=False, send_lock=threading.RLock(), send_package=sent.append)
+        data = {"actions": [{"target": target, "action": action} for target, action in actions], "end-turn": end_turn}
+        self.assertEqual(client_do_batch(conn, name, self.game, data), 0)
+        self.assertEqual(len(sent), 1)
+        spkg = JSON_CODEC.decode(JSON_CODEC.encode(sent[0]))
+        self.assertEqual(spkg["response"], "GAME DATA")
+        return spkg["data"]["results"]
+
+    def test_results_are_named_for_each_item(self):
+        self.start("a", "b")
+        actions = [(2, "basic_attack"), (2, "basic_attack"), (2, "basic_defend")]
+        self.assertEqual(self.batch("a", actions), ["OK", "NOT ENOUGH AP", "OK"])
+
+    def test_not_your_turn(self):
+        self.start("a", "b")
+        self.assertEqual(self.batch("b", [(1, "basic_attack")], True), ["NOT PLAYER TURN", "NOT PLAYER TURN"])
+
+    def test_invalid_items(self):
+        self.start("a", "b")
+        actions = [(7, "basic_attack"), (2, "no_such_action")]
+        self.assertEqual(self.batch("a", actions), ["INVALID REQUEST", "INVALID REQUEST"])
+
+class SnapshotTest(GameTest):
+
+    def test_restore_puts_back_every_change(self):
+        self.start("a", "b")
+        self.game.try_action("a", 2, "basic_defend")
+        state = self.game.snapshot()
+        players = [player.state_dict() for player in self.game.players]
+        statuses = [player.statuses.snapshot() for player in self.game.players]
+        # Change hp, ap, mana, statuses, the turn and the versions.
+        self.game.try_action("a", 2, "basic_attack")
+        self.game.cycle_turn()
+        self.game.try_action("b", 1, "basic_rest")
+        self.game.try_action("b", 1, "basic_rest")
+        self.game.players[0].statuses.clear()
+        changed = self.game.version
+        self.assertNotEqual([player.state_dict() for player in self.game.players], players)
+
+        self.game.restore(state)
+        self.assertEqual(self.game.snapshot()._replace(version=state.version), state)
+        self.assertEqual([player.state_dict() for player in self.game.players], players)
+        self.assertEqual([player.statuses.snapshot() for player in self.game.players], statuses)
+        self.assertEqual((self.game.turn_number, self.game.active_player), (1, 0))
+        # The version moves on, and clients holding a version from before get a full snapshot.
+        self.assertGreater(self.game.version, changed)
+        self.assertEqual(self.game.resync_version, self.game.version)
+        self.assertEqual(self.game.get_changes(changed), (self.game.version, None))
+
+    def test_restore_brings_back_players_who_have_left(self):
+        self.join("a", "b")
+        self.game.add_player("Bot 1", Bot)
+        state = self.game.snapshot()
+        self.game.remove_player("a")
+        self.join("c")
+        self.game.restore(state)
+        self.assertEqual([player.name for player in self.game.players], ["a", "b", "Bot 1"])
+        self.assertIsInstance(self.game.players[2], Bot)
+        self.assertEqual(self.game.slots, {"a": 0, "b": 1, "Bot 1": 2})
+        self.assertEqual(self.game.snapshot()._replace(version=state.version), state)
+
+    def test_a_snapshot_can_be_restored_again_and_again(self):
+        self.start("a", "b")
+        state = self.game.snapshot()
+        for _ in range(3):
+            self.game.try_action("a", 2, "basic_attack")
+            self.game.cycle_turn()
+            self.game.restore(state)
+            self.assertEqual(self.game.snapshot()._replace(version=state.version), state)
+
+    def test_clone_shares_nothing_that_can_change(self):
+        self.start("a", "b")
+        self.game.try_action("a", 2, "basic_defend")
+        self.game.subscribe("a", lambda game: None)
+        clone = self.game.clone()
+        self.assertEqual(clone.snapshot()._replace(version=0), self.game.snapshot()._replace(version=0))
+        # The content is shared on purpose, since nothing ever changes it.
+        self.assertIs(clone.content, self.game.content)
+        content = reachable(self.game.content)
+        originals = reachable(self.game, content)
+        shared = [type(value).__name__ for key, value in reachable(clone, content).items() if key in originals]
+        self.assertEqual(shared, [])
+        self.assertEqual(clone.subscribers, {})
+        # Playing on the clone leaves the game as it was.
+        state = self.game.snapshot()
+        clone.try_action("a", 2, "basic_attack")
+        clone.cycle_turn()
+        self.assertEqual(self.game.snapshot(), state)
+
+if __name__ == "__main__":
+    unittest.main()
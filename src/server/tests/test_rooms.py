@@ -0,0 +1,97 @@
+""" Tests for rooms.py. Run from src/server: python -m unittest discover tests """
+import os
+import sys
+import threading
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from bot import Bot
+from player import Player
+from rooms import MAX_PLAYERS, RoomRegistry
+
+class CloseRoomTest(unittest.TestCase):
+
+    def setUp(self):
+        # The content is loaded from the assets under the working directory.
+        self.cwd = os.getcwd()
+        os.chdir(SERVER_DIR)
+        self.rooms = RoomRegistry()
+        self.game = self.rooms.create_room()
+        for name, player_class in (("a", Player), ("b", Player), ("Bot 1", Bot)):
+            self.game.add_player(name, player_class)
+            self.game.set_player_profession(name, self.game.content.playable_professions()[0])
+            self.game.set_player_ready(name, True)
+        self.assertTrue(self.game.try_start("a"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_room_closes_when_every_human_disconnects_mid_game(self):
+        self.game.disconnect_player("a")
+        self.assertFalse(self.rooms.close_room_if_done(self.game))
+        self.assertIs(self.rooms.get_room(self.game.room_id), self.game)
+        self.game.disconnect_player("b")
+        self.assertTrue(self.game.in_game)
+        self.assertTrue(self.rooms.close_room_if_done(self.game))
+        self.assertIsNone(self.rooms.get_room(self.game.room_id))
+        self.assertEqual(len(self.rooms), 0)
+
+    def test_room_stays_open_while_a_human_is_connected(self):
+        self.assertFalse(self.rooms.close_room_if_done(self.game))
+        self.assertEqual(len(self.rooms), 1)
+
+class QuickJoinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(SERVER_DIR)
+        self.rooms = RoomRegistry()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_quick_joins_fill_the_oldest_room_first(self):
+        for number in range(MAX_PLAYERS + 1):
+            game, result = self.rooms.join_open_room("p{}".format(number))
+            self.assertEqual(result, number % MAX_PLAYERS)
+            self.assertEqual(game.room_id, 1 + number // MAX_PLAYERS)
+        self.assertEqual(len(self.rooms), 2)
+
+    def test_rooms_that_have_started_are_skipped(self):
+        started = self.rooms.create_room()
+        started.add_player("a", Bot)
+        started.set_player_profession("a", started.content.playable_professions()[0])
+        started.set_player_ready("a", True)
+        self.assertTrue(started.try_start())
+        game, result = self.rooms.join_open_room("b")
+        self.assertIsNot(game, started)
+        self.assertEqual(result, 0)
+        self.assertEqual(started.add_player("c"), -3)
+
+    def test_a_taken_name_is_reported(self):
+        game, _ = self.rooms.join_open_room("a")
+        self.assertEqual(self.rooms.join_open_room("a"), (game, -2))
+
+    def test_concurrent_quick_joins_never_find_a_room_full(self):
+        count = MAX_PLAYERS * 8
+        barrier = threading.Barrier(count)
+        results = []
+
+        def join(name):
+            barrier.wait()
+            results.append(self.rooms.join_open_room(name))
+
+        threads = [threading.Thread(target=join, args=("p{}".format(number),)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(sorted(result for _, result in results), sorted(list(range(MAX_PLAYERS)) * 8))
+        self.assertEqual(len(self.rooms), 8)
+        for room in self.rooms.list_rooms():
+            self.assertEqual(room["players"], MAX_PLAYERS)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+""" Tests for rwlock.py. Run from src/server: python -m unittest discover tests """
+import os
+import sys
+import threading
+import time
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from rwlock import RWLock
+
+# How long to give another thread to get somewhere it should not, or should.
+WAIT = 0.1
+
+def wait_until(condition, timeout=5):
+    """ Polls until the condition holds, and returns whether it did in time. """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class RWLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = RWLock()
+
+    def holder(self, acquire, release, entered, leave):
+        """ Returns a thread body that takes the lock, says so, and lets go once told to. """
+        def run():
+            acquire()
+            entered.set()
+            leave.wait()
+            release()
+        return run
+
+    def test_readers_share_the_lock(self):
+        entered = [threading.Event(), threading.Event()]
+        leave = threading.Event()
+        threads = [
+            start(self.holder(self.lock.acquire_read, self.lock.release_read, event, leave)) for event in entered
+        ]
+        for event in entered:
+            self.assertTrue(event.wait(5))
+        leave.set()
+        for thread in threads:
+            thread.join(5)
+
+    def test_a_writer_excludes_readers_and_writers(self):
+        others = ((self.lock.acquire_read, self.lock.release_read), (self.lock.acquire, self.lock.release))
+        for acquire, release in others:
+            with self.subTest(other=acquire.__name__):
+                self.lock.acquire()
+                entered = threading.Event()
+                leave = threading.Event()
+                thread = start(self.holder(acquire, release, entered, leave))
+                self.assertFalse(entered.wait(WAIT))
+                self.lock.release()
+                self.assertTrue(entered.wait(5))
+                leave.set()
+                thread.join(5)
+
+    def test_readers_exclude_a_writer(self):
+        self.lock.acquire_read()
+        entered = threading.Event()
+        leave = threading.Event()
+        thread = start(self.holder(self.lock.acquire, self.lock.release, entered, leave))
+        self.assertFalse(entered.wait(WAIT))
+        self.lock.release_read()
+        self.assertTrue(entered.wait(5))
+        leave.set()
+        thread.join(5)
+
+    def test_a_waiting_writer_goes_before_new_readers(self):
+        self.lock.acquire_read()
+        writer_leave = threading.Event()
+        writer = start(self.holder(self.lock.acquire, self.lock.release, threading.Event(), writer_leave))
+        self.assertTrue(wait_until(lambda: self.lock._writers_waiting == 1))
+        # The lock is only held for reading, but the new reader still waits behind the writer.
+        reader_entered = threading.Event()
+        reader_leave = threading.Event()
+        reader = start(self.holder(self.lock.acquire_read, self.lock.release_read, reader_entered, reader_leave))
+        self.assertFalse(reader_entered.wait(WAIT))
+        # Once the first reader leaves, the writer gets the lock and the reader keeps waiting.
+        self.lock.release_read()
+        self.assertTrue(wait_until(lambda: self.lock._writing))
+        self.assertFalse(reader_entered.wait(WAIT))
+        writer_leave.set()
+        writer.join(5)
+        self.assertTrue(reader_entered.wait(5))
+        reader_leave.set()
+        reader.join(5)
+
+if __name__ == "__main__":
+    unittest.main()
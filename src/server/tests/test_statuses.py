@@ -0,0 +1,40 @@
+""" Tests for statuses.py. Run from src/server: python -m unittest discover tests """
+import os
+import sys
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from action import Modifier, Status
+from statuses import StatusEngine
+
+def damage_per_tick(statuses, ticks):
+    """ Adds the statuses to a fresh engine and returns the hp each tick takes away. """
+    engine = StatusEngine()
+    engine.add_all(statuses)
+    attributes = {"hp": 1000}
+    damage = []
+    for _ in range(ticks):
+        before = attributes["hp"]
+        engine.process(attributes)
+        damage.append(before - attributes["hp"])
+    return damage
+
+class StatusEngineTest(unittest.TestCase):
+
+    def test_mixed_durations_stack_in_either_order(self):
+        short = Status(Modifier("hp", 2), duration=1)
+        long = Status(Modifier("hp", 2), duration=5)
+        self.assertEqual(damage_per_tick([short, long], 6), [4, 2, 2, 2, 2, 0])
+        self.assertEqual(damage_per_tick([long, short], 6), [4, 2, 2, 2, 2, 0])
+
+    def test_identical_statuses_share_a_record(self):
+        engine = StatusEngine()
+        status = Status(Modifier("hp", 3), duration=2)
+        engine.add_all([status, status])
+        self.assertEqual(len(engine.stacks), 1)
+        self.assertEqual(len(engine), 2)
+
+if __name__ == "__main__":
+    unittest.main()